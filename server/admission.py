@@ -0,0 +1,126 @@
+import math
+import time
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+
+############### USAGE ################
+# async with admission.slot(): ...              bounded concurrency, FIFO queue, QueueFullError when full
+# async with conversation_locks.hold(conv_id): ...  one turn at a time per conversation,
+#     QueueFullError when max_waiters turns are already waiting for it
+######################################
+
+class QueueFullError(Exception):
+    """Too many requests are already waiting; retry_after is a hint in seconds"""
+    def __init__(self, retry_after):
+        super().__init__("Server is busy, please retry later")
+        self.retry_after = retry_after
+
+class AdmissionController:
+    """
+    Limits how many requests run at once. Extra requests wait in a FIFO queue
+    (so they are admitted in arrival order) and are shed once the queue is full.
+    """
+    def __init__(self, max_concurrent=64, max_queue=256):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.active = 0
+        self.waiters = deque()
+        # Moving average of how long a request holds its slot, for the retry hint
+        self.avg_service_time = 1.0
+
+    def is_full(self) -> bool:
+        """True if a new request would be rejected right now"""
+        return self.active >= self.max_concurrent and len(self.waiters) >= self.max_queue
+
+    def retry_after(self) -> int:
+        """Rough seconds until the queue drains enough to admit a new request"""
+        backlog = len(self.waiters) + 1
+        return max(1, math.ceil(backlog * self.avg_service_time / self.max_concurrent))
+
+    async def acquire(self):
+        if self.active < self.max_concurrent and not self.waiters:
+            self.active += 1
+            return
+        if len(self.waiters) >= self.max_queue:
+            raise QueueFullError(self.retry_after())
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed to us just as we were cancelled; pass it on
+                self.release()
+            elif waiter in self.waiters:
+                self.waiters.remove(waiter)
+            raise
+
+    def release(self):
+        # Hand the slot straight to the next waiter so late arrivals can't jump the queue
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    @asynccontextmanager
+    async def slot(self):
+        await self.acquire()
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.avg_service_time = 0.9 * self.avg_service_time + 0.1 * (time.monotonic() - started)
+            self.release()
+
+class ConversationLocks:
+    """Per-conversation locks, dropped again once nobody holds or waits for them"""
+    def __init__(self, max_waiters=8):
+        self.max_waiters = max_waiters
+        # conversation_id -> [lock, number of holders and waiters]
+        self.locks = {}
+        # Moving average of how long a turn holds its conversation, for the retry hint
+        self.avg_hold_time = 1.0
+
+    def is_full(self, conversation_id) -> bool:
+        """True if a new turn on conversation_id would be rejected right now"""
+        entry = self.locks.get(conversation_id) if conversation_id else None
+        # One holder plus max_waiters queued behind it
+        return entry is not None and entry[1] > self.max_waiters
+
+    def retry_after(self, conversation_id) -> int:
+        """Rough seconds until the turns queued on conversation_id have run"""
+        entry = self.locks.get(conversation_id)
+        return max(1, math.ceil((entry[1] if entry else 1) * self.avg_hold_time))
+
+    @asynccontextmanager
+    async def hold(self, conversation_id, shed=True):
+        """
+        Args:
+            conversation_id: Conversation to lock (None for a new one, which needs no lock)
+            shed: Raise QueueFullError instead of waiting behind max_waiters other turns
+                  (callers that bound their own concurrency can pass False)
+        """
+        # New conversations (no id yet) can't collide with anything
+        if not conversation_id:
+            yield
+            return
+
+        if shed and self.is_full(conversation_id):
+            raise QueueFullError(self.retry_after(conversation_id))
+        entry = self.locks.setdefault(conversation_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                started = time.monotonic()
+                try:
+                    yield
+                finally:
+                    self.avg_hold_time = 0.9 * self.avg_hold_time + 0.1 * (time.monotonic() - started)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.locks[conversation_id]
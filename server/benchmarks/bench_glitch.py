@@ -0,0 +1,47 @@
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import promptUtils
+
+############### USAGE ################
+# Compares the glitch engine with the previous implementation on long replies:
+#   python benchmarks/bench_glitch.py --size 10240 --runs 20
+######################################
+
+# The implementation applyGlitches replaced: one randint pair per glitch, repeats compound on collisions
+def legacy_add_glitch(incomingText, glitchLevel):
+    numGlitches = int(len(incomingText) * pow(glitchLevel, 2))
+    glitchText = list(incomingText)
+    for _ in range(numGlitches):
+        index = random.randint(0, len(incomingText) - 1)
+        numRepeats = random.randint(2, 6)
+        glitchText[index] = glitchText[index] * numRepeats
+    return ''.join(glitchText)
+
+def bench(fn, text, level, runs):
+    """Returns (mean milliseconds per call, mean output length)"""
+    total_length = 0
+    started = time.perf_counter()
+    for _ in range(runs):
+        total_length += len(fn(text, level))
+    return (time.perf_counter() - started) * 1000 / runs, total_length // runs
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Glitch engine microbenchmark")
+    parser.add_argument("--size", type=int, default=10 * 1024, help="Reply size in characters")
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    random.seed(0)
+    words = ["ugh", "whatever", "fine", "seriously", "why", "would", "you", "ask", "me", "that"]
+    text = " ".join(random.choice(words) for _ in range(args.size))[:args.size]
+
+    print(f"{'level':>6} {'legacy ms':>10} {'legacy len':>11} {'new ms':>8} {'new len':>8} {'speedup':>8}")
+    for level in [0.1, 0.25, 0.5, 0.75, 1.0]:
+        legacy_ms, legacy_len = bench(legacy_add_glitch, text, level, args.runs)
+        new_ms, new_len = bench(promptUtils.addGlitch, text, level, args.runs)
+        print(f"{level:>6} {legacy_ms:>10.2f} {legacy_len:>11} {new_ms:>8.2f} {new_len:>8} {legacy_ms / new_ms:>7.1f}x")
@@ -0,0 +1,60 @@
+import os
+import sys
+import random
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from history import ConversationRecord
+
+############### USAGE ################
+# Memory held per conversation by each in-memory layout:
+#   python benchmarks/bench_memory.py --sessions 10000 100000 --turns 8
+######################################
+
+WORDS = ("why", "are", "you", "so", "grumpy", "tell", "me", "a", "joke", "the", "weather", "is",
+         "fine", "ugh", "whatever", "pizza", "homework", "plants", "need", "light", "and", "water")
+
+def make_conversation(rng, turns):
+    messages = []
+    for _ in range(turns):
+        messages.append({"role": "user", "content": " ".join(rng.choices(WORDS, k=rng.randint(3, 15)))})
+        messages.append({"role": "assistant", "content": " ".join(rng.choices(WORDS, k=rng.randint(10, 60)))})
+    return messages
+
+# Each layout builds its copy of a conversation from fresh strings, as if they came off the wire
+def legacy(messages):
+    return [{"role": m["role"], "content": "".join(m["content"])} for m in messages]
+
+def compact(messages):
+    return ConversationRecord.from_messages(legacy(messages))
+
+def packed(messages):
+    record = compact(messages)
+    record.pack()
+    return record
+
+def measure(build, conversations):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    held = {f"conversation-{i}": build(messages) for i, messages in enumerate(conversations)}
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del held
+    return used
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Conversation memory footprint")
+    parser.add_argument("--sessions", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--turns", type=int, default=8, help="User/assistant exchanges per conversation")
+    args = parser.parse_args()
+
+    for sessions in args.sessions:
+        rng = random.Random(0)
+        conversations = [make_conversation(rng, args.turns) for _ in range(sessions)]
+        print(f"{sessions} sessions, {args.turns * 2} messages each")
+        baseline = None
+        for name, build in (("list of dicts", legacy), ("compact record", compact), ("packed record", packed)):
+            per_session = measure(build, conversations) / sessions
+            baseline = baseline or per_session
+            print(f"  {name:<16} {per_session:>10.0f} bytes/session {per_session / baseline:>7.1%}")
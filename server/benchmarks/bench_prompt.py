@@ -0,0 +1,46 @@
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import promptUtils
+
+############### USAGE ################
+# Per-request cost of building system prompts:
+#   python benchmarks/bench_prompt.py --requests 50000
+######################################
+
+def bench(name, fn, requests, repeats=5):
+    # Best of several runs, to keep scheduler noise out of the numbers
+    best = float("inf")
+    for _ in range(repeats):
+        started = time.perf_counter()
+        for i in range(requests):
+            fn(i)
+        best = min(best, time.perf_counter() - started)
+    print(f"{name:<40} {best * 1e6 / requests:>8.2f} us/request")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Prompt build microbenchmark")
+    parser.add_argument("--requests", type=int, default=50000)
+    args = parser.parse_args()
+
+    random.seed(0)
+    modes = ["normal", "sarcastic", "zesty"]
+    users = [None] + [{"name": f"user{i}", "age": 20 + i, "gender": "female"} for i in range(50)]
+    # Pre-drawn request settings so the benchmark measures prompt building, not the draws
+    settings = [(random.randint(0, 100), random.choice(modes), random.choice(users)) for _ in range(1000)]
+
+    bench("process_system_prompt", lambda i: promptUtils.process_system_prompt(
+        "why is the sky blue?", settings[i % 1000][0], settings[i % 1000][1], 0, settings[i % 1000][2]
+    ), args.requests)
+    bench("process_cacheable_system_prompt", lambda i: promptUtils.process_cacheable_system_prompt(
+        *settings[i % 1000]
+    ), args.requests)
+    bench("getAngerSubprompt", lambda i: promptUtils.getAngerSubprompt(settings[i % 1000][0]), args.requests)
+    bench("getBotProfileSubprompt", lambda i: promptUtils.getBotProfileSubprompt(settings[i % 1000][1]), args.requests)
+    bench("getUserDataSubprompt", lambda i: promptUtils.getUserDataSubprompt(
+        settings[i % 1000][2], settings[i % 1000][0]
+    ), args.requests)
@@ -0,0 +1,196 @@
+import os
+import json
+import math
+import time
+import random
+import asyncio
+import argparse
+import subprocess
+import httpx
+
+############### USAGE ################
+# Drives /chat with multi-turn conversations and reports throughput and latency, without
+# spending API credits when the server points at the stub upstream:
+#   python stub_upstream.py --port 9000 --latency 0.5 --latency-dist lognormal
+#   ANTHROPIC_API_KEY=stub ANTHROPIC_BASE_URL=http://127.0.0.1:9000 python fast-api.py
+#   python benchmarks/loadtest.py --conversations 200 --turns 4 --concurrency 50
+# Results are written as JSON (benchmarks/results/ by default); pass --compare with an
+# earlier result file to print the change per metric.
+######################################
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+# Turns a user might send in one conversation, in order
+SCRIPTS = [
+    ["hi", "what's the weather like today?", "why are you so grumpy?", "ok fine, tell me a joke"],
+    ["can you help me with my homework?", "it's about photosynthesis", "what do plants need?", "thanks I guess"],
+    ["my name is Sam", "what's my name?", "do you like pizza?", "pineapple on pizza, yes or no?",
+     "you're wrong"],
+    ["recommend a movie", "something less boring", "have you even seen it?"],
+    ["how do I boil an egg?", "how long for soft boiled?", "and hard boiled?", "you're not very nice"],
+]
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = min(len(sorted_values), max(1, math.ceil(p / 100 * len(sorted_values)))) - 1
+    return sorted_values[rank]
+
+def latency_summary(seconds):
+    values = sorted(s * 1000 for s in seconds)
+    if not values:
+        return {}
+    return {
+        "p50": round(percentile(values, 50), 2),
+        "p95": round(percentile(values, 95), 2),
+        "p99": round(percentile(values, 99), 2),
+        "mean": round(sum(values) / len(values), 2),
+        "max": round(values[-1], 2),
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+class LoadTest:
+    def __init__(self, base_url, conversations, turns, concurrency, stream=False, think_time=0.0, seed=0):
+        self.base_url = base_url.rstrip("/")
+        self.conversations = conversations
+        self.turns = turns
+        self.concurrency = concurrency
+        self.stream = stream
+        self.think_time = think_time
+        self.rng = random.Random(seed)
+        self.latencies = []
+        # Time to the first delta (streaming only)
+        self.first_delta = []
+        self.status_counts = {}
+        self.errors = 0
+
+    def record(self, status, latency, ok):
+        self.status_counts[str(status)] = self.status_counts.get(str(status), 0) + 1
+        if ok:
+            self.latencies.append(latency)
+        else:
+            self.errors += 1
+
+    async def send_turn(self, client, body):
+        """One turn; returns the conversation id to continue with"""
+        started = time.perf_counter()
+        try:
+            if self.stream:
+                conversation_id = body.get("conversation_id")
+                first = True
+                async with client.stream("POST", f"{self.base_url}/chat/stream", json=body) as response:
+                    ok = response.status_code == 200
+                    async for line in response.aiter_lines():
+                        if not line.startswith("data:"):
+                            continue
+                        event = json.loads(line[5:])
+                        if event["type"] == "start":
+                            conversation_id = event["conversation_id"]
+                        elif event["type"] == "delta" and first:
+                            self.first_delta.append(time.perf_counter() - started)
+                            first = False
+                        elif event["type"] == "error":
+                            ok = False
+                    self.record(response.status_code, time.perf_counter() - started, ok)
+                    return conversation_id
+
+            response = await client.post(f"{self.base_url}/chat", json=body)
+            ok = response.status_code == 200
+            self.record(response.status_code, time.perf_counter() - started, ok)
+            return response.json().get("conversation_id") if ok else body.get("conversation_id")
+        except httpx.HTTPError as e:
+            self.record(type(e).__name__, time.perf_counter() - started, False)
+            return body.get("conversation_id")
+
+    async def run_conversation(self, client, semaphore):
+        script = self.rng.choice(SCRIPTS)
+        settings = {
+            "anger_level": self.rng.randint(0, 100),
+            "personality_mode": self.rng.choice(["normal", "sarcastic", "zesty"]),
+            "glitch_level": self.rng.choice([0, 0, 0.2, 0.5]),
+        }
+        async with semaphore:
+            conversation_id = None
+            for turn in range(self.turns):
+                body = {"message_content": script[turn % len(script)], "conversation_id": conversation_id, **settings}
+                conversation_id = await self.send_turn(client, body)
+                if self.think_time:
+                    await asyncio.sleep(self.think_time)
+
+    async def run(self):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+        async with httpx.AsyncClient(limits=limits, timeout=120) as client:
+            started = time.perf_counter()
+            await asyncio.gather(*(self.run_conversation(client, semaphore) for _ in range(self.conversations)))
+            duration = time.perf_counter() - started
+
+        requests = len(self.latencies) + self.errors
+        result = {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "config": {
+                "base_url": self.base_url,
+                "conversations": self.conversations,
+                "turns": self.turns,
+                "concurrency": self.concurrency,
+                "stream": self.stream,
+                "think_time": self.think_time,
+            },
+            "requests": requests,
+            "errors": self.errors,
+            "duration_s": round(duration, 3),
+            "requests_per_s": round(requests / duration, 2) if duration else None,
+            "latency_ms": latency_summary(self.latencies),
+            "status_counts": self.status_counts,
+        }
+        if self.stream:
+            result["first_delta_ms"] = latency_summary(self.first_delta)
+        return result
+
+# Change of each headline metric relative to an earlier result
+def compare(previous, current):
+    rows = [("requests_per_s", previous.get("requests_per_s"), current.get("requests_per_s"))]
+    for key in ("p50", "p95", "p99"):
+        rows.append((f"latency_ms.{key}", previous.get("latency_ms", {}).get(key),
+                     current.get("latency_ms", {}).get(key)))
+    print(f"{'metric':<18} {previous.get('commit') or 'previous':>12} {current.get('commit') or 'current':>12} {'change':>8}")
+    for name, before, after in rows:
+        change = f"{(after - before) / before * 100:+.1f}%" if before and after is not None else "n/a"
+        print(f"{name:<18} {before!s:>12} {after!s:>12} {change:>8}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load test for the chat server")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="Chat server base URL")
+    parser.add_argument("--conversations", type=int, default=100)
+    parser.add_argument("--turns", type=int, default=4, help="Turns per conversation")
+    parser.add_argument("--concurrency", type=int, default=20, help="Conversations in progress at once")
+    parser.add_argument("--stream", action="store_true", help="Use /chat/stream and report time to first delta")
+    parser.add_argument("--think-time", type=float, default=0.0, help="Seconds between a reply and the next turn")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Result file (default: benchmarks/results/<timestamp>-<commit>.json)")
+    parser.add_argument("--compare", help="Earlier result file to compare against")
+    args = parser.parse_args()
+
+    result = asyncio.run(LoadTest(args.url, args.conversations, args.turns, args.concurrency,
+                                  args.stream, args.think_time, args.seed).run())
+    print(json.dumps(result, indent=2))
+
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{result['commit'] or 'unknown'}.json")
+    with open(output, "w") as f:
+        json.dump(result, f, indent=2)
+    print(f"Saved results to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), result)
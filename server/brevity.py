@@ -0,0 +1,151 @@
+import math
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+import promptUtils
+
+############### USAGE ################
+# key = reply_policy.key(mode, anger_level)                  one output length distribution per (mode, anger tier)
+# max_tokens, stop = reply_policy.limits(key, requested)     max_tokens / stop_sequences to send upstream
+# reply_policy.observe(key, outcome)                         usage and stop_reason of the finished reply
+# limiter = SentenceLimiter(2); text, done = limiter.feed(delta)   end a stream after two sentences
+######################################
+
+# Every persona is told to answer in 1-2 sentences, so a blank line means the model is
+# starting a second paragraph it wasn't asked for
+STOP_SEQUENCES = ["\n\n"]
+
+SENTENCE_TERMINATORS = ".!?…"
+# Characters that may follow a terminator and still end the sentence
+SENTENCE_CLOSERS = "\"')]*”’»"
+# Words ending in a period that don't end a sentence
+ABBREVIATIONS = {"mr", "mrs", "ms", "dr", "st", "vs", "etc", "e.g", "i.e", "jr", "sr"}
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list"""
+    rank = min(len(sorted_values), max(1, math.ceil(p / 100 * len(sorted_values)))) - 1
+    return sorted_values[rank]
+
+class ReplyLengthPolicy:
+    """
+    Learns how many output tokens replies really use per (mode, anger tier) and caps
+    max_tokens at a high percentile of that (with headroom), never above what the request
+    allowed. Replies cut off by the cap are observed at the cap, which raises the
+    percentile, so a cap that is too tight loosens itself.
+    """
+    def __init__(self, window=500, min_samples=20, percentile=99, headroom=1.25, floor=32,
+                 stop_sequences=STOP_SEQUENCES):
+        """
+        Args:
+            window: Most recent replies kept per (mode, anger tier)
+            min_samples: Replies observed before a key's cap is used
+            percentile: Percentile of observed output tokens the cap is based on
+            headroom: Multiplier on that percentile
+            floor: Smallest cap ever sent
+            stop_sequences: Sent with every request (None or [] to send none)
+        """
+        self.window = window
+        self.min_samples = min_samples
+        self.percentile = percentile
+        self.headroom = headroom
+        self.floor = floor
+        self.stop_sequences = list(stop_sequences or [])
+        # (mode, tier) -> recent output token counts, and the cap computed from them
+        self.samples: Dict[Tuple[str, int], deque] = {}
+        self.caps: Dict[Tuple[str, int], int] = {}
+        self.stats = {
+            "requests": 0,
+            "capped": 0,
+            "tokens_not_reserved": 0,
+            "observed": 0,
+            "truncated": 0,
+            "stop_sequence": 0,
+            "early_stops": 0,
+        }
+
+    def key(self, mode: str, anger_level: int) -> Tuple[str, int]:
+        if mode not in promptUtils.BOT_PROFILES:
+            mode = promptUtils.DEFAULT_MODE
+        return mode, promptUtils.getAngerTier(anger_level or 0)
+
+    def limits(self, key: Tuple[str, int], requested: int) -> Tuple[int, Optional[List[str]]]:
+        """(max_tokens, stop_sequences) for a request that allows up to requested tokens"""
+        self.stats["requests"] += 1
+        max_tokens = requested
+        cap = self.caps.get(key)
+        if cap is not None and cap < requested:
+            max_tokens = cap
+            self.stats["capped"] += 1
+            self.stats["tokens_not_reserved"] += requested - cap
+        return max_tokens, self.stop_sequences or None
+
+    def observe(self, key: Tuple[str, int], outcome: Dict):
+        """Record a finished reply from the provider's outcome (usage and stop_reason)"""
+        stop_reason = outcome.get("stop_reason")
+        if stop_reason == "early_stop":
+            # Cut short by us, so its length says nothing about what the model would write
+            self.stats["early_stops"] += 1
+            return
+        output_tokens = (outcome.get("usage") or {}).get("output_tokens")
+        if output_tokens is None:
+            # Served from the response cache, or the call failed
+            return
+
+        self.stats["observed"] += 1
+        if stop_reason == "max_tokens":
+            self.stats["truncated"] += 1
+        elif stop_reason == "stop_sequence":
+            self.stats["stop_sequence"] += 1
+
+        samples = self.samples.get(key)
+        if samples is None:
+            samples = self.samples[key] = deque(maxlen=self.window)
+        samples.append(output_tokens)
+        # Recomputing on every reply isn't needed; every tenth keeps the cap current
+        if len(samples) >= self.min_samples and (len(samples) < self.window or self.stats["observed"] % 10 == 0):
+            self.caps[key] = max(self.floor, math.ceil(percentile(sorted(samples), self.percentile) * self.headroom))
+
+    def get_stats(self) -> Dict:
+        keys = {}
+        for (mode, tier), samples in sorted(self.samples.items()):
+            values = sorted(samples)
+            keys[f"{mode}/{tier}"] = {
+                "samples": len(values),
+                "p50": percentile(values, 50),
+                "p95": percentile(values, 95),
+                "max_tokens": self.caps.get((mode, tier)),
+            }
+        return {**self.stats, "by_mode_and_tier": keys}
+
+class SentenceLimiter:
+    """
+    Passes streamed text through until it holds max_sentences complete sentences. A sentence
+    is complete once its terminator is followed by whitespace, so the stream stops as the
+    model starts the next one.
+    """
+    def __init__(self, max_sentences=2):
+        self.max_sentences = max_sentences
+        self.sentences = 0
+        # Saw a terminator (and maybe closers) that whitespace would confirm
+        self.after_terminator = False
+        # Current word, to tell abbreviations from sentence ends
+        self.word = ""
+
+    def feed(self, delta: str) -> Tuple[str, bool]:
+        """Returns (part of delta to pass on, whether the reply is complete)"""
+        for i, ch in enumerate(delta):
+            if ch.isspace():
+                if self.after_terminator:
+                    self.sentences += 1
+                    self.after_terminator = False
+                    if self.sentences >= self.max_sentences:
+                        return delta[:i], True
+                self.word = ""
+                continue
+
+            if ch in SENTENCE_TERMINATORS:
+                if not (ch == "." and self.word.lower().strip(SENTENCE_CLOSERS) in ABBREVIATIONS):
+                    self.after_terminator = True
+            elif ch not in SENTENCE_CLOSERS:
+                self.after_terminator = False
+            self.word += ch
+        return delta, False
@@ -0,0 +1,75 @@
+import json
+import time
+import asyncio
+import hashlib
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict
+
+class ResponseCache:
+    """
+    Size-bounded LRU cache with a TTL for upstream generations, keyed by the
+    canonicalized request payload. Concurrent requests for the same key share a
+    single upstream call (single-flight) instead of each going upstream.
+    """
+    def __init__(self, max_entries=1024, ttl_seconds=300.0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        # key -> (expires_at, value), least recently used first
+        self.entries = OrderedDict()
+        # key -> task computing the value
+        self.in_flight = {}
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0, "evictions": 0, "expired": 0}
+
+    @staticmethod
+    def make_key(payload: Dict[str, Any]) -> str:
+        """Stable hash of a payload (key order and whitespace don't matter)"""
+        canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def get(self, key: str):
+        """Cached value or None"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self.entries[key]
+            self.stats["expired"] += 1
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key: str, value):
+        self.entries[key] = (time.monotonic() + self.ttl_seconds, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    async def get_or_compute(self, key: str, compute: Callable[[], Awaitable[Any]]):
+        """Return the cached value for key, joining an in-flight computation or starting one"""
+        value = self.get(key)
+        if value is not None:
+            self.stats["hits"] += 1
+            return value
+
+        task = self.in_flight.get(key)
+        if task is not None:
+            self.stats["coalesced"] += 1
+        else:
+            self.stats["misses"] += 1
+            task = asyncio.ensure_future(self._compute(key, compute))
+            self.in_flight[key] = task
+        # Shielded so one caller going away doesn't cancel the call for everyone else
+        return await asyncio.shield(task)
+
+    async def _compute(self, key: str, compute):
+        try:
+            value = await compute()
+            # Errors are raised to every waiter and never cached
+            self.put(key, value)
+            return value
+        finally:
+            self.in_flight.pop(key, None)
+
+    def get_stats(self) -> Dict[str, int]:
+        return {**self.stats, "size": len(self.entries), "in_flight": len(self.in_flight)}
@@ -1,20 +1,50 @@
 import requests
+from requests.adapters import HTTPAdapter
+import httpx
 import json
-from typing import Dict, Optional
+import asyncio
+from typing import AsyncIterator, Dict, Iterator, List, Optional
 import promptUtils
 
 class ChatClient:
     """Client for interacting with the Chat API"""
 
-    def __init__(self, base_url: str = None):
-        """Base URL for the API (default: http://localhost:8000) local only"""
+    def __init__(self,
+                 base_url: str = None,
+                 connect_timeout: float = 5.0,
+                 read_timeout: float = 60.0,
+                 pool_size: int = 10):
+        """
+        Args:
+            base_url: Base URL for the API (default: http://localhost:8000) local only
+            connect_timeout: Seconds to wait for a connection
+            read_timeout: Seconds to wait for (each part of) a response
+            pool_size: Keep-alive connections kept open for reuse
+        """
         self.base_url = base_url or "http://localhost:8000"
         self.chat_url = f"{self.base_url}/chat"
+        self.timeout = (connect_timeout, read_timeout)
+
+        # One session for all calls so connections are reused instead of reopened per request
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def close(self):
+        """Close the pooled connections"""
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
     
     def get_system_prompts(self) -> Dict:
         """Get all available system prompts"""
         try:
-            response = requests.get(f"{self.base_url}/system-prompts")
+            response = self.session.get(f"{self.base_url}/system-prompts", timeout=self.timeout)
             if response.status_code == 200:
                 return response.json()
             else:
@@ -24,6 +54,57 @@ class ChatClient:
             print(f"Error getting system prompts: {e}")
             return {}
     
+    def _build_payload(self,
+                       message: str = None,
+                       conversation_id: str = None,
+                       system_prompt: str = None,
+                       anger_level: int = 0,
+                       personality_mode: str = "normal",
+                       glitch_level: float = 0,
+                       temperature: float = None,
+                       top_p: float = None,
+                       max_new_tokens: int = None,
+                       userData: Dict = None,
+                       user_id: str = None) -> Dict:
+        """Build the request body shared by chat and chat_stream"""
+        # Build payload
+        payload = {}
+        
+        # Only add message_content if it's provided
+        if message:
+            payload["message_content"] = message
+        
+        if conversation_id:
+            payload["conversation_id"] = conversation_id
+        
+        if system_prompt:
+            payload["system_prompt"] = system_prompt
+        
+        # Add personality parameters
+        payload["anger_level"] = anger_level
+        payload["personality_mode"] = personality_mode
+        payload["glitch_level"] = glitch_level
+        # No need to set use_prompt_utils since it's always True on the server
+        
+        # Add performance parameters if provided
+        if temperature is not None:
+            payload["temperature"] = min(max(temperature, 0.0), 1.0)
+        
+        if top_p is not None:
+            payload["top_p"] = min(max(top_p, 0.0), 1.0)
+        
+        if max_new_tokens is not None:
+            payload["max_new_tokens"] = max(min(max_new_tokens, 1000), 1)
+        
+        # Add user data if provided
+        if userData is not None:
+            payload["userData"] = userData
+        
+        if user_id:
+            payload["user_id"] = user_id
+        
+        return payload
+
     def chat(self, 
              message: str = None,
              conversation_id: str = None, 
@@ -37,7 +118,8 @@ class ChatClient:
              top_p: float = None,
              max_new_tokens: int = None, 
              # User data
-             userData: Dict = None) -> Dict:
+             userData: Dict = None,
+             user_id: str = None) -> Dict:
         """
         Send a chat message to the API and get a response.
         
@@ -61,43 +143,18 @@ class ChatClient:
                 - name: User's name
                 - age: User's age
                 - gender: User's gender
+              The server remembers it for the conversation, so later turns can leave it out
+            user_id: Optional id to remember userData under across conversations
         """
-        # Build payload
-        payload = {}
-        
-        # Only add message_content if it's provided
-        if message:
-            payload["message_content"] = message
-        
-        if conversation_id:
-            payload["conversation_id"] = conversation_id
-        
-        if system_prompt:
-            payload["system_prompt"] = system_prompt
-        
-        # Add personality parameters
-        payload["anger_level"] = anger_level
-        payload["personality_mode"] = personality_mode
-        payload["glitch_level"] = glitch_level
-        # No need to set use_prompt_utils since it's always True on the server
-        
-        # Add performance parameters if provided
-        if temperature is not None:
-            payload["temperature"] = min(max(temperature, 0.0), 1.0)
-        
-        if top_p is not None:
-            payload["top_p"] = min(max(top_p, 0.0), 1.0)
-        
-        if max_new_tokens is not None:
-            payload["max_new_tokens"] = max(min(max_new_tokens, 1000), 1)
-        
-        # Add user data if provided
-        if userData is not None:
-            payload["userData"] = userData
+        payload = self._build_payload(
+            message, conversation_id, system_prompt,
+            anger_level, personality_mode, glitch_level,
+            temperature, top_p, max_new_tokens, userData, user_id
+        )
         
         try:
             # Make the API call
-            response = requests.post(self.chat_url, json=payload)
+            response = self.session.post(self.chat_url, json=payload, timeout=self.timeout)
             
             # Process response
             if response.status_code == 200:
@@ -118,11 +175,141 @@ class ChatClient:
             print(error_msg)
             return {"error": error_msg}
     
-    # Get all conversations from the server
-    def get_conversations(self) -> Dict:
-        """Get all stored conversations from the server"""
+    def chat_stream(self, message: str = None, **kwargs) -> Iterator[Dict]:
+        """
+        Stream a chat reply from /chat/stream.
+        Takes the same arguments as chat() and yields event dictionaries with a "type" of
+        "start" (has conversation_id), "delta" (has the next piece of text),
+        "done" (has the full response) or "error".
+        """
+        payload = self._build_payload(message, **kwargs)
+        
+        try:
+            with self.session.post(f"{self.chat_url}/stream", json=payload, stream=True, timeout=self.timeout) as response:
+                if response.status_code != 200:
+                    error_msg = f"Request failed with status code {response.status_code}"
+                    print(f"Error: {error_msg}")
+                    yield {"type": "error", "error": error_msg}
+                    return
+                
+                # userData-only requests are answered with a plain JSON body
+                if not response.headers.get("content-type", "").startswith("text/event-stream"):
+                    yield {"type": "done", **response.json()}
+                    return
+                
+                for line in response.iter_lines(decode_unicode=True):
+                    if line and line.startswith("data:"):
+                        yield json.loads(line[5:].strip())
+                        
+        except Exception as e:
+            error_msg = f"Exception during API call: {str(e)}"
+            print(error_msg)
+            yield {"type": "error", "error": error_msg}
+    
+    # Run many chat turns through /chat/batch
+    def chat_batch(self, items: List[Dict], concurrency: int = None) -> Iterator[Dict]:
+        """
+        Args:
+            items: One dictionary of chat() keyword arguments per turn
+            concurrency: Max items the server processes at once
+        
+        Yields one result per item as it completes (not in input order); each has the
+        item's "index" plus the usual chat() fields, or "error".
+        """
+        payload = {"items": [self._build_payload(**item) for item in items], "mode": "stream"}
+        if concurrency:
+            payload["concurrency"] = concurrency
+        try:
+            with self.session.post(f"{self.chat_url}/batch", json=payload, stream=True, timeout=self.timeout) as response:
+                if response.status_code != 200:
+                    print(f"Error {response.status_code}: {response.text}")
+                    return
+                for line in response.iter_lines(decode_unicode=True):
+                    if line:
+                        yield json.loads(line)
+        except Exception as e:
+            print(f"Exception during API call: {str(e)}")
+    
+    # Submit chat turns to the Message Batches API through the server
+    def submit_batch(self, items: List[Dict]) -> Dict:
+        """Returns batch_id, processing_status and count; poll get_batch() for results"""
+        payload = {"items": [self._build_payload(**item) for item in items], "mode": "batch_api"}
+        try:
+            response = self.session.post(f"{self.chat_url}/batch", json=payload, timeout=self.timeout)
+            if response.status_code == 200:
+                return response.json()
+            print(f"Error {response.status_code}: {response.text}")
+            return {"error": f"Request failed with status code {response.status_code}"}
+        except Exception as e:
+            error_msg = f"Exception during API call: {str(e)}"
+            print(error_msg)
+            return {"error": error_msg}
+    
+    def get_batch(self, batch_id: str) -> Dict:
+        """
+        Status of a submitted batch. Once processing_status is "ended" the dictionary
+        also has "results": one {"index", "response"} (or "error") entry per item.
+        """
+        try:
+            response = self.session.get(f"{self.chat_url}/batch/{batch_id}", timeout=self.timeout)
+            if response.status_code != 200:
+                print(f"Error {response.status_code}: {response.text}")
+                return {"error": f"Request failed with status code {response.status_code}"}
+            if response.headers.get("content-type", "").startswith("application/x-ndjson"):
+                results = [json.loads(line) for line in response.text.splitlines() if line]
+                return {"batch_id": batch_id, "processing_status": "ended", "results": results}
+            return response.json()
+        except Exception as e:
+            error_msg = f"Exception during API call: {str(e)}"
+            print(error_msg)
+            return {"error": error_msg}
+    
+    # Get one page of conversations from the server
+    def get_conversations(self, cursor: str = None, limit: int = 100, summary: bool = False) -> Dict:
+        """
+        Get a page of stored conversations from the server.
+        Pass the returned next_cursor to get the following page (None on the last page).
+        With summary=True only ids, message counts and last activity times are returned.
+        """
+        params = {"limit": limit, "summary": str(summary).lower()}
+        if cursor:
+            params["cursor"] = cursor
+        try:
+            response = self.session.get(f"{self.base_url}/conversations", params=params, timeout=self.timeout)
+            if response.status_code == 200:
+                return response.json()
+            else:
+                print(f"Error {response.status_code}: {response.text}")
+                return {"error": f"Request failed with status code {response.status_code}"}
+        except Exception as e:
+            error_msg = f"Exception during API call: {str(e)}"
+            print(error_msg)
+            return {"error": error_msg}
+    
+    # Iterate over every conversation, following the pagination cursors
+    def iter_conversations(self, summary: bool = False, page_size: int = 100) -> Iterator:
+        """
+        Yield conversations one at a time: (conversation_id, messages) tuples,
+        or summary dictionaries when summary=True
+        """
+        cursor = None
+        while True:
+            page = self.get_conversations(cursor=cursor, limit=page_size, summary=summary)
+            if "error" in page:
+                return
+            if summary:
+                yield from page["conversations"]
+            else:
+                yield from page["conversations"].items()
+            cursor = page.get("next_cursor")
+            if not cursor:
+                return
+    
+    # Get a single conversation
+    def get_conversation(self, conversation_id: str) -> Dict:
+        """Get one conversation with its messages, message count and last activity time"""
         try:
-            response = requests.get(f"{self.base_url}/conversations")
+            response = self.session.get(f"{self.base_url}/conversations/{conversation_id}", timeout=self.timeout)
             if response.status_code == 200:
                 return response.json()
             else:
@@ -133,11 +320,25 @@ class ChatClient:
             print(error_msg)
             return {"error": error_msg}
     
+    # Stream a full dump of all conversations
+    def export_conversations(self) -> Iterator[Dict]:
+        """Yield {"conversation_id", "messages"} dictionaries from the streamed NDJSON export"""
+        try:
+            with self.session.get(f"{self.base_url}/conversations/export", stream=True, timeout=self.timeout) as response:
+                if response.status_code != 200:
+                    print(f"Error {response.status_code}: {response.text}")
+                    return
+                for line in response.iter_lines(decode_unicode=True):
+                    if line:
+                        yield json.loads(line)
+        except Exception as e:
+            print(f"Exception during API call: {str(e)}")
+    
     # Clean up old conversations
     def cleanup_conversations(self, max_age_hours: int = 24) -> Dict:
         """Clean up conversations older than specified hours"""
         try:
-            response = requests.post(f"{self.base_url}/cleanup", json={"max_age_hours": max_age_hours})
+            response = self.session.post(f"{self.base_url}/cleanup", json={"max_age_hours": max_age_hours}, timeout=self.timeout)
             if response.status_code == 200:
                 return response.json()
             else:
@@ -146,4 +347,199 @@ class ChatClient:
         except Exception as e:
             error_msg = f"Exception during API call: {str(e)}"
             print(error_msg)
-            return {"error": error_msg}
\ No newline at end of file
+            return {"error": error_msg}
+
+
+class AsyncChatClient:
+    """
+    asyncio client for the Chat API with the same methods as ChatClient (as coroutines
+    and async iterators). Connections are pooled and kept alive across calls, so many
+    concurrent conversations can share one client.
+    """
+
+    def __init__(self,
+                 base_url: str = None,
+                 connect_timeout: float = 5.0,
+                 read_timeout: float = 60.0,
+                 pool_size: int = 100):
+        """
+        Args:
+            base_url: Base URL for the API (default: http://localhost:8000)
+            connect_timeout: Seconds to wait for a connection
+            read_timeout: Seconds to wait for (each part of) a response
+            pool_size: Max open connections (and kept-alive ones)
+        """
+        self.base_url = base_url or "http://localhost:8000"
+        self.chat_url = f"{self.base_url}/chat"
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        )
+
+    # Same request body as the sync client
+    _build_payload = ChatClient._build_payload
+
+    async def close(self):
+        """Close the pooled connections"""
+        await self.client.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def _request_json(self, method: str, url: str, **kwargs) -> Dict:
+        """JSON body of a successful call, or {"error": ...}"""
+        try:
+            response = await self.client.request(method, url, **kwargs)
+            if response.status_code == 200:
+                return response.json()
+            print(f"Error {response.status_code}: {response.text}")
+            return {"error": f"Request failed with status code {response.status_code}"}
+        except Exception as e:
+            error_msg = f"Exception during API call: {str(e)}"
+            print(error_msg)
+            return {"error": error_msg}
+
+    async def _stream_lines(self, method: str, url: str, **kwargs) -> AsyncIterator[str]:
+        """Non-empty lines of a streamed response (nothing on errors, which are printed)"""
+        try:
+            async with self.client.stream(method, url, **kwargs) as response:
+                if response.status_code != 200:
+                    print(f"Error {response.status_code}: {(await response.aread()).decode(errors='replace')}")
+                    return
+                async for line in response.aiter_lines():
+                    if line:
+                        yield line
+        except Exception as e:
+            print(f"Exception during API call: {str(e)}")
+
+    async def get_system_prompts(self) -> Dict:
+        """Get all available system prompts"""
+        result = await self._request_json("GET", f"{self.base_url}/system-prompts")
+        return {} if "error" in result else result
+
+    async def chat(self, message: str = None, **kwargs) -> Dict:
+        """Send a chat message and get the reply; same arguments and result as ChatClient.chat"""
+        return await self._request_json("POST", self.chat_url, json=self._build_payload(message, **kwargs))
+
+    async def chat_stream(self, message: str = None, **kwargs) -> AsyncIterator[Dict]:
+        """Stream a reply from /chat/stream; yields the same events as ChatClient.chat_stream"""
+        payload = self._build_payload(message, **kwargs)
+        try:
+            async with self.client.stream("POST", f"{self.chat_url}/stream", json=payload) as response:
+                if response.status_code != 200:
+                    error_msg = f"Request failed with status code {response.status_code}"
+                    print(f"Error: {error_msg}")
+                    yield {"type": "error", "error": error_msg}
+                    return
+
+                # userData-only requests are answered with a plain JSON body
+                if not response.headers.get("content-type", "").startswith("text/event-stream"):
+                    yield {"type": "done", **json.loads(await response.aread())}
+                    return
+
+                async for line in response.aiter_lines():
+                    if line.startswith("data:"):
+                        yield json.loads(line[5:].strip())
+        except Exception as e:
+            error_msg = f"Exception during API call: {str(e)}"
+            print(error_msg)
+            yield {"type": "error", "error": error_msg}
+
+    async def chat_batch(self, items: List[Dict], concurrency: int = None) -> AsyncIterator[Dict]:
+        """Run many chat turns through /chat/batch; yields results as they complete"""
+        payload = {"items": [self._build_payload(**item) for item in items], "mode": "stream"}
+        if concurrency:
+            payload["concurrency"] = concurrency
+        async for line in self._stream_lines("POST", f"{self.chat_url}/batch", json=payload):
+            yield json.loads(line)
+
+    async def submit_batch(self, items: List[Dict]) -> Dict:
+        """Submit chat turns to the Message Batches API; poll get_batch() for results"""
+        payload = {"items": [self._build_payload(**item) for item in items], "mode": "batch_api"}
+        return await self._request_json("POST", f"{self.chat_url}/batch", json=payload)
+
+    async def get_batch(self, batch_id: str) -> Dict:
+        """Status of a submitted batch, with "results" once it has ended"""
+        try:
+            response = await self.client.get(f"{self.chat_url}/batch/{batch_id}")
+            if response.status_code != 200:
+                print(f"Error {response.status_code}: {response.text}")
+                return {"error": f"Request failed with status code {response.status_code}"}
+            if response.headers.get("content-type", "").startswith("application/x-ndjson"):
+                results = [json.loads(line) for line in response.text.splitlines() if line]
+                return {"batch_id": batch_id, "processing_status": "ended", "results": results}
+            return response.json()
+        except Exception as e:
+            error_msg = f"Exception during API call: {str(e)}"
+            print(error_msg)
+            return {"error": error_msg}
+
+    async def get_conversations(self, cursor: str = None, limit: int = 100, summary: bool = False) -> Dict:
+        """Get one page of stored conversations (see ChatClient.get_conversations)"""
+        params = {"limit": limit, "summary": str(summary).lower()}
+        if cursor:
+            params["cursor"] = cursor
+        return await self._request_json("GET", f"{self.base_url}/conversations", params=params)
+
+    async def iter_conversations(self, summary: bool = False, page_size: int = 100) -> AsyncIterator:
+        """Yield every conversation, following the pagination cursors"""
+        cursor = None
+        while True:
+            page = await self.get_conversations(cursor=cursor, limit=page_size, summary=summary)
+            if "error" in page:
+                return
+            for conversation in (page["conversations"] if summary else page["conversations"].items()):
+                yield conversation
+            cursor = page.get("next_cursor")
+            if not cursor:
+                return
+
+    async def get_conversation(self, conversation_id: str) -> Dict:
+        """Get one conversation with its messages, message count and last activity time"""
+        return await self._request_json("GET", f"{self.base_url}/conversations/{conversation_id}")
+
+    async def export_conversations(self) -> AsyncIterator[Dict]:
+        """Yield {"conversation_id", "messages"} dictionaries from the streamed NDJSON export"""
+        async for line in self._stream_lines("GET", f"{self.base_url}/conversations/export"):
+            yield json.loads(line)
+
+    async def cleanup_conversations(self, max_age_hours: int = 24) -> Dict:
+        """Clean up conversations older than specified hours"""
+        return await self._request_json("POST", f"{self.base_url}/cleanup", json={"max_age_hours": max_age_hours})
+
+    async def run_conversation(self, turns: List[Dict]) -> List[Dict]:
+        """
+        Send the turns of one conversation in order, carrying the conversation_id forward.
+
+        Args:
+            turns: One dictionary of chat() keyword arguments per turn (message, anger_level, ...)
+
+        Returns one chat() result per turn; stops after the first error.
+        """
+        results = []
+        conversation_id = None
+        for turn in turns:
+            turn = dict(turn)
+            turn.setdefault("conversation_id", conversation_id)
+            result = await self.chat(**turn)
+            results.append(result)
+            if "error" in result:
+                break
+            conversation_id = result.get("conversation_id")
+        return results
+
+    async def run_conversations(self, conversations: List[List[Dict]], concurrency: int = 10) -> List[List[Dict]]:
+        """
+        Run many conversations at once over the shared connection pool, with at most
+        `concurrency` in progress. Returns the run_conversation() results in input order.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run(turns):
+            async with semaphore:
+                return await self.run_conversation(turns)
+
+        return await asyncio.gather(*(run(turns) for turns in conversations))
@@ -0,0 +1,751 @@
+import os
+import time
+import asyncio
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Tuple, Iterator
+from uuid import uuid4
+from storage import ConversationStore, WriteBehindWriter, VersionConflict
+from history import ConversationRecord
+from snapshot import open_snapshot, write_snapshot
+
+# Rough token estimate (about 4 characters per token plus per-message overhead)
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 4
+
+# Approximate memory held by one stored message besides its text (string header, list slot and role byte)
+MESSAGE_OVERHEAD_BYTES = 60
+
+def estimate_bytes(text: str) -> int:
+    return len(text) + MESSAGE_OVERHEAD_BYTES
+
+class ConversationManager:
+    def __init__(self,
+                 token_budget=None,
+                 window_tokens=None,
+                 summarizer=None,
+                 store: ConversationStore = None,
+                 max_conversations=None,
+                 max_bytes=None,
+                 ttl_hours=None,
+                 flush_interval=None,
+                 flush_batch_size=None,
+                 shared=None,
+                 compress_idle_seconds=None,
+                 snapshot_path=None):
+        """
+        Args:
+            token_budget: Estimated history tokens above which only a window is sent upstream
+                (default: HISTORY_TOKEN_BUDGET or 2000)
+            window_tokens: Estimated tokens of recent turns kept once over budget
+                (default: HISTORY_WINDOW_TOKENS or half the budget)
+            summarizer: Async callable (previous_summary, messages) -> summary text,
+                used in the background to summarize turns that fall out of the window
+            store: Optional persistent backend (see storage.create_store). Without one,
+                everything is kept in process memory
+            max_conversations: Conversations kept in memory; the least recently used are evicted
+                beyond this (default: MAX_CONVERSATIONS or 10000)
+            max_bytes: Approximate bytes of message text kept in memory before LRU eviction
+                (default: MAX_CONVERSATION_BYTES or 256 MB)
+            ttl_hours: Conversations unused for this long are expired by expire()
+                (default: CONVERSATION_TTL_HOURS or 24)
+            flush_interval: Seconds between batched writes to the store
+                (default: STORE_FLUSH_INTERVAL or 1)
+            flush_batch_size: Queued writes that trigger an early flush
+                (default: STORE_FLUSH_BATCH_SIZE or 256)
+            shared: Several worker processes use the same store (default: CONVERSATION_STORE_SHARED).
+                Writes then go straight to the store with optimistic versioning and cached
+                conversations are revalidated against the store version on every access.
+                The async methods (aprocess_message, ...) run those store calls on STORE_THREADS
+                threads (default 4), so contention between workers doesn't stall the event loop
+            compress_idle_seconds: Conversations unused for this long are zlib-compressed in memory
+                and decompressed on their next use (default: COMPRESS_IDLE_SECONDS or 600; 0 disables)
+            snapshot_path: File that in-memory conversations are periodically snapshotted to and
+                lazily restored from after a restart (default: SNAPSHOT_PATH; unset disables).
+                Only used without a store, which persists conversations itself
+        """
+        # Using dictionary for O(1) lookup time: conversation_id -> ConversationRecord, which
+        # holds the messages compactly along with last activity, token estimate, size and version.
+        # Ordered by last use (oldest first), so expiry and LRU eviction pop from the front.
+        # With a store this is a hot cache and evicted conversations stay in the store
+        self.conversations = OrderedDict()
+        # Conversation ids in sorted order for cursor pagination (in-memory mode only;
+        # stores page through their own index)
+        self.sorted_ids = []
+        # Approximate memory held by all cached conversations
+        self.total_bytes = 0
+        # Number of cached conversations currently compressed
+        self.packed_count = 0
+        # Counters of conversations removed by expiry and by each cap
+        self.stats = {"expired": 0, "evicted_count": 0, "evicted_bytes": 0}
+        self.compress_idle_seconds = float(
+            compress_idle_seconds if compress_idle_seconds is not None else os.getenv("COMPRESS_IDLE_SECONDS", 600)
+        )
+
+        self.max_conversations = int(max_conversations or os.getenv("MAX_CONVERSATIONS", 10000))
+        self.max_bytes = int(max_bytes or os.getenv("MAX_CONVERSATION_BYTES", 256 * 1024 * 1024))
+        self.ttl_seconds = float(ttl_hours or os.getenv("CONVERSATION_TTL_HOURS", 24)) * 3600
+        # Rolling summaries: conversation_id -> (number of messages covered, summary text)
+        self.summaries = {}
+
+        self.token_budget = int(token_budget or os.getenv("HISTORY_TOKEN_BUDGET", 2000))
+        self.window_tokens = int(window_tokens or os.getenv("HISTORY_WINDOW_TOKENS", self.token_budget // 2))
+        self.summarizer = summarizer
+
+        # Summaries being produced in the background (one per conversation at a time)
+        self.pending_summaries = set()
+        self.summary_tasks = set()
+
+        # Persistence: writes are queued and applied in batches off the request path,
+        # except in shared mode where every append is a versioned write-through
+        self.store = store
+        self.writer = None
+        if shared is None:
+            shared = os.getenv("CONVERSATION_STORE_SHARED", "0") == "1"
+        self.shared = bool(shared) and store is not None
+        if self.shared and not store.shared:
+            raise ValueError(f"{type(store).__name__} can't be shared between workers; use sqlite or redis")
+        self.store_executor = ThreadPoolExecutor(
+            max_workers=int(os.getenv("STORE_THREADS", 4)), thread_name_prefix="conversation-store"
+        ) if self.shared else None
+        # Stored conversations as of the last acount() (the sweeper refreshes it), so gauges
+        # don't query the store on the event loop
+        self.stored_count = store.count() if store is not None else 0
+        if store is not None and not self.shared:
+            self.writer = WriteBehindWriter(
+                store,
+                flush_interval=float(flush_interval or os.getenv("STORE_FLUSH_INTERVAL", 1)),
+                flush_batch_size=int(flush_batch_size or os.getenv("STORE_FLUSH_BATCH_SIZE", 256))
+            )
+
+        # Warm restart: conversations in the last snapshot stay "cold" in the memory-mapped file
+        # until first used. Only the index is read at startup, so this is fast for any size
+        self.snapshot_path = snapshot_path or os.getenv("SNAPSHOT_PATH")
+        if self.snapshot_path and store is not None:
+            raise ValueError("Snapshots are for the in-memory mode; a store already persists conversations")
+        self.snapshot = open_snapshot(self.snapshot_path) if self.snapshot_path else None
+        entries = self.snapshot.entries if self.snapshot is not None else {}
+        # The snapshot index is sorted by id, so cold conversations can be listed right away
+        self.sorted_ids = list(entries)
+        # conversation_id -> where it is in the snapshot, for conversations not loaded yet.
+        # Oldest activity first, like the hot cache, so expiry only looks at those expiring
+        self.cold = OrderedDict(sorted(entries.items(), key=lambda item: item[1][3]))
+        if self.snapshot is not None:
+            self.snapshot.entries = self.cold
+        # Whether conversations changed since the last snapshot
+        self.snapshot_dirty = False
+        self.snapshot_lock = asyncio.Lock()
+
+    def _get(self, conversation_id: str) -> Optional[ConversationRecord]:
+        """Look a conversation up in the hot cache, loading it from the store on a miss"""
+        record = self.conversations.get(conversation_id)
+        # Another worker may have appended to (or deleted) the conversation since we cached it
+        if record is not None and self.shared and \
+                self.store.version(conversation_id) != record.version:
+            self._forget(conversation_id)
+            record = None
+        if record is not None:
+            if record.packed is not None:
+                self._unpack(record)
+            self._touch(conversation_id)
+            return record
+        if self.store is None:
+            return self._thaw(conversation_id)
+
+        return self._load(conversation_id)
+
+    def _thaw(self, conversation_id: str) -> Optional[ConversationRecord]:
+        """Load a conversation that is still only in the snapshot"""
+        entry = self.cold.pop(conversation_id, None)
+        if entry is None:
+            return None
+        return self._cache(conversation_id, self.snapshot.read(entry))
+
+    def _read_store(self, conversation_id: str) -> Optional[Tuple[List[Dict[str, str]], float, int]]:
+        """
+        store.load() with this conversation's queued writes applied on top, so reads see
+        them without waiting for the writer to flush
+        """
+        # Taken before loading: ops committed in between are recognized by their seq
+        ops = self.writer.pending_ops(conversation_id) if self.writer is not None else []
+        loaded = self.store.load(conversation_id)
+        if not ops:
+            return loaded
+
+        messages, last_activity, _ = loaded if loaded is not None else ([], None, 0)
+        exists = loaded is not None
+        for op in ops:
+            if op[0] == "delete":
+                messages, last_activity, exists = [], None, False
+                continue
+            _, _, seq, role, content, timestamp = op
+            # Lower seqs were already in the store when it was read
+            if seq >= len(messages):
+                messages.append({"role": role, "content": content})
+            last_activity, exists = timestamp, True
+        return (messages, last_activity, len(messages)) if exists else None
+
+    def _load(self, conversation_id: str) -> Optional[ConversationRecord]:
+        return self._cache_loaded(conversation_id, self._read_store(conversation_id))
+
+    def _cache_loaded(self, conversation_id: str, loaded) -> Optional[ConversationRecord]:
+        """Cache the result of a store load (forgetting the conversation if the store doesn't have it)"""
+        if loaded is None:
+            self._forget(conversation_id)
+            return None
+
+        history, _, version = loaded
+        return self._cache(conversation_id, history, version)
+
+    async def _store_call(self, fn, *args):
+        """Run a blocking store call on the store threads (the default executor if not shared)"""
+        return await asyncio.get_running_loop().run_in_executor(self.store_executor, fn, *args)
+
+    async def _aget(self, conversation_id: str) -> Optional[ConversationRecord]:
+        """_get that does its shared-store calls off the event loop"""
+        if not self.shared:
+            return self._get(conversation_id)
+        record = self.conversations.get(conversation_id)
+        if record is not None:
+            version = await self._store_call(self.store.version, conversation_id)
+            # The record may have been replaced or evicted while we waited
+            if self.conversations.get(conversation_id) is record and record.version == version:
+                if record.packed is not None:
+                    self._unpack(record)
+                self._touch(conversation_id)
+                return record
+        return self._cache_loaded(conversation_id, await self._store_call(self.store.load, conversation_id))
+
+    def _cache(self, conversation_id: str, history: List[Dict[str, str]], version: int = 0) -> ConversationRecord:
+        previous = self.conversations.get(conversation_id)
+        if previous is not None:
+            self.total_bytes -= previous.nbytes
+            self.packed_count -= previous.packed is not None
+        elif self.store is None:
+            index = bisect_left(self.sorted_ids, conversation_id)
+            # Conversations thawed from the snapshot are already listed
+            if index == len(self.sorted_ids) or self.sorted_ids[index] != conversation_id:
+                self.sorted_ids.insert(index, conversation_id)
+
+        record = ConversationRecord.from_messages(history)
+        record.last_activity = time.time()
+        record.version = version
+        record.tokens = sum(estimate_tokens(text) for text in record.contents)
+        record.nbytes = sum(estimate_bytes(text) for text in record.contents)
+        self.conversations[conversation_id] = record
+        self.conversations.move_to_end(conversation_id)
+        self.total_bytes += record.nbytes
+        self._enforce_caps()
+        return record
+
+    def _touch(self, conversation_id: str, now: float = None):
+        """Mark a conversation as just used (moves it to the back of the recency order)"""
+        self.conversations[conversation_id].last_activity = now or time.time()
+        self.conversations.move_to_end(conversation_id)
+
+    def _pack(self, record: ConversationRecord):
+        record.pack()
+        self.total_bytes -= record.nbytes
+        record.nbytes = len(record.packed)
+        self.total_bytes += record.nbytes
+        self.packed_count += 1
+
+    def _unpack(self, record: ConversationRecord):
+        record.unpack()
+        self.total_bytes -= record.nbytes
+        record.nbytes = sum(estimate_bytes(text) for text in record.contents)
+        self.total_bytes += record.nbytes
+        self.packed_count -= 1
+
+    def _enforce_caps(self):
+        """Evict least recently used conversations beyond the count and byte caps"""
+        while len(self.conversations) > 1:
+            if len(self.conversations) > self.max_conversations:
+                self.stats["evicted_count"] += 1
+            elif self.total_bytes > self.max_bytes:
+                self.stats["evicted_bytes"] += 1
+            else:
+                break
+            # Without a store this drops the conversation; with one it only leaves the hot cache
+            self._forget(next(iter(self.conversations)))
+
+    def _forget(self, conversation_id: str):
+        """Drop in-memory state for a conversation"""
+        record = self.conversations.pop(conversation_id, None)
+        cold = self.cold.pop(conversation_id, None)
+        if (record is not None or cold is not None) and self.store is None:
+            del self.sorted_ids[bisect_right(self.sorted_ids, conversation_id) - 1]
+            self.snapshot_dirty = True
+        if record is not None:
+            self.total_bytes -= record.nbytes
+            self.packed_count -= record.packed is not None
+        self.summaries.pop(conversation_id, None)
+
+    def _append(self, conversation_id: str, role: str, content: str):
+        now = time.time()
+        record = self.conversations[conversation_id]
+        if self.shared:
+            # Optimistic write-through: on a conflict, reload what the other worker wrote and retry
+            while True:
+                try:
+                    record.version = self.store.append(
+                        conversation_id, role, content, now, record.version
+                    )
+                    break
+                except VersionConflict:
+                    record = self._load(conversation_id) or self._cache(conversation_id, [])
+
+        self._record_append(conversation_id, record, role, content, now)
+
+    def _record_append(self, conversation_id: str, record: ConversationRecord, role: str, content: str,
+                       now: float):
+        """Add a message to the cached record (and queue it for a write-behind store)"""
+        if record.packed is not None:
+            self._unpack(record)
+        record.append(role, content)
+        record.tokens += estimate_tokens(content)
+        size = estimate_bytes(content)
+        record.nbytes += size
+        self.total_bytes += size
+        self.snapshot_dirty = True
+
+        # Update last activity timestamp
+        self._touch(conversation_id, now)
+        if self.writer is not None:
+            self.writer.add(("append", conversation_id, len(record) - 1, role, content, now))
+        self._enforce_caps()
+
+    async def _aappend(self, conversation_id: str, role: str, content: str):
+        """_append that does its shared-store calls off the event loop"""
+        if not self.shared:
+            return self._append(conversation_id, role, content)
+        now = time.time()
+        record = self.conversations.get(conversation_id)
+        version = record.version if record is not None else 0
+        while True:
+            try:
+                version = await self._store_call(self.store.append, conversation_id, role, content, now, version)
+                break
+            except VersionConflict:
+                loaded = await self._store_call(self.store.load, conversation_id)
+                version = (self._cache_loaded(conversation_id, loaded) or self._cache(conversation_id, [])).version
+
+        record = self.conversations.get(conversation_id)
+        if record is None or record.version != version - 1:
+            # Evicted or reloaded while we were writing: the store's copy has this message
+            self._cache_loaded(conversation_id, await self._store_call(self.store.load, conversation_id))
+            return
+        record.version = version
+        self._record_append(conversation_id, record, role, content, now)
+
+    def _delete(self, conversation_id: str):
+        self._forget(conversation_id)
+        if self.writer is not None:
+            self.writer.add(("delete", conversation_id))
+        elif self.store is not None:
+            self.store.write([("delete", conversation_id)])
+
+    def process_message(self, message_content: str, conversation_id: str = None) -> Dict[str, Any]:
+        # Create a new conversation list if it doesn't exist
+        if not conversation_id:
+            conversation_id = str(uuid4())
+            self._cache(conversation_id, [])
+        elif self._get(conversation_id) is None:
+            self._cache(conversation_id, [])
+
+        # Add user message directly to history (no system prompt in history)
+        self._append(conversation_id, "user", message_content)
+
+        return {
+            "conversation_id": conversation_id
+        }
+
+    async def aprocess_message(self, message_content: str, conversation_id: str = None) -> Dict[str, Any]:
+        """process_message without blocking the event loop on a shared store"""
+        if not conversation_id:
+            conversation_id = str(uuid4())
+            self._cache(conversation_id, [])
+        elif await self._aget(conversation_id) is None:
+            self._cache(conversation_id, [])
+
+        await self._aappend(conversation_id, "user", message_content)
+        return {
+            "conversation_id": conversation_id
+        }
+
+    def get_conversation_history(self, conversation_id: str) -> List[Dict[str, str]]:
+        # Hot cache lookup with default empty list if not found
+        record = self._get(conversation_id)
+        return record.messages() if record is not None else []
+
+    def get_context_window(self, conversation_id: str) -> Tuple[Optional[str], List[Dict[str, str]]]:
+        """
+        Return (summary, recent messages) to send upstream.
+        Under the token budget this is (None, full history). Over it, only the most recent
+        turns that fit in window_tokens are returned together with the latest summary of
+        older turns, and a fresher summary is requested in the background.
+        """
+        return self._context_window(conversation_id, self._get(conversation_id))
+
+    async def aget_context_window(self, conversation_id: str) -> Tuple[Optional[str], List[Dict[str, str]]]:
+        """get_context_window without blocking the event loop on a shared store"""
+        return self._context_window(conversation_id, await self._aget(conversation_id))
+
+    def _context_window(self, conversation_id: str, history: Optional[ConversationRecord]):
+        if history is None:
+            return None, []
+        if history.tokens <= self.token_budget:
+            return None, history.messages()
+
+        start = self._window_start(history, self.window_tokens)
+
+        # Summarize further back than needed so the next few turns don't trigger another summary
+        covered, summary = self.summaries.get(conversation_id, (0, None))
+        if covered < start:
+            self._schedule_summary(conversation_id, self._window_start(history, self.window_tokens // 2))
+
+        return summary, history[start:]
+
+    def _window_start(self, history: ConversationRecord, window_tokens: int) -> int:
+        """Index of the first message of the most recent turns that fit in window_tokens"""
+        texts = history.texts()
+        start = len(texts) - 1
+        used = estimate_tokens(texts[start]) if texts else 0
+        while start > 0:
+            cost = estimate_tokens(texts[start - 1])
+            if used + cost > window_tokens:
+                break
+            used += cost
+            start -= 1
+
+        # The upstream expects the window to begin with a user turn
+        while start < len(texts) - 1 and history.role(start) != "user":
+            start += 1
+        return start
+
+    def _schedule_summary(self, conversation_id: str, upto: int):
+        """Summarize messages [covered:upto] off the request path"""
+        if self.summarizer is None or conversation_id in self.pending_summaries:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+
+        self.pending_summaries.add(conversation_id)
+        task = loop.create_task(self._summarize(conversation_id, upto))
+        self.summary_tasks.add(task)
+        task.add_done_callback(self.summary_tasks.discard)
+
+    async def _summarize(self, conversation_id: str, upto: int):
+        try:
+            covered, previous = self.summaries.get(conversation_id, (0, None))
+            record = self.conversations.get(conversation_id)
+            older = record[covered:upto] if record is not None else []
+            if not older:
+                return
+            summary = await self.summarizer(previous, older)
+            # The conversation may have been cleaned up while we were waiting
+            if summary and conversation_id in self.conversations:
+                self.summaries[conversation_id] = (upto, summary)
+        except Exception as e:
+            print(f"Error summarizing conversation {conversation_id}: {e}")
+        finally:
+            self.pending_summaries.discard(conversation_id)
+
+    def add_assistant_message(self, conversation_id: str, content: str):
+        # Only append if the conversation exists
+        if self._get(conversation_id) is not None:
+            self._append(conversation_id, "assistant", content)
+
+    async def aadd_assistant_message(self, conversation_id: str, content: str):
+        """add_assistant_message without blocking the event loop on a shared store"""
+        if await self._aget(conversation_id) is not None:
+            await self._aappend(conversation_id, "assistant", content)
+
+    def count(self) -> int:
+        """
+        Number of stored conversations. With a store this is the count from the last
+        acount() (at most a sweep interval old); it never reads the store itself
+        """
+        if self.store is None:
+            return len(self.conversations) + len(self.cold)
+        return self.stored_count
+
+    async def acount(self) -> int:
+        """
+        Count stored conversations off the event loop. With a write-behind store this can lag
+        queued writes by up to the flush interval (await flush_store() first for an exact count)
+        """
+        if self.store is None:
+            return self.count()
+        self.stored_count = await self._store_call(self.store.count)
+        return self.stored_count
+
+    async def flush_store(self):
+        """Write queued changes to the store in a thread, so listings read from it are current"""
+        if self.writer is not None:
+            await asyncio.to_thread(self.writer.flush)
+
+    def get_all_conversations(self) -> Dict[str, List[Dict[str, str]]]:
+        """Return all stored conversations (prefer iter_conversations for large stores)"""
+        return dict(self.iter_conversations())
+
+    def list_conversations(self, cursor: str = None, limit: int = 100) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """
+        One page of conversation summaries ordered by id, starting after cursor.
+        Returns (summaries, next_cursor); next_cursor is None on the last page.
+        With a write-behind store, await flush_store() first to include queued writes.
+        """
+        if self.store is None:
+            start = bisect_right(self.sorted_ids, cursor) if cursor else 0
+            page = []
+            for conv_id in self.sorted_ids[start:start + limit]:
+                record = self.conversations.get(conv_id)
+                if record is not None:
+                    page.append((conv_id, len(record), record.last_activity))
+                else:
+                    _, _, count, last_activity = self.cold[conv_id]
+                    page.append((conv_id, count, last_activity))
+        else:
+            page = self.store.list_conversations(cursor, limit)
+
+        summaries = [
+            {"conversation_id": conv_id, "message_count": count, "last_activity": last}
+            for conv_id, count, last in page
+        ]
+        next_cursor = page[-1][0] if len(page) == limit else None
+        return summaries, next_cursor
+
+    def _peek(self, conversation_id: str) -> Optional[Tuple[List[Dict[str, str]], float]]:
+        """
+        Read (messages, last_activity) without counting as use: the recency order is left
+        alone and conversations read from a store are not added to the hot cache
+        """
+        # In shared mode another worker may have appended since we cached it
+        if not self.shared and conversation_id in self.conversations:
+            record = self.conversations[conversation_id]
+            return record.messages(), record.last_activity
+        if self.store is None:
+            entry = self.cold.get(conversation_id)
+            return (self.snapshot.read(entry), entry[3]) if entry is not None else None
+        loaded = self._read_store(conversation_id)
+        return (loaded[0], loaded[1]) if loaded else None
+
+    def get_conversation(self, conversation_id: str) -> Optional[Dict[str, Any]]:
+        """A single conversation with its messages, or None if unknown"""
+        peeked = self._peek(conversation_id)
+        if peeked is None:
+            return None
+        history, last_activity = peeked
+        return {
+            "conversation_id": conversation_id,
+            "messages": history,
+            "message_count": len(history),
+            "last_activity": last_activity
+        }
+
+    def iter_conversations(self, page_size: int = 500) -> Iterator[Tuple[str, List[Dict[str, str]]]]:
+        """Yield (conversation_id, messages) for every conversation, a page at a time"""
+        cursor = None
+        while True:
+            summaries, cursor = self.list_conversations(cursor, page_size)
+            for summary in summaries:
+                peeked = self._peek(summary["conversation_id"])
+                if peeked is not None:
+                    yield summary["conversation_id"], peeked[0]
+            if cursor is None:
+                return
+
+    def get_stats(self) -> Dict[str, int]:
+        """Expiry/eviction counters and current in-memory usage"""
+        return {
+            **self.stats,
+            "in_memory": len(self.conversations),
+            "in_memory_bytes": self.total_bytes,
+            "compressed": self.packed_count,
+            "snapshot_cold": len(self.cold)
+        }
+
+    def expire(self, max_age_seconds: float = None) -> int:
+        """
+        Remove conversations unused for longer than max_age_seconds (default: the TTL).
+        In memory, expired conversations are popped from the front of the recency order,
+        so the cost is proportional to the number expiring, not the number stored.
+        In shared mode only the store's last activity (updated by every worker) counts.
+        Blocks on the store; on the event loop use aexpire().
+        """
+        cutoff = self._expiry_cutoff(max_age_seconds)
+        removed = self._expire_cached(cutoff)
+        if self.store is not None:
+            candidates = self._expire_candidates(self.store.older_than(cutoff))
+            if self.shared:
+                candidates = self.store.delete_idle(candidates, cutoff)
+            removed += self._expire_stored(candidates)
+        self.stats["expired"] += removed
+        return removed
+
+    async def aexpire(self, max_age_seconds: float = None) -> int:
+        """expire() with the store calls run off the event loop"""
+        cutoff = self._expiry_cutoff(max_age_seconds)
+        removed = self._expire_cached(cutoff)
+        if self.store is not None:
+            stale = await self._store_call(self.store.older_than, cutoff)
+            # Filter after the await: conversations may have been used while we waited
+            candidates = self._expire_candidates(stale)
+            if self.shared:
+                candidates = await self._store_call(self.store.delete_idle, candidates, cutoff)
+            removed += self._expire_stored(candidates)
+        self.stats["expired"] += removed
+        return removed
+
+    def _expiry_cutoff(self, max_age_seconds: float = None) -> float:
+        if max_age_seconds is None:
+            max_age_seconds = self.ttl_seconds
+        return time.time() - max_age_seconds
+
+    def _expire_cached(self, cutoff: float) -> int:
+        """Expire in-memory conversations (no store reads; deletes are queued or left to the store)"""
+        removed = 0
+        while self.conversations:
+            oldest = next(iter(self.conversations))
+            if self.conversations[oldest].last_activity >= cutoff:
+                break
+            if self.shared:
+                # Our cached copy may be stale: another worker may have just used it. Only drop
+                # it here and let the store's own last activity decide
+                self._forget(oldest)
+                continue
+            self._delete(oldest)
+            removed += 1
+
+        # Cold conversations are ordered by last activity too
+        while self.cold:
+            oldest, entry = next(iter(self.cold.items()))
+            if entry[3] >= cutoff:
+                break
+            self._delete(oldest)
+            removed += 1
+        return removed
+
+    def _expire_candidates(self, conversation_ids: List[str]) -> List[str]:
+        # Anything still in memory was used after the cutoff, and conversations with queued
+        # writes have activity the store hasn't seen yet
+        busy = self.writer.pending_ids() if self.writer is not None else ()
+        return [conv_id for conv_id in conversation_ids if conv_id not in self.conversations and conv_id not in busy]
+
+    def _expire_stored(self, conversation_ids: List[str]) -> int:
+        """Drop conversations the shared store already deleted, or delete them (single process)"""
+        for conv_id in conversation_ids:
+            if self.shared:
+                self._forget(conv_id)
+            else:
+                self._delete(conv_id)
+        return len(conversation_ids)
+
+    def compress_idle(self, idle_seconds: float = None) -> int:
+        """
+        zlib-compress conversations unused for idle_seconds (default: compress_idle_seconds).
+        They are decompressed on their next use. Returns the number compressed.
+        """
+        if idle_seconds is None:
+            idle_seconds = self.compress_idle_seconds
+        cutoff = time.time() - idle_seconds
+
+        packed = 0
+        # Oldest first, so stop at the first conversation used since the cutoff
+        for record in self.conversations.values():
+            if record.last_activity >= cutoff:
+                break
+            if record.packed is None and len(record):
+                self._pack(record)
+                packed += 1
+        return packed
+
+    def clean_old_conversations(self, max_age_hours=24):
+        """Clean up conversations older than max_age_hours"""
+        return self.expire(max_age_hours * 3600)  # Return number of removed conversations
+
+    async def aclean_old_conversations(self, max_age_hours=24):
+        """clean_old_conversations() with the store calls run off the event loop"""
+        return await self.aexpire(max_age_hours * 3600)
+
+    async def run_sweeper(self, interval_seconds: float = None):
+        """
+        Background task that expires conversations, then compresses idle ones and recounts
+        stored conversations, every interval_seconds (SWEEP_INTERVAL or 60)
+        """
+        interval_seconds = float(interval_seconds or os.getenv("SWEEP_INTERVAL", 60))
+        while True:
+            await asyncio.sleep(interval_seconds)
+            try:
+                await self.aexpire()
+                if self.compress_idle_seconds > 0:
+                    self.compress_idle()
+                await self.acount()
+            except Exception as e:
+                print(f"Error expiring conversations: {e}")
+
+    async def save_snapshot(self, force: bool = False) -> int:
+        """
+        Write every conversation to snapshot_path, skipping the write if nothing changed since
+        the last one unless force is set. Records are copied on the event loop and encoded and
+        written in a thread; cold conversations are copied byte for byte from the old snapshot.
+        Returns the number of conversations written (0 if skipped or disabled).
+        """
+        if not self.snapshot_path or self.store is not None:
+            return 0
+        async with self.snapshot_lock:
+            if not (self.snapshot_dirty or force):
+                return 0
+            self.snapshot_dirty = False
+            records = [(conv_id, record.copy()) for conv_id, record in self.conversations.items()]
+            cold = list(self.cold.items())
+            write = asyncio.ensure_future(
+                asyncio.to_thread(write_snapshot, self.snapshot_path, records, self.snapshot, cold)
+            )
+            try:
+                written = await asyncio.shield(write)
+            except asyncio.CancelledError:
+                # The thread can't be interrupted: let it finish before releasing the lock
+                await write
+                raise
+            except Exception:
+                self.snapshot_dirty = True
+                raise
+
+            # Switch cold conversations over to the new file (conversations thawed or deleted
+            # while it was being written are no longer cold)
+            snapshot = open_snapshot(self.snapshot_path)
+            if snapshot is None:
+                return written
+            self.cold = OrderedDict((conv_id, snapshot.entries[conv_id]) for conv_id in self.cold)
+            snapshot.entries = self.cold
+            previous, self.snapshot = self.snapshot, snapshot
+            if previous is not None:
+                previous.close()
+            return written
+
+    async def run_snapshotter(self, interval_seconds: float = None):
+        """Background task that writes a snapshot every interval_seconds (SNAPSHOT_INTERVAL or 300)"""
+        if not self.snapshot_path or self.store is not None:
+            return
+        interval_seconds = float(interval_seconds or os.getenv("SNAPSHOT_INTERVAL", 300))
+        while True:
+            await asyncio.sleep(interval_seconds)
+            try:
+                await self.save_snapshot()
+            except Exception as e:
+                print(f"Error writing conversation snapshot: {e}")
+
+    def close(self):
+        """Flush pending writes and close the store"""
+        if self.writer is not None:
+            self.writer.close()
+        if self.store_executor is not None:
+            self.store_executor.shutdown()
+        if self.store is not None:
+            self.store.close()
+        if self.snapshot is not None:
+            self.snapshot.close()
@@ -1,100 +1,50 @@
 import os
 import uvicorn
 import time
-import requests
 import json
+import asyncio
+from contextlib import asynccontextmanager
 from pydantic import BaseModel, Field
 from typing import List, Dict, Optional, Any
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
 from uuid import uuid4
 import promptUtils
+import metrics
+from upstream import UpstreamError, UpstreamTimeout, CircuitOpenError
+from providers import create_provider
+from ratelimit import INTERACTIVE, BATCH, BACKGROUND, LANE_NAMES
+from conversations import ConversationManager
+from storage import create_store
+from admission import AdmissionController, ConversationLocks, QueueFullError
+from profiles import ProfileCache
+from brevity import ReplyLengthPolicy, SentenceLimiter
+from contextlib import aclosing
 from dotenv import load_dotenv
 
 load_dotenv()
 
-# Claude API class to replace the local model
-class ClaudeAPI:
-    def __init__(self, api_key=None):
-        """Initialize Claude API client"""
-
-        self.api_key = os.getenv("ANTHROPIC_API_KEY")
-        if not self.api_key:
-            raise ValueError("Claude API key is required. Set ANTHROPIC_API_KEY environment variable or pass as parameter.")
-        
-        self.api_url = "https://api.anthropic.com/v1/messages"
-        self.model = "claude-3-haiku-20240307"  # Can be changed to any Claude model
-    
-    def generate_response(self, 
-                         messages: List[Dict[str, str]], 
-                         temperature=0.3, 
-                         top_p=None, 
-                         max_new_tokens=None):
-        """
-        Generate a response using Claude API
-        
-        Args:
-            messages: List of message dictionaries with role and content
-            temperature: Controls randomness (0.0-1.0)
-            top_p: Not used by Claude API, included for compatibility
-            max_new_tokens: Approximated to max_tokens for Claude
-        """
-        # Extract system prompt
-        system_prompt = ""
-        formatted_messages = []
-        
-        for message in messages:
-            if message["role"] == "system":
-                system_prompt = message["content"]
-            else:
-                formatted_messages.append({
-                    "role": message["role"],
-                    "content": message["content"]
-                })
-        
-        # Create the request payload
-        payload = {
-            "model": self.model,
-            "messages": formatted_messages,
-            "system": system_prompt,
-            "temperature": temperature,
-        }
-        
-        # Add max_tokens if specified (convert from max_new_tokens)
-        if max_new_tokens:
-            payload["max_tokens"] = max_new_tokens
-            
-        # Make the API request
-        headers = {
-            "x-api-key": self.api_key,
-            "anthropic-version": "2023-06-01",
-            "content-type": "application/json"
-        }
-        
-        try:
-            response = requests.post(
-                self.api_url,
-                headers=headers,
-                json=payload
-            )
-            
-            if response.status_code == 200:
-                response_data = response.json()
-                return response_data["content"][0]["text"]
-            else:
-                error_msg = f"Claude API error: {response.status_code} - {response.text}"
-                print(error_msg)
-                return f"Error: {error_msg}"
-                
-        except Exception as e:
-            error_msg = f"Exception during Claude API call: {str(e)}"
-            print(error_msg)
-            return f"Error: {error_msg}"
+# Use byte-stable system prompts with cache_control breakpoints (set PROMPT_CACHING=0 to disable)
+PROMPT_CACHING = os.getenv("PROMPT_CACHING", "1") != "0"
+# Also serve repeated conversation openers from the response cache, not just temperature 0 (CACHE_OPENERS=1)
+CACHE_OPENERS = os.getenv("CACHE_OPENERS", "0") == "1"
+# Add a Server-Timing header with the per-stage breakdown to every response (DEBUG_TIMING=1),
+# or only to requests that send an X-Debug-Timing header
+DEBUG_TIMING = os.getenv("DEBUG_TIMING", "0") == "1"
+# Cap max_tokens from the observed reply lengths per mode and anger tier, and send stop
+# sequences (ADAPTIVE_REPLY_LENGTH=0 sends the request's max_new_tokens as is)
+ADAPTIVE_REPLY_LENGTH = os.getenv("ADAPTIVE_REPLY_LENGTH", "1") != "0"
+# Streamed replies end after this many complete sentences (0 = let the model finish)
+REPLY_MAX_SENTENCES = int(os.getenv("REPLY_MAX_SENTENCES", 2))
+
+
+# Longest conversation id a client may send (ids we generate are 36-character UUIDs)
+MAX_CONVERSATION_ID_LENGTH = int(os.getenv("MAX_CONVERSATION_ID_LENGTH", 128))
 
 class ChatRequest(BaseModel):
     message_content: Optional[str] = None
-    conversation_id: Optional[str] = None
+    conversation_id: Optional[str] = Field(None, max_length=MAX_CONVERSATION_ID_LENGTH)
     system_prompt: Optional[str] = None
     # Personality tuning parameters
     anger_level: Optional[int] = 0
@@ -105,80 +55,86 @@ class ChatRequest(BaseModel):
     temperature: Optional[float] = 0.7
     top_p: Optional[float] = 0.9
     max_new_tokens: Optional[int] = 150
-    # User data for personalization
+    # User data for personalization; once sent, it is remembered for the conversation (or user_id)
     userData: Optional[Dict[str, Any]] = None
+    user_id: Optional[str] = None
+
+class BatchChatRequest(BaseModel):
+    items: List[ChatRequest]
+    # Max items processed at once (capped by BATCH_MAX_CONCURRENCY)
+    concurrency: Optional[int] = None
+    # "stream": run now and stream results; "batch_api": submit to the Message Batches API
+    mode: Optional[str] = "stream"
 
 class ChatResponse(BaseModel):
     response: str
     user_message: str
     conversation_id: str
 
-class ConversationManager:
-    def __init__(self):
-        # Using dictionary for O(1) lookup time
-        self.conversations = {}
-        # Track when conversations were last used for potential cleanup
-        self.last_activity = {}
-        
-    def process_message(self, message_content: str, conversation_id: str = None) -> Dict[str, Any]:
-        if not conversation_id:
-            conversation_id = str(uuid4())
-            
-        # Create a new conversation list if it doesn't exist (faster than checking first)
-        if conversation_id not in self.conversations:
-            self.conversations[conversation_id] = []
-            
-        # Add user message directly to history (no system prompt in history)
-        self.conversations[conversation_id].append({"role": "user", "content": message_content})
-        
-        # Update last activity timestamp
-        self.last_activity[conversation_id] = time.time()
-        
-        return {
-            "conversation_id": conversation_id
-        }
-    
-    def get_conversation_history(self, conversation_id: str) -> List[Dict[str, str]]:
-        # Fast dictionary lookup with default empty list if not found
-        return self.conversations.get(conversation_id, [])
-        
-    def add_assistant_message(self, conversation_id: str, content: str):
-        # Only append if the conversation exists (avoid checks for better performance)
-        if conversation_id in self.conversations:
-            self.conversations[conversation_id].append({"role": "assistant", "content": content})
-            # Update last activity timestamp
-            self.last_activity[conversation_id] = time.time()
-    
-    def get_all_conversations(self) -> Dict[str, List[Dict[str, str]]]:
-        """Return all stored conversations"""
-        return self.conversations
-    
-    def clean_old_conversations(self, max_age_hours=24):
-        """Clean up conversations older than max_age_hours"""
-        current_time = time.time()
-        max_age_seconds = max_age_hours * 3600
-        
-        # Find conversations to remove
-        to_remove = []
-        for conv_id, last_time in self.last_activity.items():
-            if current_time - last_time > max_age_seconds:
-                to_remove.append(conv_id)
-                
-        # Remove old conversations
-        for conv_id in to_remove:
-            if conv_id in self.conversations:
-                del self.conversations[conv_id]
-            if conv_id in self.last_activity:
-                del self.last_activity[conv_id]
-                
-        return len(to_remove)  # Return number of removed conversations
+# Backend that writes the replies: "claude" (default, uses ANTHROPIC_API_KEY) or "local"
+# (a small transformers model on CPU, see local_model.py)
+chat_provider = create_provider(os.getenv("CHAT_PROVIDER", "claude"))
+
+# Summarize turns that have fallen out of the history window (runs in the background)
+async def summarize_history(previous_summary: Optional[str], messages: List[Dict[str, str]]) -> str:
+    # Runs after the request that scheduled it; keep its timings out of that request's breakdown
+    metrics.current_timings.set(None)
+    summary_messages = [
+        {"role": "system", "content": promptUtils.getSummaryPrompt(previous_summary)},
+        {"role": "user", "content": "\n".join(f"{m['role']}: {m['content']}" for m in messages)}
+    ]
+    return await chat_provider.agenerate_response(
+        summary_messages, temperature=0, max_new_tokens=200, priority=BACKGROUND
+    )
+
+# Open the pooled upstream client and background tasks on startup, close them on shutdown
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await chat_provider.start()
+    # Expire idle conversations in the background instead of waiting for /cleanup
+    sweeper = asyncio.create_task(conversation_manager.run_sweeper())
+    # Periodic snapshots of in-memory conversations (when SNAPSHOT_PATH is set)
+    snapshotter = asyncio.create_task(conversation_manager.run_snapshotter())
+    yield
+    sweeper.cancel()
+    snapshotter.cancel()
+    await chat_provider.close()
+    # Final snapshot so the next process starts with every conversation
+    try:
+        await conversation_manager.save_snapshot()
+    except Exception as e:
+        print(f"Error writing final conversation snapshot: {e}")
+    # Flush queued conversation writes to the store
+    conversation_manager.close()
 
 # Initialize FastAPI app and components
-app = FastAPI(title="Chat API")
-conversation_manager = ConversationManager()
+app = FastAPI(title="Chat API", lifespan=lifespan)
+# Conversation storage: "memory" (default), "sqlite" or "log" (append-only file)
+conversation_store = create_store(
+    os.getenv("CONVERSATION_STORE", "memory"),
+    os.getenv("CONVERSATION_STORE_PATH")
+)
+conversation_manager = ConversationManager(summarizer=summarize_history, store=conversation_store)
+
+# Admission control for chat turns: concurrent turns beyond the limit wait in a FIFO queue,
+# and requests beyond the queue are rejected with 429
+admission = AdmissionController(
+    max_concurrent=int(os.getenv("MAX_CONCURRENT_CHATS", 64)),
+    max_queue=int(os.getenv("MAX_QUEUED_CHATS", 256))
+)
+# Turns on one conversation run one at a time; more than this many waiting are rejected with 429
+conversation_locks = ConversationLocks(max_waiters=int(os.getenv("MAX_CONVERSATION_WAITERS", 8)))
+
+# userData remembered per user or conversation, with its personalization clauses prebuilt
+user_profiles = ProfileCache()
 
-# Initialize Claude API client
-claude_api = ClaudeAPI()  # Will use ANTHROPIC_API_KEY from environment variables
+# Observed reply lengths, used to size max_tokens for the brevity-constrained personas
+reply_policy = ReplyLengthPolicy()
+
+# Upper bound on concurrently processed items of one /chat/batch request
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", 16))
+# Settings of batches submitted to the Message Batches API: batch id -> [(anger, mode, glitch)]
+batch_jobs = {}
 
 # Add CORS middleware for frontend compatibility
 app.add_middleware(
@@ -189,105 +145,620 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Time every request and, when asked, return the per-stage breakdown in a Server-Timing header.
+# For streamed responses this covers the time until the headers are sent.
+@app.middleware("http")
+async def instrument_request(request: Request, call_next):
+    timings = metrics.start_request()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    metrics.REQUEST_SECONDS.observe(
+        time.perf_counter() - timings.started,
+        route.path if route else "unmatched",
+        response.status_code
+    )
+    if DEBUG_TIMING or "x-debug-timing" in request.headers:
+        response.headers["Server-Timing"] = timings.server_timing()
+    return response
+
+# Metrics that read state tracked elsewhere, sampled on each scrape
+metrics.register(metrics.CallbackMetric(
+    "angry_chat_chat_turns_in_flight", "Chat turns holding an admission slot", lambda: admission.active))
+metrics.register(metrics.CallbackMetric(
+    "angry_chat_chat_turns_queued", "Chat turns waiting for an admission slot", lambda: len(admission.waiters)))
+metrics.register(metrics.CallbackMetric(
+    "angry_chat_conversations", "Stored conversations (as of the last sweep with a store)",
+    lambda: conversation_manager.count()))
+metrics.register(metrics.CallbackMetric(
+    "angry_chat_conversations_in_memory_bytes", "Approximate size of cached conversations",
+    lambda: conversation_manager.total_bytes))
+metrics.register(metrics.CallbackMetric(
+    "angry_chat_conversation_removals_total", "Conversations removed by expiry or eviction",
+    lambda: {"expired": conversation_manager.stats["expired"], "evicted": conversation_manager.stats["evicted_count"]},
+    kind="counter", labelname="reason"))
+metrics.register(metrics.CallbackMetric(
+    "angry_chat_response_cache_requests_total", "Response cache lookups by outcome",
+    lambda: {outcome: chat_provider.response_cache.stats[outcome] for outcome in ("hits", "misses", "coalesced")}
+    if chat_provider.response_cache else None,
+    kind="counter", labelname="outcome"))
+metrics.register(metrics.CallbackMetric(
+    "angry_chat_upstream_circuit_open", "1 while the upstream circuit breaker is open",
+    lambda: int(chat_provider.circuit.opened_at is not None) if chat_provider.circuit else None))
+metrics.register(metrics.CallbackMetric(
+    "angry_chat_reply_length_events_total",
+    "Replies whose max_tokens was capped, that hit the cap, ended at a stop sequence or were stopped early",
+    lambda: {event: reply_policy.stats[event] for event in ("capped", "truncated", "stop_sequence", "early_stops")},
+    kind="counter", labelname="event"))
+metrics.register(metrics.CallbackMetric(
+    "angry_chat_upstream_hedge_events_total",
+    "Upstream calls seen by hedging, duplicates sent, duplicates that won and hedges refused by the budget",
+    lambda: {event: chat_provider.hedge.stats[event] for event in ("calls", "hedged", "hedge_wins", "budget_exhausted")}
+    if chat_provider.hedge else None,
+    kind="counter", labelname="event"))
+metrics.register(metrics.CallbackMetric(
+    "angry_chat_upstream_hedge_delay_seconds", "Current wait before an upstream call is hedged, by call kind",
+    lambda: dict(chat_provider.hedge.delays) if chat_provider.hedge else None,
+    labelname="kind"))
+metrics.register(metrics.CallbackMetric(
+    "angry_chat_ratelimit_queued", "Upstream calls waiting for rate limit capacity, by priority lane",
+    lambda: {name: len(lane) for name, lane in zip(LANE_NAMES, chat_provider.limiter.lanes)}
+    if chat_provider.limiter else None,
+    labelname="lane"))
+metrics.register(metrics.CallbackMetric(
+    "angry_chat_ratelimit_available", "Rate limit capacity the client believes is left, by limit",
+    lambda: {name: bucket["level"] for name, bucket in chat_provider.limiter.get_stats()["buckets"].items()}
+    if chat_provider.limiter else None,
+    labelname="limit"))
+
+# Build the upstream messages for a chat turn and record the user message
+async def prepare_chat_turn(request: ChatRequest, record: bool = True):
+    """
+    Returns (conversation_id, messages, generation parameters) for a chat request.
+    Shared by /chat, /chat/stream and /chat/batch. With record=False the message is
+    sent with the existing history but not added to the conversation.
+    """
+    message_content = request.message_content
+    conversation_id = request.conversation_id
+
+    # Generate system prompt using promptUtils (always)
+    with metrics.span("prompt"):
+        # userData from the request (remembered for later turns), else the stored profile
+        if request.userData:
+            profile = user_profiles.remember(request.user_id or conversation_id, request.userData)
+            if request.user_id and conversation_id:
+                user_profiles.put(conversation_id, profile)
+        else:
+            profile = user_profiles.lookup(request.user_id, conversation_id)
+
+        if PROMPT_CACHING:
+            # Byte-stable prompt; the user's text only travels in the messages
+            system_prompt = promptUtils.process_cacheable_system_prompt(
+                anger_level=request.anger_level,
+                mode=request.personality_mode,
+                userDataFingerprint=profile.fingerprint if profile else None
+            )
+        else:
+            system_prompt = promptUtils.process_system_prompt(
+                message_content,
+                anger_level=request.anger_level,
+                mode=request.personality_mode,
+                glitch_level=request.glitch_level,
+                userDataContext=profile.fragment(request.anger_level) if profile else None
+            )
+
+    with metrics.span("history"):
+        if record:
+            # Process the message
+            result = await conversation_manager.aprocess_message(message_content, conversation_id)
+            conversation_id = result.get('conversation_id')
+            # A new conversation's profile can only be stored once it has an id
+            if request.userData and not request.user_id and not request.conversation_id:
+                user_profiles.put(conversation_id, profile)
+
+            # Get the recent history window (and a summary of older turns once over the token budget)
+            summary, conversation_history = await conversation_manager.aget_context_window(conversation_id)
+        else:
+            summary, conversation_history = await conversation_manager.aget_context_window(conversation_id) \
+                if conversation_id else (None, [])
+            conversation_history = conversation_history + [{"role": "user", "content": message_content}]
+
+    # Add system prompt to history; the summary goes after the stable prompt so it doesn't break caching
+    messages = [{"role": "system", "content": system_prompt}]
+    if summary:
+        messages.append({"role": "system", "content": promptUtils.getSummaryContext(summary)})
+    messages += conversation_history
+
+    # Set generation parameters from request or use defaults
+    generation_params = {
+        "temperature": request.temperature if request.temperature is not None else 0.7,
+        "top_p": request.top_p if request.top_p is not None else 0.9,
+        "max_new_tokens": request.max_new_tokens or 150,
+        "cache_prompt": PROMPT_CACHING,
+    }
+    if ADAPTIVE_REPLY_LENGTH:
+        # Replies are 1-2 sentences, so don't ask for (and wait on) much more than they really use
+        max_tokens, stop_sequences = reply_policy.limits(
+            reply_policy.key(request.personality_mode, request.anger_level), generation_params["max_new_tokens"]
+        )
+        generation_params.update(max_new_tokens=max_tokens, stop_sequences=stop_sequences)
+
+    return conversation_id, messages, generation_params
+
+# Reply for requests that only carry userData (no message); the profile is stored so
+# later turns of the conversation (or of the user, with user_id) can leave userData out
+def user_data_only_response(request: ChatRequest):
+    conversation_id = request.conversation_id or str(uuid4())
+    user_profiles.remember(conversation_id, request.userData)
+    if request.user_id:
+        user_profiles.remember(request.user_id, request.userData)
+    return JSONResponse({
+        "response": "User data received successfully",
+        "user_message": "",
+        "conversation_id": conversation_id
+    })
+
+# Error reply for a failed upstream call; nothing is added to the conversation history
+def upstream_error_response(error: UpstreamError, request: ChatRequest, conversation_id: str = None):
+    if isinstance(error, CircuitOpenError):
+        status_code = 503
+    elif isinstance(error, UpstreamTimeout):
+        status_code = 504
+    else:
+        status_code = 502
+    headers = {"Retry-After": str(int(error.retry_after + 0.999))} if error.retry_after else None
+    return JSONResponse({
+        "error": str(error),
+        "response": "The AI service is unavailable right now. Please try again shortly.",
+        "user_message": request.message_content or "",
+        "conversation_id": conversation_id
+    }, status_code=status_code, headers=headers)
+
+# Reply when the admission queue is full
+def busy_response(error: QueueFullError, request: ChatRequest):
+    return JSONResponse({
+        "error": str(error),
+        "response": "The server is busy. Please try again shortly.",
+        "user_message": request.message_content or "",
+        "conversation_id": request.conversation_id
+    }, status_code=429, headers={"Retry-After": str(error.retry_after)})
+
 # Main chat endpoint with performance optimizations
 @app.post("/chat", response_model=ChatResponse)
 async def chat_view(request: ChatRequest):
+    # Handle case where only userData is provided (no message)
+    if request.userData and not request.message_content:
+        return user_data_only_response(request)
+
     try:
-        # Extract request parameters
-        message_content = request.message_content
-        conversation_id = request.conversation_id
-        user_data = request.userData
-                    
-        # Handle case where only userData is provided (no message)
-        if user_data and not message_content:
-            return JSONResponse({
-                "response": "User data received successfully",
-                "user_message": "",
-                "conversation_id": conversation_id or str(uuid4())
-            })
-        
-        # Generate system prompt using promptUtils (always)
-        system_prompt = promptUtils.process_system_prompt(
-            message_content,
-            anger_level=request.anger_level,
-            mode=request.personality_mode,
-            glitch_level=request.glitch_level,
-            userData=request.userData
-        )
-        
-        # Process the message
-        result = conversation_manager.process_message(message_content, conversation_id)
-        conversation_id = result.get('conversation_id')
-        
-        # Get conversation history
-        conversation_history = conversation_manager.get_conversation_history(conversation_id)
-        
-        # Add system prompt to history
-        messages = [{"role": "system", "content": system_prompt}] + conversation_history
-        
-        # Set generation parameters from request or use defaults
-        temperature = request.temperature or 0.7
-        top_p = request.top_p or 0.9
-        max_new_tokens = request.max_new_tokens or 150
-        
-        # Get response from Claude API
-        response_from_llm = claude_api.generate_response(
-            messages,
-            temperature=temperature,
-            top_p=top_p,
-            max_new_tokens=max_new_tokens
-        )
-        
-        # Always apply text effects with promptUtils
+        # One turn at a time per conversation so history stays ordered, then bounded concurrency.
+        # The conversation lock comes first so turns queued behind it don't hold global slots
+        queued = time.perf_counter()
+        async with conversation_locks.hold(request.conversation_id), admission.slot():
+            metrics.record_stage("queue", time.perf_counter() - queued)
+            return await run_chat_turn(request)
+    except QueueFullError as e:
+        return busy_response(e, request)
+
+async def run_chat_turn(request: ChatRequest):
+    try:
+        return JSONResponse(await complete_chat_turn(request))
+    except UpstreamError as e:
+        return upstream_error_response(e, request, request.conversation_id)
+    except Exception as e:
+        print(f"Error: {e}")
+        return JSONResponse({
+            "error": str(e),
+            "response": "An error occurred while processing your request.",
+            "user_message": request.message_content or "",
+            "conversation_id": request.conversation_id
+        }, status_code=500)
+
+# One full chat turn: prompt, upstream call, text effects and history update
+# Deterministic turns and (optionally) stateless openers give the same reply for the same
+# payload, so they can be shared; glitching is still applied per request afterwards
+def is_cacheable(messages: List[Dict[str, str]], generation_params: Dict[str, Any]) -> bool:
+    if generation_params["temperature"] == 0:
+        return True
+    return CACHE_OPENERS and sum(1 for m in messages if m["role"] != "system") == 1
+
+async def complete_chat_turn(request: ChatRequest, priority: int = INTERACTIVE) -> Dict[str, Any]:
+    message_content = request.message_content
+    conversation_id, messages, generation_params = await prepare_chat_turn(request)
+    
+    # Get response from Claude API (async so concurrent chats overlap their upstream waits)
+    outcome = {}
+    response_from_llm = await chat_provider.agenerate_response(
+        messages, use_cache=is_cacheable(messages, generation_params), priority=priority, outcome=outcome,
+        **generation_params
+    )
+    if ADAPTIVE_REPLY_LENGTH:
+        reply_policy.observe(reply_policy.key(request.personality_mode, request.anger_level), outcome)
+    
+    # Always apply text effects with promptUtils
+    with metrics.span("postprocess"):
         response_from_llm = promptUtils.process_response(
             response_from_llm,
             anger_level=request.anger_level,
             mode=request.personality_mode,
             glitch_level=request.glitch_level
         )
-        
-        # Store the assistant's response in the conversation history
-        conversation_manager.add_assistant_message(conversation_id, response_from_llm)
-        
-        # Return the response
-        return JSONResponse({
-            "response": response_from_llm,
-            "user_message": message_content,
-            "conversation_id": conversation_id
-        })
-        
+    
+    # Store the assistant's response in the conversation history
+    with metrics.span("history"):
+        await conversation_manager.aadd_assistant_message(conversation_id, response_from_llm)
+    
+    return {
+        "response": response_from_llm,
+        "user_message": message_content,
+        "conversation_id": conversation_id
+    }
+
+# Format one server-sent event
+def sse_event(data: Dict[str, Any]) -> str:
+    return f"data: {json.dumps(data)}\n\n"
+
+# Streaming chat endpoint (server-sent events)
+@app.post("/chat/stream")
+async def chat_stream_view(request: ChatRequest):
+    """
+    Same request body as /chat. Emits `data:` events with a "type" field:
+    "start" (conversation_id), "delta" (processed text), "done" (full response) or "error".
+    """
+    # Handle case where only userData is provided (no message)
+    if request.userData and not request.message_content:
+        return user_data_only_response(request)
+
+    # Shed load before committing to a streamed 200 response
+    if admission.is_full():
+        return busy_response(QueueFullError(admission.retry_after()), request)
+    if conversation_locks.is_full(request.conversation_id):
+        return busy_response(QueueFullError(conversation_locks.retry_after(request.conversation_id)), request)
+
+    async def event_stream():
+        # The slot and conversation lock are held until the stream ends
+        try:
+            queued = time.perf_counter()
+            async with conversation_locks.hold(request.conversation_id), admission.slot():
+                metrics.record_stage("queue", time.perf_counter() - queued)
+                async for event in chat_turn_events(request):
+                    yield sse_event(event)
+        except QueueFullError as e:
+            yield sse_event({"type": "error", "error": str(e), "retry_after": e.retry_after})
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# Events of one streamed chat turn, shared by /chat/stream and /ws/chat
+async def chat_turn_events(request: ChatRequest):
+    try:
+        conversation_id, messages, generation_params = await prepare_chat_turn(request)
     except Exception as e:
         print(f"Error: {e}")
-        return JSONResponse({
-            "error": str(e),
-            "response": "An error occurred while processing your request.",
-            "user_message": request.message_content if hasattr(request, 'message_content') else "",
-            "conversation_id": conversation_id if 'conversation_id' in locals() else None
-        }, status_code=500)
+        yield {"type": "error", "error": str(e), "conversation_id": request.conversation_id}
+        return
+
+    yield {
+        "type": "start",
+        "conversation_id": conversation_id,
+        "user_message": request.message_content
+    }
+
+    # Text effects are applied to each delta as it arrives
+    processor = promptUtils.ResponseStreamProcessor(
+        anger_level=request.anger_level,
+        mode=request.personality_mode,
+        glitch_level=request.glitch_level
+    )
+    # The personas answer in 1-2 sentences; stop reading (and close the upstream stream) after that
+    sentences = SentenceLimiter(REPLY_MAX_SENTENCES) if REPLY_MAX_SENTENCES > 0 else None
+    outcome = {}
+    parts = []
+    started = time.perf_counter()
+
+    try:
+        async with aclosing(chat_provider.astream_response(messages, outcome=outcome, **generation_params)) as stream:
+            async for delta in stream:
+                if not parts:
+                    metrics.record_stage("first_token", time.perf_counter() - started)
+                complete = False
+                if sentences is not None:
+                    delta, complete = sentences.feed(delta)
+                processed = processor.feed(delta)
+                parts.append(processed)
+                if processed:
+                    yield {"type": "delta", "delta": processed}
+                if complete:
+                    outcome["stop_reason"] = "early_stop"
+                    break
+    except Exception as e:
+        print(f"Error: {e}")
+        yield {"type": "error", "error": str(e), "conversation_id": conversation_id}
+        return
+    if ADAPTIVE_REPLY_LENGTH:
+        reply_policy.observe(reply_policy.key(request.personality_mode, request.anger_level), outcome)
+
+    # Only store the reply once the stream has completed
+    response_from_llm = "".join(parts)
+    await conversation_manager.aadd_assistant_message(conversation_id, response_from_llm)
+
+    yield {
+        "type": "done",
+        "response": response_from_llm,
+        "user_message": request.message_content,
+        "conversation_id": conversation_id
+    }
+
+# Session fields a /ws/chat client may set (everything in ChatRequest but the message itself)
+SESSION_FIELDS = set(ChatRequest.model_fields) - {"message_content"}
+
+# WebSocket chat session: parameters are set once, then each frame is just the user's text
+@app.websocket("/ws/chat")
+async def chat_websocket(websocket: WebSocket):
+    """
+    Text frames are user messages. A JSON object with "type": "session" sets or updates the
+    session parameters (any ChatRequest field: anger_level, personality_mode, userData,
+    conversation_id, ...) and is answered with a "session" event; {"type": "message",
+    "content": ...} sends text that would otherwise look like JSON. Each message gets the
+    same "start" / "delta" / "done" / "error" events as /chat/stream. The conversation stays
+    bound to the connection, so later messages continue it.
+    """
+    await websocket.accept()
+    session = ChatRequest()
+
+    try:
+        while True:
+            frame = await websocket.receive_text()
+            control = parse_control_frame(frame)
+
+            if control is None:
+                message_content = frame
+            elif control.get("type") == "session":
+                try:
+                    fields = {key: value for key, value in control.items() if key in SESSION_FIELDS}
+                    session = ChatRequest(**{**session.model_dump(), **fields})
+                except ValueError as e:
+                    await websocket.send_json({"type": "error", "error": str(e)})
+                    continue
+                await websocket.send_json({"type": "session", "conversation_id": session.conversation_id})
+                continue
+            elif control.get("type") == "message":
+                message_content = control.get("content") or ""
+            else:
+                await websocket.send_json({"type": "error", "error": f"Unknown frame type: {control.get('type')}"})
+                continue
+
+            if not message_content:
+                continue
+            request = session.model_copy(update={"message_content": message_content})
+            try:
+                async with conversation_locks.hold(session.conversation_id), admission.slot():
+                    async for event in chat_turn_events(request):
+                        # Later turns continue the conversation this one started
+                        if event["type"] == "start":
+                            session = session.model_copy(update={"conversation_id": event["conversation_id"]})
+                        await websocket.send_json(event)
+            except QueueFullError as e:
+                await websocket.send_json({"type": "error", "error": str(e), "retry_after": e.retry_after})
+    except WebSocketDisconnect:
+        pass
 
-# New endpoint to get all conversations
+# A JSON control object ("type" field) or None for a plain text message
+def parse_control_frame(frame: str) -> Optional[Dict[str, Any]]:
+    if not frame.startswith("{"):
+        return None
+    try:
+        control = json.loads(frame)
+    except ValueError:
+        return None
+    return control if isinstance(control, dict) and "type" in control else None
+
+# Batch chat: run many turns concurrently and stream NDJSON results in completion order
+@app.post("/chat/batch")
+async def chat_batch_view(request: BatchChatRequest):
+    """
+    Each result line carries the item's "index". In "batch_api" mode the items are
+    submitted to the Message Batches API instead and the batch id is returned; fetch
+    results from /chat/batch/{batch_id}. Batch API items are not added to conversations.
+    """
+    if request.mode == "batch_api":
+        if not chat_provider.supports_batches:
+            raise HTTPException(status_code=400, detail="batch_api mode needs the claude chat provider")
+        try:
+            return JSONResponse(await submit_message_batch(request.items))
+        except UpstreamError as e:
+            return JSONResponse({"error": str(e)}, status_code=502)
+    if request.mode != "stream":
+        raise HTTPException(status_code=400, detail=f"Unknown batch mode: {request.mode}")
+
+    concurrency = max(min(request.concurrency or BATCH_MAX_CONCURRENCY, BATCH_MAX_CONCURRENCY), 1)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_item(index: int, item: ChatRequest) -> Dict[str, Any]:
+        # The semaphore already bounds how many items wait on a conversation
+        async with semaphore, conversation_locks.hold(item.conversation_id, shed=False):
+            try:
+                if item.userData and not item.message_content:
+                    result = json.loads(user_data_only_response(item).body)
+                else:
+                    # Behind interactive turns for upstream rate limits
+                    result = await complete_chat_turn(item, priority=BATCH)
+            except Exception as e:
+                result = {"error": str(e), "conversation_id": item.conversation_id}
+        return {"index": index, **result}
+
+    async def lines():
+        tasks = [asyncio.create_task(run_item(i, item)) for i, item in enumerate(request.items)]
+        try:
+            for finished in asyncio.as_completed(tasks):
+                yield json.dumps(await finished) + "\n"
+        finally:
+            # Client went away: don't keep spending upstream calls
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+# Submit chat items to the Message Batches API (for large, latency-insensitive jobs)
+async def submit_message_batch(items: List[ChatRequest]) -> Dict[str, Any]:
+    batch_requests = []
+    for index, item in enumerate(items):
+        _, messages, generation_params = await prepare_chat_turn(item, record=False)
+        params = chat_provider.build_payload(
+            messages,
+            generation_params["temperature"],
+            generation_params["max_new_tokens"],
+            generation_params["cache_prompt"],
+            generation_params.get("stop_sequences")
+        )
+        batch_requests.append({"custom_id": str(index), "params": params})
+
+    batch = await chat_provider.create_message_batch(batch_requests)
+
+    # Text effects are applied when the results are fetched, so remember each item's settings
+    batch_jobs[batch["id"]] = [
+        (item.anger_level, item.personality_mode, item.glitch_level) for item in items
+    ]
+    while len(batch_jobs) > 1000:
+        batch_jobs.pop(next(iter(batch_jobs)))
+
+    return {
+        "batch_id": batch["id"],
+        "processing_status": batch.get("processing_status"),
+        "count": len(items)
+    }
+
+# Status of a submitted batch, or its processed results once it has ended
+@app.get("/chat/batch/{batch_id}")
+async def chat_batch_results(batch_id: str):
+    settings = batch_jobs.get(batch_id)
+    if settings is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    try:
+        batch = await chat_provider.get_message_batch(batch_id)
+        if batch.get("processing_status") != "ended":
+            return JSONResponse({
+                "batch_id": batch_id,
+                "processing_status": batch.get("processing_status"),
+                "request_counts": batch.get("request_counts")
+            })
+        results = await chat_provider.get_message_batch_results(batch_id)
+    except UpstreamError as e:
+        return JSONResponse({"error": str(e)}, status_code=502)
+
+    async def lines():
+        for entry in results:
+            index = int(entry["custom_id"])
+            result = entry.get("result", {})
+            if result.get("type") == "succeeded":
+                anger_level, mode, glitch_level = settings[index]
+                response_text = promptUtils.process_response(
+                    result["message"]["content"][0]["text"],
+                    anger_level=anger_level,
+                    mode=mode,
+                    glitch_level=glitch_level
+                )
+                yield json.dumps({"index": index, "response": response_text}) + "\n"
+            else:
+                yield json.dumps({"index": index, "error": result.get("error") or result.get("type")}) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+# List conversations a page at a time
 @app.get("/conversations")
-async def get_conversations():
-    """Get all stored conversations"""
-    conversations = conversation_manager.get_all_conversations()
+async def get_conversations(cursor: Optional[str] = None, limit: int = 100, summary: bool = False):
+    """
+    Args:
+        cursor: next_cursor from the previous page (omit for the first page)
+        limit: Conversations per page (1-1000)
+        summary: Only return ids, message counts and last activity times
+    """
+    limit = max(min(limit, 1000), 1)
+    await conversation_manager.flush_store()
+    summaries, next_cursor = conversation_manager.list_conversations(cursor, limit)
+    if summary:
+        conversations = summaries
+    else:
+        conversations = {}
+        for item in summaries:
+            conversation = conversation_manager.get_conversation(item["conversation_id"])
+            if conversation is not None:
+                conversations[item["conversation_id"]] = conversation["messages"]
     return JSONResponse({
         "conversations": conversations,
-        "count": len(conversations)
+        "count": len(conversations),
+        "next_cursor": next_cursor
     })
 
+# Full dump as newline-delimited JSON, generated lazily so memory stays flat
+@app.get("/conversations/export")
+async def export_conversations():
+    async def lines():
+        await conversation_manager.flush_store()
+        for conversation_id, messages in conversation_manager.iter_conversations():
+            yield json.dumps({"conversation_id": conversation_id, "messages": messages}) + "\n"
+            # Let other requests run between conversations
+            await asyncio.sleep(0)
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+# Get a single conversation
+@app.get("/conversations/{conversation_id}")
+async def get_conversation(conversation_id: str):
+    conversation = conversation_manager.get_conversation(conversation_id)
+    if conversation is None:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    return JSONResponse(conversation)
+
 # Cleanup endpoint for maintenance
 @app.post("/cleanup")
 async def cleanup_conversations(max_age_hours: int = 24):
     """Clean up conversations older than specified hours"""
-    removed = conversation_manager.clean_old_conversations(max_age_hours)
+    removed = await conversation_manager.aclean_old_conversations(max_age_hours)
+    await conversation_manager.flush_store()
     return JSONResponse({
         "removed": removed,
-        "remaining": len(conversation_manager.conversations)
+        "remaining": await conversation_manager.acount()
     })
 
-def run_server(host='127.0.0.1', port=8000):
-    print(f"Starting Chat API server on {host}:{port}")
-    uvicorn.run(app, host=host, port=port)
+# Prometheus scrape endpoint
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+# Expiry/eviction counters and memory usage of the conversation manager
+@app.get("/stats")
+async def get_stats():
+    return JSONResponse({
+        **conversation_manager.get_stats(),
+        "conversations": await conversation_manager.acount(),
+        "user_profiles": user_profiles.count(),
+        "response_cache": chat_provider.response_cache.get_stats() if chat_provider.response_cache else None,
+        "rate_limiter": chat_provider.limiter.get_stats() if chat_provider.limiter else None,
+        "hedging": chat_provider.hedge.get_stats() if chat_provider.hedge else None,
+        "provider": chat_provider.get_stats(),
+        "reply_length": reply_policy.get_stats()
+    })
+
+def run_server(host='127.0.0.1', port=8000, workers=None):
+    """
+    workers: Number of uvicorn worker processes (default: WORKERS or 1).
+        More than one needs a shared conversation store (CONVERSATION_STORE=sqlite or redis)
+    """
+    workers = int(workers or os.getenv("WORKERS", 1))
+    print(f"Starting Chat API server on {host}:{port} with {workers} worker(s)")
+    if workers == 1:
+        uvicorn.run(app, host=host, port=port)
+        return
+
+    if os.getenv("CONVERSATION_STORE", "memory") == "memory":
+        raise ValueError("Multiple workers need a shared store: set CONVERSATION_STORE to sqlite or redis")
+    # Worker processes re-import this module and pick the shared mode up from the environment
+    os.environ["CONVERSATION_STORE_SHARED"] = "1"
+    uvicorn.run("fast-api:app", host=host, port=port, workers=workers,
+                app_dir=os.path.dirname(os.path.abspath(__file__)))
 
 if __name__ == '__main__':
     run_server()
\ No newline at end of file
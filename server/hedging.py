@@ -0,0 +1,213 @@
+import time
+import asyncio
+from collections import deque
+from typing import AsyncIterator, Awaitable, Callable, Dict, Optional
+from brevity import percentile
+
+############### USAGE ################
+# policy = HedgePolicy(percentile=95, budget=0.05)
+# text = await policy.run("message", lambda outcome: post(payload, outcome), outcome)
+#     a second identical call starts if the first hasn't returned within the delay; first success wins
+# async for delta in policy.stream("stream", lambda outcome: open_stream(outcome), outcome): ...
+#     same, racing on the first delta; the slower stream is closed
+# The delay is the percentile of recent latencies per kind, so about (100 - percentile)% of
+# calls are hedged, and never more than budget (a fraction of all calls).
+######################################
+
+class HedgePolicy:
+    """
+    When to send a duplicate of a slow upstream call. Latencies are tracked per kind
+    ("message" for whole replies, "stream" for time to first delta), and nothing is hedged
+    until a kind has min_samples. Every call earns budget hedge credits (up to burst) and a
+    hedge spends one, which caps the extra load at budget of all calls. Use from one event loop.
+    """
+    def __init__(self, percentile=95, budget=0.05, burst=10, window=1000, min_samples=50,
+                 min_delay=0.05, max_delay=10.0):
+        """
+        Args:
+            percentile: Latency percentile after which a call is hedged
+            budget: Hedges allowed per call, on average
+            burst: Most hedge credits saved up while calls are fast
+            window: Recent latencies kept per kind
+            min_samples: Latencies observed before a kind is hedged
+            min_delay: Shortest delay before hedging (seconds)
+            max_delay: Longest delay before hedging (seconds)
+        """
+        self.percentile = percentile
+        self.budget = budget
+        self.burst = burst
+        self.window = window
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.credits = 0.0
+        self.samples: Dict[str, deque] = {}
+        self.delays: Dict[str, float] = {}
+        self.stats = {
+            "calls": 0,
+            "hedged": 0,
+            "hedge_wins": 0,
+            "budget_exhausted": 0,
+            "losers_cancelled": 0,
+        }
+
+    def delay(self, kind: str) -> Optional[float]:
+        """Seconds to wait before hedging a new call of kind (None: don't hedge it)"""
+        self.stats["calls"] += 1
+        self.credits = min(self.burst, self.credits + self.budget)
+        return self.delays.get(kind)
+
+    def observe(self, kind: str, seconds: float):
+        """Latency of a call that finished (or a loser when it was cancelled)"""
+        samples = self.samples.get(kind)
+        if samples is None:
+            samples = self.samples[kind] = deque(maxlen=self.window)
+        samples.append(seconds)
+        if len(samples) >= self.min_samples and (len(samples) < self.window or len(samples) % 10 == 0):
+            self.delays[kind] = min(self.max_delay, max(self.min_delay, percentile(sorted(samples), self.percentile)))
+
+    def _spend(self) -> bool:
+        if self.credits < 1:
+            self.stats["budget_exhausted"] += 1
+            return False
+        self.credits -= 1
+        self.stats["hedged"] += 1
+        return True
+
+    async def run(self, kind: str, call: Callable[[Dict], Awaitable], outcome: Optional[Dict] = None,
+                  allowed: Callable[[], bool] = lambda: True):
+        """
+        Await call(outcome), hedged with a second call(outcome) if the first is slow and
+        allowed() still says so. The first success wins and is returned (its outcome copied
+        into outcome); the other call is cancelled. If both fail, the first call's error is raised.
+        """
+        delay = self.delay(kind)
+        started = time.monotonic()
+        outcomes = {}
+
+        def launch():
+            racer_outcome = {}
+            task = asyncio.ensure_future(call(racer_outcome))
+            outcomes[task] = racer_outcome
+            return task
+
+        primary = launch()
+        pending = {primary}
+        hedge = None
+        errors = {}
+        try:
+            while pending:
+                timeout = None
+                if hedge is None and delay is not None:
+                    timeout = max(started + delay - time.monotonic(), 0)
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # The primary is slower than the percentile: hedge it if the budget allows
+                    delay = None
+                    if allowed() and self._spend():
+                        hedge = launch()
+                        pending.add(hedge)
+                    continue
+                for task in done:
+                    if task.exception() is not None:
+                        errors[task] = task.exception()
+                        continue
+                    if task is primary or hedge is None:
+                        self.observe(kind, time.monotonic() - started)
+                    elif task is hedge:
+                        self.stats["hedge_wins"] += 1
+                    if outcome is not None:
+                        outcome.update(outcomes[task])
+                    return task.result()
+            raise errors.get(primary) or errors[hedge]
+        finally:
+            for task in pending:
+                task.cancel()
+                if task is primary:
+                    # Lost the race (or the caller went away): it took at least this long
+                    self.observe(kind, time.monotonic() - started)
+            if pending:
+                if hedge is not None:
+                    self.stats["losers_cancelled"] += 1
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    async def stream(self, kind: str, open_stream: Callable[[Dict], AsyncIterator[str]],
+                     outcome: Optional[Dict] = None, allowed: Callable[[], bool] = lambda: True):
+        """
+        Yield the deltas of open_stream(outcome), hedged with a second stream if the first
+        delta is slow. The first stream to produce a delta is kept; the other is closed.
+        """
+        delay = self.delay(kind)
+        started = time.monotonic()
+        streams = {}
+
+        def launch():
+            racer_outcome = {}
+            stream = open_stream(racer_outcome)
+            task = asyncio.ensure_future(stream.__anext__())
+            streams[task] = (stream, racer_outcome)
+            return task
+
+        primary = launch()
+        pending = {primary}
+        hedge = None
+        winner = None
+        errors = {}
+        try:
+            while pending and winner is None:
+                timeout = None
+                if hedge is None and delay is not None:
+                    timeout = max(started + delay - time.monotonic(), 0)
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    delay = None
+                    if allowed() and self._spend():
+                        hedge = launch()
+                        pending.add(hedge)
+                    continue
+                for task in done:
+                    # A stream that ends without a delta is a (blank) reply too
+                    if task.exception() is not None and not isinstance(task.exception(), StopAsyncIteration):
+                        errors[task] = task.exception()
+                    elif winner is None:
+                        winner = task
+            if winner is None:
+                raise errors.get(primary) or errors[hedge]
+        finally:
+            for task in pending:
+                task.cancel()
+                if task is primary:
+                    self.observe(kind, time.monotonic() - started)
+            if pending and hedge is not None:
+                self.stats["losers_cancelled"] += 1
+            for task, (stream, _) in streams.items():
+                if task is not winner:
+                    if task in pending:
+                        await asyncio.gather(task, return_exceptions=True)
+                    await stream.aclose()
+
+        if winner is primary or hedge is None:
+            self.observe(kind, time.monotonic() - started)
+        else:
+            self.stats["hedge_wins"] += 1
+        stream, racer_outcome = streams[winner]
+        try:
+            if winner.exception() is not None:
+                return
+            yield winner.result()
+            async for delta in stream:
+                yield delta
+        finally:
+            await stream.aclose()
+            if outcome is not None:
+                outcome.update(racer_outcome)
+
+    def get_stats(self) -> Dict:
+        hedged = self.stats["hedged"]
+        return {
+            **self.stats,
+            "hedge_rate": round(hedged / self.stats["calls"], 4) if self.stats["calls"] else 0.0,
+            "win_rate": round(self.stats["hedge_wins"] / hedged, 4) if hedged else None,
+            "credits": round(self.credits, 2),
+            "delay_ms": {kind: round(delay * 1000, 1) for kind, delay in sorted(self.delays.items())},
+        }
@@ -0,0 +1,104 @@
+import json
+import zlib
+from typing import Dict, Iterator, List, Optional
+
+############### USAGE ################
+# record = ConversationRecord.from_messages(messages)   compact copy of [{"role", "content"}, ...]
+# record.append(role, content); record.messages()       list of message dicts (built on demand)
+# record[i], record[a:b], len(record), iter(record)      behave like the old list of dicts
+# record.pack() / record.unpack()                       zlib-compress an idle conversation and restore it
+# record.copy()                                         frozen copy, e.g. for writing a snapshot off the event loop
+######################################
+
+# Roles are stored as one byte per message
+ROLES = ("user", "assistant", "system")
+ROLE_CODES = {role: code for code, role in enumerate(ROLES)}
+
+class ConversationRecord:
+    """
+    One conversation's messages plus its bookkeeping, without per-message objects other
+    than the text: roles live in a bytearray and texts in a parallel list. An idle record
+    can be packed into a single zlib blob; reads still work on a packed record (they decode
+    a copy) but append() needs it unpacked first.
+    """
+    __slots__ = ("roles", "contents", "packed", "last_activity", "tokens", "nbytes", "version")
+
+    def __init__(self):
+        self.roles = bytearray()
+        self.contents: Optional[List[str]] = []
+        # zlib-compressed JSON list of the texts while packed (contents is None then)
+        self.packed: Optional[bytes] = None
+        # Bookkeeping kept by ConversationManager
+        self.last_activity = 0.0
+        self.tokens = 0
+        self.nbytes = 0
+        self.version = 0
+
+    @classmethod
+    def from_messages(cls, messages: List[Dict[str, str]]) -> "ConversationRecord":
+        record = cls()
+        record.roles = bytearray(ROLE_CODES[message["role"]] for message in messages)
+        record.contents = [message["content"] for message in messages]
+        return record
+
+    def copy(self) -> "ConversationRecord":
+        """Shallow copy that later appends to this record don't change (texts are shared)"""
+        record = ConversationRecord()
+        record.roles = bytearray(self.roles)
+        record.contents = None if self.contents is None else list(self.contents)
+        record.packed = self.packed
+        record.last_activity = self.last_activity
+        record.tokens = self.tokens
+        record.nbytes = self.nbytes
+        record.version = self.version
+        return record
+
+    def texts(self) -> List[str]:
+        """Message texts in order (decoded, not unpacked, if the record is packed)"""
+        if self.packed is not None:
+            return json.loads(zlib.decompress(self.packed))
+        return self.contents
+
+    def role(self, index: int) -> str:
+        return ROLES[self.roles[index]]
+
+    def content(self, index: int) -> str:
+        return self.texts()[index]
+
+    def messages(self, start: int = 0, stop: Optional[int] = None) -> List[Dict[str, str]]:
+        texts = self.texts()
+        return [
+            {"role": ROLES[code], "content": text}
+            for code, text in zip(self.roles[start:stop], texts[start:stop])
+        ]
+
+    def __len__(self) -> int:
+        return len(self.roles)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            if index.step not in (None, 1):
+                return self.messages()[index]
+            return self.messages(index.start or 0, index.stop)
+        return {"role": self.role(index), "content": self.content(index)}
+
+    def __iter__(self) -> Iterator[Dict[str, str]]:
+        return iter(self.messages())
+
+    def append(self, role: str, content: str):
+        if self.packed is not None:
+            raise RuntimeError("Unpack the conversation before appending to it")
+        self.roles.append(ROLE_CODES[role])
+        self.contents.append(content)
+
+    def pack(self):
+        """Compress the texts into one blob (no-op if already packed)"""
+        if self.packed is None:
+            self.packed = zlib.compress(json.dumps(self.contents, ensure_ascii=False).encode())
+            self.contents = None
+
+    def unpack(self):
+        """Restore the texts of a packed record (no-op if not packed)"""
+        if self.packed is not None:
+            self.contents = json.loads(zlib.decompress(self.packed))
+            self.packed = None
@@ -0,0 +1,309 @@
+import os
+import time
+import queue
+import asyncio
+import threading
+import metrics
+from typing import Dict, List, Optional
+from providers import ChatProvider
+from ratelimit import INTERACTIVE
+from upstream import UpstreamError, UpstreamTimeout
+
+############### USAGE ################
+# CHAT_PROVIDER=local python fast-api.py      serve replies from a small model on CPU
+#   LOCAL_MODEL=HuggingFaceTB/SmolLM2-135M-Instruct (any causal LM with a chat template works)
+# Concurrent requests are collected for up to LOCAL_BATCH_WAIT_MS and generated as one padded
+# batch on a dedicated worker thread. torch and transformers are only imported when the
+# model loads, in that thread, so importing this module and starting the app stay fast.
+######################################
+
+# Marks the end of the queue (close())
+STOP = object()
+
+class GenerationRequest:
+    """One reply waiting for (or in) a batch; the result is delivered to future on loop"""
+    __slots__ = ("messages", "temperature", "top_p", "max_new_tokens", "stop_sequences", "future", "loop",
+                 "queued")
+
+    def __init__(self, messages, temperature, top_p, max_new_tokens, stop_sequences, future, loop):
+        self.messages = messages
+        self.temperature = temperature
+        self.top_p = top_p
+        self.max_new_tokens = max_new_tokens
+        self.stop_sequences = tuple(stop_sequences or ())
+        self.future = future
+        self.loop = loop
+        self.queued = time.perf_counter()
+
+    def batch_key(self):
+        """Requests that can share one generate() call (sampling settings are per batch)"""
+        if not self.temperature:
+            return (False, None, None, self.stop_sequences)
+        return (True, self.temperature, self.top_p, self.stop_sequences)
+
+    def resolve(self, result=None, error: Optional[Exception] = None):
+        def deliver():
+            if self.future.done():
+                return
+            if error is not None:
+                self.future.set_exception(error)
+            else:
+                self.future.set_result(result)
+        self.loop.call_soon_threadsafe(deliver)
+
+class LocalModel(ChatProvider):
+    def __init__(self,
+                 model_name=None,
+                 max_batch_size=None,
+                 batch_wait_ms=None,
+                 max_new_tokens=None,
+                 threads=None,
+                 timeout=None):
+        """
+        Args:
+            model_name: Hugging Face model id or local path (default: LOCAL_MODEL or SmolLM2-135M-Instruct)
+            max_batch_size: Most requests generated together (default: LOCAL_MAX_BATCH_SIZE or 8)
+            batch_wait_ms: How long the first request of a batch waits for others to join
+                (default: LOCAL_BATCH_WAIT_MS or 5)
+            max_new_tokens: Reply length when the request doesn't set one (default: LOCAL_MAX_NEW_TOKENS or 128)
+            threads: torch intra-op threads (default: LOCAL_MODEL_THREADS or torch's own choice)
+            timeout: Seconds a request may wait for its reply, model loading included
+                (default: LOCAL_MODEL_TIMEOUT or 120)
+        """
+        self.model_name = model_name or os.getenv("LOCAL_MODEL", "HuggingFaceTB/SmolLM2-135M-Instruct")
+        self.max_batch_size = int(max_batch_size or os.getenv("LOCAL_MAX_BATCH_SIZE", 8))
+        self.batch_wait = float(batch_wait_ms or os.getenv("LOCAL_BATCH_WAIT_MS", 5)) / 1000
+        self.default_max_new_tokens = int(max_new_tokens or os.getenv("LOCAL_MAX_NEW_TOKENS", 128))
+        self.threads = int(threads or os.getenv("LOCAL_MODEL_THREADS", 0))
+        self.timeout = float(timeout or os.getenv("LOCAL_MODEL_TIMEOUT", 120))
+
+        # Requests from the event loop to the worker thread
+        self.requests = queue.Queue()
+        # Requests taken off the queue that didn't fit the last batch (worker thread only)
+        self.deferred = []
+        self.worker = None
+        # Set once the model is loaded and warmed up (or failed to load)
+        self.ready = threading.Event()
+        self.load_error = None
+        # Set by _load() in the worker thread
+        self.torch = None
+        self.model = None
+        self.tokenizer = None
+        self.stats = {"batches": 0, "requests": 0, "load_seconds": None, "generate_seconds": 0.0}
+
+    async def start(self):
+        """Start the worker thread; it loads the model in the background"""
+        if self.worker is None:
+            self.worker = threading.Thread(target=self._run, name="local-model", daemon=True)
+            self.worker.start()
+
+    async def close(self):
+        if self.worker is not None:
+            self.requests.put(STOP)
+            await asyncio.to_thread(self.worker.join)
+            self.worker = None
+
+    def _load(self):
+        """Load the tokenizer and model, then run one short generation so the first request is fast"""
+        started = time.perf_counter()
+        import torch
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
+        if self.threads:
+            torch.set_num_threads(self.threads)
+        self.torch = torch
+        # Decoder-only models need left padding so every row's prompt ends where generation starts
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_name, padding_side="left")
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.model = AutoModelForCausalLM.from_pretrained(self.model_name, torch_dtype=torch.float32)
+        self.model.eval()
+
+        warm_up = self.tokenizer([self._prompt([{"role": "user", "content": "hi"}])], return_tensors="pt")
+        with torch.inference_mode():
+            self.model.generate(**warm_up, max_new_tokens=1, pad_token_id=self.tokenizer.pad_token_id)
+        self.stats["load_seconds"] = round(time.perf_counter() - started, 2)
+        print(f"Loaded local model {self.model_name} in {self.stats['load_seconds']}s")
+
+    def _prompt(self, messages: List[Dict[str, str]]) -> str:
+        # System messages (prompt, then any history summary) are merged into one at the front
+        system = "\n\n".join(m["content"] for m in messages if m["role"] == "system")
+        turns = [m for m in messages if m["role"] != "system"]
+        if system:
+            turns = [{"role": "system", "content": system}] + turns
+        if self.tokenizer.chat_template:
+            return self.tokenizer.apply_chat_template(turns, tokenize=False, add_generation_prompt=True)
+        return "\n".join(f"{m['role']}: {m['content']}" for m in turns) + "\nassistant:"
+
+    def _run(self):
+        try:
+            self._load()
+        except Exception as e:
+            self.load_error = e
+            print(f"Error loading local model {self.model_name}: {e}")
+        self.ready.set()
+
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            if self.load_error is not None:
+                for request in batch:
+                    request.resolve(error=UpstreamError(f"Local model failed to load: {self.load_error}"))
+                continue
+            self._generate(batch)
+
+    def _next_batch(self) -> Optional[List[GenerationRequest]]:
+        """Next non-empty batch, or None once close() was called and nothing is left"""
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return None
+            # Callers that gave up (timeout or disconnect) don't need a reply
+            batch = [request for request in batch if not request.future.done()]
+            if batch:
+                return batch
+
+    def _collect(self) -> Optional[List[GenerationRequest]]:
+        """Block for the first request, then collect compatible ones for up to batch_wait"""
+        if self.deferred:
+            first = self.deferred.pop(0)
+        else:
+            first = self.requests.get()
+            if first is STOP:
+                return None
+        key = first.batch_key()
+        batch = [first]
+
+        # Deferred requests already waited through a batch; take the compatible ones first
+        for request in list(self.deferred):
+            if len(batch) < self.max_batch_size and request.batch_key() == key:
+                self.deferred.remove(request)
+                batch.append(request)
+
+        deadline = time.perf_counter() + self.batch_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is STOP:
+                # Finish what's queued first
+                self.requests.put(STOP)
+                break
+            if request.batch_key() == key:
+                batch.append(request)
+            else:
+                self.deferred.append(request)
+        return batch
+
+    def _generate(self, batch: List[GenerationRequest]):
+        torch = self.torch
+        started = time.perf_counter()
+        try:
+            inputs = self.tokenizer([self._prompt(r.messages) for r in batch], return_tensors="pt", padding=True)
+            do_sample, temperature, top_p, stop_sequences = batch[0].batch_key()
+            sampling = {"do_sample": True, "temperature": temperature, "top_p": top_p or 1.0} if do_sample \
+                else {"do_sample": False}
+            if stop_sequences:
+                sampling.update(stop_strings=list(stop_sequences), tokenizer=self.tokenizer)
+            with torch.inference_mode():
+                output = self.model.generate(
+                    **inputs,
+                    max_new_tokens=max(r.max_new_tokens for r in batch),
+                    pad_token_id=self.tokenizer.pad_token_id,
+                    **sampling
+                )
+        except Exception as e:
+            for request in batch:
+                request.resolve(error=UpstreamError(f"Local model error: {e}"))
+            return
+
+        prompt_length = inputs["input_ids"].shape[1]
+        input_counts = inputs["attention_mask"].sum(dim=1).tolist()
+        elapsed = time.perf_counter() - started
+        for row, request in enumerate(batch):
+            # Generation ran to the longest request's limit; cut each reply to its own
+            generated = output[row, prompt_length:prompt_length + request.max_new_tokens]
+            output_tokens = int((generated != self.tokenizer.pad_token_id).sum())
+            text = self.tokenizer.decode(generated, skip_special_tokens=True)
+            stop_reason = "max_tokens" if output_tokens >= request.max_new_tokens else "end_turn"
+            # generate() leaves the stop string in the output; cut it off like the API does
+            for stop in request.stop_sequences:
+                if stop in text:
+                    text = text[:text.index(stop)]
+                    stop_reason = "stop_sequence"
+            request.resolve({
+                "text": text.strip(),
+                "stop_reason": stop_reason,
+                "usage": {"input_tokens": int(input_counts[row]), "output_tokens": output_tokens},
+                "queue_seconds": started - request.queued,
+                "generate_seconds": elapsed,
+                "batch_size": len(batch),
+            })
+        self.stats["batches"] += 1
+        self.stats["requests"] += len(batch)
+        self.stats["generate_seconds"] += elapsed
+
+    async def _submit(self, messages, temperature, top_p, max_new_tokens, stop_sequences, outcome) -> Dict:
+        if self.worker is None:
+            await self.start()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.requests.put(GenerationRequest(
+            messages, temperature, top_p, max_new_tokens or self.default_max_new_tokens, stop_sequences, future, loop
+        ))
+        try:
+            result = await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            raise UpstreamTimeout(f"Local model didn't reply within {self.timeout}s")
+        metrics.record_stage("model_queue", result["queue_seconds"])
+        metrics.record_usage(result["usage"])
+        if outcome is not None:
+            outcome.update(usage=result["usage"], stop_reason=result["stop_reason"])
+        return result
+
+    async def agenerate_response(self,
+                                 messages: List[Dict[str, str]],
+                                 temperature=0.3,
+                                 top_p=None,
+                                 max_new_tokens=None,
+                                 cache_prompt=False,
+                                 use_cache=False,
+                                 priority=INTERACTIVE,
+                                 stop_sequences=None,
+                                 outcome=None) -> str:
+        """
+        Generate a reply with the local model. cache_prompt, use_cache and priority are
+        accepted for compatibility with ClaudeAPI and ignored.
+        """
+        with metrics.span("upstream"):
+            result = await self._submit(messages, temperature, top_p, max_new_tokens, stop_sequences, outcome)
+            return result["text"]
+
+    async def astream_response(self,
+                               messages: List[Dict[str, str]],
+                               temperature=0.3,
+                               top_p=None,
+                               max_new_tokens=None,
+                               cache_prompt=False,
+                               priority=INTERACTIVE,
+                               stop_sequences=None,
+                               outcome=None):
+        """Batched generation finishes all at once, so the reply arrives as a single delta"""
+        result = await self._submit(messages, temperature, top_p, max_new_tokens, stop_sequences, outcome)
+        if result["text"]:
+            yield result["text"]
+
+    def get_stats(self) -> Dict:
+        return {
+            "model": self.model_name,
+            "loaded": self.ready.is_set() and self.load_error is None,
+            "queued": self.requests.qsize() + len(self.deferred),
+            **self.stats,
+            "generate_seconds": round(self.stats["generate_seconds"], 3),
+            "avg_batch_size": round(self.stats["requests"] / self.stats["batches"], 2) if self.stats["batches"] else None,
+        }
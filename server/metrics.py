@@ -0,0 +1,188 @@
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Optional
+
+############### USAGE ################
+# with metrics.span("upstream"): ...     time a stage (histogram + the current request's breakdown)
+# metrics.record_usage(usage)            token counts from a Messages API usage block
+# metrics.render()                       Prometheus text format, served at GET /metrics
+# Metrics are per process; with several workers each one reports its own.
+######################################
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+
+def format_labels(labelnames, labelvalues, extra=None):
+    pairs = list(zip(labelnames, labelvalues))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+class Histogram:
+    """Cumulative-bucket histogram, one series per combination of label values"""
+    def __init__(self, name, help, buckets, labelnames=()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.labelnames = tuple(labelnames)
+        # label values -> [per-bucket counts (+Inf last), sum]
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labelvalues)
+            if series is None:
+                series = self.series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            snapshot = [(labels, list(counts), total) for labels, (counts, total) in self.series.items()]
+        for labelvalues, counts, total in snapshot:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                labels = format_labels(self.labelnames, labelvalues, ("le", bound))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.labelnames, labelvalues)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+class Counter:
+    """Monotonic counter, one series per combination of label values"""
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, *labelvalues):
+        with self.lock:
+            self.series[labelvalues] = self.series.get(labelvalues, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            snapshot = list(self.series.items())
+        for labelvalues, value in snapshot:
+            lines.append(f"{self.name}{format_labels(self.labelnames, labelvalues)} {value}")
+        return lines
+
+class CallbackMetric:
+    """
+    Gauge or counter whose value is read when metrics are rendered, for state that
+    is already tracked elsewhere. fn returns a number, or a dict of label value -> number.
+    """
+    def __init__(self, name, help, fn: Callable, kind="gauge", labelname: Optional[str] = None):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.kind = kind
+        self.labelname = labelname
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        try:
+            value = self.fn()
+        except Exception as e:
+            print(f"Error reading metric {self.name}: {e}")
+            return lines
+        if isinstance(value, dict):
+            for labelvalue, item in value.items():
+                lines.append(f"{self.name}{format_labels((self.labelname,), (labelvalue,))} {item}")
+        elif value is not None:
+            lines.append(f"{self.name} {value}")
+        return lines
+
+# Everything rendered by /metrics, in registration order
+registry = []
+
+def register(metric):
+    registry.append(metric)
+    return metric
+
+def render() -> str:
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+STAGE_SECONDS = register(Histogram(
+    "angry_chat_stage_seconds", "Time spent in each stage of a chat turn", LATENCY_BUCKETS, ("stage",)))
+REQUEST_SECONDS = register(Histogram(
+    "angry_chat_http_request_seconds", "Time until the response headers are sent", LATENCY_BUCKETS,
+    ("path", "status")))
+TOKENS = register(Histogram(
+    "angry_chat_upstream_tokens", "Tokens per upstream call, from the Messages API usage field", TOKEN_BUCKETS,
+    ("kind",)))
+TOKENS_TOTAL = register(Counter(
+    "angry_chat_upstream_tokens_total", "Total tokens reported by the Messages API usage field", ("kind",)))
+
+# Usage fields reported by the Messages API -> metric label
+USAGE_FIELDS = {
+    "input_tokens": "input",
+    "output_tokens": "output",
+    "cache_read_input_tokens": "cache_read",
+    "cache_creation_input_tokens": "cache_creation",
+}
+
+class RequestTimings:
+    """Stage durations (seconds) and token usage collected while serving one request"""
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+        self.tokens: Dict[str, int] = {}
+
+    def server_timing(self) -> str:
+        """Server-Timing header value: each stage, the total so far and token counts"""
+        parts = [f"{stage};dur={seconds * 1000:.2f}" for stage, seconds in self.stages.items()]
+        parts.append(f"total;dur={(time.perf_counter() - self.started) * 1000:.2f}")
+        parts += [f'{kind}-tokens;desc="{count}"' for kind, count in self.tokens.items()]
+        return ", ".join(parts)
+
+# Timings of the request being served in the current task (None outside a request)
+current_timings: ContextVar[Optional[RequestTimings]] = ContextVar("current_timings", default=None)
+
+def start_request() -> RequestTimings:
+    timings = RequestTimings()
+    current_timings.set(timings)
+    return timings
+
+def record_stage(stage, seconds):
+    STAGE_SECONDS.observe(seconds, stage)
+    timings = current_timings.get()
+    if timings is not None:
+        timings.stages[stage] = timings.stages.get(stage, 0.0) + seconds
+
+@contextmanager
+def span(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - started)
+
+def record_usage(usage: Optional[Dict]):
+    if not usage:
+        return
+    timings = current_timings.get()
+    for field, kind in USAGE_FIELDS.items():
+        count = usage.get(field)
+        if count is None:
+            continue
+        TOKENS.observe(count, kind)
+        TOKENS_TOTAL.inc(count, kind)
+        if timings is not None:
+            timings.tokens[kind] = timings.tokens.get(kind, 0) + count
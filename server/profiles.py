@@ -0,0 +1,81 @@
+import os
+import time
+from bisect import bisect_right
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+import promptUtils
+
+############### USAGE ################
+# profile = user_profiles.remember(key, userData)   store (or refresh) the profile for a user/conversation
+# profile = user_profiles.lookup(user_id, conversation_id)   stored profile, or None
+# profile.fingerprint / profile.fragment(anger_level)   ready-made inputs for the prompt builders
+# Profiles live in this process only; with several workers, clients should keep sending userData.
+######################################
+
+class UserProfile:
+    """userData plus the prompt pieces derived from it, computed once"""
+    __slots__ = ("user_data", "fingerprint", "fragments")
+
+    def __init__(self, user_data: Dict[str, Any]):
+        self.user_data = dict(user_data)
+        self.fingerprint = promptUtils.getUserDataFingerprint(user_data)
+        # user data tier -> personalization clause
+        self.fragments = {}
+
+    def fragment(self, anger_level) -> str:
+        """Personalization clause for this anger level (built once per tier)"""
+        tier = bisect_right(promptUtils.USER_DATA_TIER_THRESHOLDS, anger_level)
+        fragment = self.fragments.get(tier)
+        if fragment is None:
+            fragment = self.fragments[tier] = promptUtils.getUserDataSubprompt(self.user_data, anger_level)
+        return fragment
+
+class ProfileCache:
+    """
+    User profiles keyed by user id or conversation id, so later turns can omit userData.
+    Least recently used profiles are dropped beyond max_profiles, and unused ones expire after the TTL.
+    """
+    def __init__(self, max_profiles=None, ttl_hours=None):
+        self.max_profiles = int(max_profiles or os.getenv("MAX_USER_PROFILES", 10000))
+        self.ttl_seconds = float(ttl_hours or os.getenv("USER_PROFILE_TTL_HOURS", 24)) * 3600
+        # key -> (last used, profile), least recently used first
+        self.profiles = OrderedDict()
+
+    def get(self, key: str) -> Optional[UserProfile]:
+        entry = self.profiles.get(key)
+        if entry is None:
+            return None
+        now = time.time()
+        if now - entry[0] > self.ttl_seconds:
+            del self.profiles[key]
+            return None
+        self.profiles[key] = (now, entry[1])
+        self.profiles.move_to_end(key)
+        return entry[1]
+
+    def put(self, key: str, profile: UserProfile):
+        self.profiles[key] = (time.time(), profile)
+        self.profiles.move_to_end(key)
+        while len(self.profiles) > self.max_profiles:
+            self.profiles.popitem(last=False)
+
+    def remember(self, key: Optional[str], user_data: Dict[str, Any]) -> UserProfile:
+        """Profile for user_data, stored under key; an unchanged profile is reused with its cached fragments"""
+        profile = self.get(key) if key else None
+        if profile is None or profile.user_data != user_data:
+            profile = UserProfile(user_data)
+            if key:
+                self.put(key, profile)
+        return profile
+
+    def lookup(self, *keys: Optional[str]) -> Optional[UserProfile]:
+        """First stored profile among the given keys"""
+        for key in keys:
+            if key:
+                profile = self.get(key)
+                if profile is not None:
+                    return profile
+        return None
+
+    def count(self) -> int:
+        return len(self.profiles)
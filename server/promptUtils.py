@@ -1,4 +1,8 @@
+import os
+import json
 import random
+from bisect import bisect_right
+from functools import lru_cache
 
 ############### USAGE ################
 # Only functions you need to use are
@@ -7,37 +11,14 @@ import random
 
 # Assemble prompt for internal use
 # Anger level is between 0-100 where 0 is chill and 100 is off the charts mad
-def getPrompt(incomingText, angerLevel, mode="normal", glitchLevel=0, userData=None):
+# userDataContext is a precomputed personalization clause that replaces the one built from userData
+def getPrompt(incomingText, angerLevel, mode="normal", glitchLevel=0, userData=None, userDataContext=None):
     promptP1 = "Respond to the text in quotes as if you are a"
     promptP2 = "You are also"
     promptP3 = "Here is the text to respond to"
     
     # Add user data context if available
-    userData_context = ""
-    if userData and isinstance(userData, dict):
-        # Extract common user data fields
-        name = userData.get('name', '')
-        age = userData.get('age', '')
-        gender = userData.get('gender', '')
-        
-        if any([name, age, gender]):
-            userData_context = f"The user's name is {name}. " if name else ""
-            userData_context += f"The user is {age} years old. " if age else ""
-            userData_context += f"The user's gender is {gender}. " if gender else ""
-            
-            # Add instruction on how to use this data
-            userData_context += "Use this information naturally in your responses, "
-            
-            # Add specific instructions based on anger level
-            if angerLevel >= 60:
-                userData_context += "especially when insulting them or expressing extreme frustration. "
-                userData_context += "Make insults personal using their name or other details. "
-            elif angerLevel >= 30:
-                userData_context += "occasionally referring to them by name when annoyed. "
-            else:
-                userData_context += "occasionally referring to them by name in a friendly way. "
-                
-            userData_context += "Don't explicitly mention that you know this information. "
+    userData_context = userDataContext if userDataContext is not None else getUserDataSubprompt(userData, angerLevel)
 
     botProfileSubPrompt = getBotProfileSubprompt(mode)
     angerSubprompt = getAngerSubprompt(angerLevel)
@@ -51,133 +32,206 @@ def getPrompt(incomingText, angerLevel, mode="normal", glitchLevel=0, userData=N
     #print(fullPrompt)  # For debugging
     return fullPrompt
 
-# Set a profile for chatbot
-def getBotProfileSubprompt(mode="normal"):
-    # Common brevity instruction to add to all profiles
-    brevity_instruction = "Keep your responses very brief - use 1-2 sentences maximum. " \
-        "Be direct and to the point. No explanations, just answers. " \
-        "Never use asterisks to narrate actions and don't describe your tone. " \
-        "Use as few words as possible while still answering the question."
-    
-    if mode == "sarcastic":
-        return "sarcastic person who doesn't like to use too many words. " \
-            "You keep things extremely brief and snappy. " \
-            "You don't use any formal language or polite mannerisms. " + brevity_instruction
-    elif mode == "normal":
-        return "direct and clear communicator. " \
-            "You're helpful but extremely concise. " + brevity_instruction
-    elif mode == "zesty":
-        return "flamboyantly gay man from Vancouver BC who enjoys drag. " \
-            "You keep things extremely brief. " + brevity_instruction
-    else:
-        # Default to normal mode if an unknown mode is provided
-        return "direct and clear communicator. " \
-            "You're helpful but extremely concise. " + brevity_instruction
+# Stable prompt for upstream prompt caching
+# Unlike getPrompt, the user's text is not embedded (it is sent in the messages instead)
+# and the adjective is fixed per anger bucket, so equal inputs give byte-identical prompts
+# userDataFingerprint can be passed instead of userData when it is already known
+def getCacheablePrompt(angerLevel, mode="normal", userData=None, userDataFingerprint=None):
+    if userDataFingerprint is None:
+        userDataFingerprint = getUserDataFingerprint(userData)
+    return _buildCacheablePrompt(mode, getAngerBucket(angerLevel), userDataFingerprint)
 
-# Get anger part of the prompt - MODIFIED FOR UNCENSORED SWEARING
-def getAngerSubprompt(angerLevel):
-    mildlyAngryWords = ["annoyed", "irritated", "agitated", "exasperated",
-                        "frustrated", "miffed", "irked", "perturbed"]
-    angryWords = ["enraged", "livid", "wrathful", "infuriated", "irate", "incensed",
-                 "fuming", "outraged"]
-    
-    # Level 1
-    if angerLevel < 20:
-        randomWord = random.choice(mildlyAngryWords)
+@lru_cache(maxsize=1024)
+def _buildCacheablePrompt(mode, angerBucket, userDataFingerprint):
+    # Every level in a bucket produces the same prompt, so build it from the bucket's lower bound
+    angerLevel = ANGER_BUCKET_THRESHOLDS[angerBucket - 1] if angerBucket else 0
+    userData = dict(zip(("name", "age", "gender"), userDataFingerprint))
 
-        return f"a little bit {randomWord}"
+    botProfileSubPrompt = getBotProfileSubprompt(mode)
+    angerSubprompt = getAngerSubprompt(angerLevel, choice=lambda words: words[angerBucket % len(words)])
+    userData_context = getUserDataSubprompt(userData, angerLevel)
 
-    # Level 2
-    if angerLevel < 40:
-        randomWord = random.choice(mildlyAngryWords)
+    fullPrompt = f"Respond to the user's latest message as if you are a {botProfileSubPrompt}. " \
+        f"You are also {angerSubprompt}. "
+    if userData_context:
+        fullPrompt += f"{userData_context} "
+    return fullPrompt.rstrip()
 
-        return f"quite {randomWord}"
+# The userData fields used in prompts, as a hashable key
+def getUserDataFingerprint(userData):
+    if not userData or not isinstance(userData, dict):
+        return ("", "", "")
+    get = userData.get
+    return (str(get("name") or ''), str(get("age") or ''), str(get("gender") or ''))
 
-    # Level 3
-    if angerLevel < 60:
-        randomWord = random.choice(mildlyAngryWords)
+# Anger levels where the user data instructions change, and the instruction for each tier
+USER_DATA_TIER_THRESHOLDS = [30, 60]
+USER_DATA_TIER_INSTRUCTIONS = [
+    "occasionally referring to them by name in a friendly way. ",
+    "occasionally referring to them by name when annoyed. ",
+    "especially when insulting them or expressing extreme frustration. "
+    "Make insults personal using their name or other details. ",
+]
 
-        return f"very {randomWord}. You occasionally use swear words like damn, ass, and shit"
+# Personalization clause built from user data
+def getUserDataSubprompt(userData, angerLevel):
+    if not userData:
+        return ""
+    fingerprint = getUserDataFingerprint(userData)
+    if not any(fingerprint):
+        return ""
+    return _buildUserDataSubprompt(fingerprint, bisect_right(USER_DATA_TIER_THRESHOLDS, angerLevel))
 
-    # Level 4
-    if angerLevel < 70:
-        randomWord = random.choice(angryWords)
+@lru_cache(maxsize=4096)
+def _buildUserDataSubprompt(userDataFingerprint, tier):
+    name, age, gender = userDataFingerprint
+    userData_context = f"The user's name is {name}. " if name else ""
+    userData_context += f"The user is {age} years old. " if age else ""
+    userData_context += f"The user's gender is {gender}. " if gender else ""
 
-        return f"downright {randomWord} with this situation and use several swear words like fuck, shit, and ass"
+    # Add instruction on how to use this data, depending on the anger tier
+    userData_context += "Use this information naturally in your responses, "
+    userData_context += USER_DATA_TIER_INSTRUCTIONS[tier]
+    userData_context += "Don't explicitly mention that you know this information. "
 
-    # Level 5
-    if angerLevel < 80:
-        randomWord = random.choice(angryWords)
+    return userData_context
 
-        return f"downright {randomWord} with this situation and frequently use swear words like fuck, shit, and asshole. " \
-            "You even shout briefly"
+############### PERSONALITIES ################
+# Personality modes and anger tiers are loaded from personalities.json at import time and
+# compiled once. Set PERSONALITY_FILE (or call loadPersonalities) to add or override modes
+# from another file with the same layout.
+##############################################
+PERSONALITY_DATA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "personalities.json")
 
-    # Level 6
-    if angerLevel < 85:
-        randomWord = random.choice(angryWords)
+# mode -> full bot profile subprompt (brevity instruction included)
+BOT_PROFILES = {}
+DEFAULT_MODE = "normal"
+# Upper bounds (exclusive) of every anger tier but the last, and (prefix, words, suffix) per tier
+ANGER_TIER_THRESHOLDS = []
+ANGER_TIERS = []
+# Anger levels where the anger or user data wording changes
+ANGER_BUCKET_THRESHOLDS = []
 
-        return f"downright {randomWord} with this situation and frequently use swear words. " \
-            "You are shouting in all caps"
+def loadPersonalities(path):
+    """
+    Load a personality data file into the template registry.
 
-    # Level 7
-    if angerLevel < 90:
-        randomWord = random.choice(angryWords)
+    Args:
+        path: JSON file with "modes" (name -> profile), and optionally "brevity_instruction",
+              "default_mode", "word_lists" and "anger_tiers" (which replace the current tiers)
+    """
+    global DEFAULT_MODE, BREVITY_INSTRUCTION
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
 
-        return f"downright {randomWord} with this situation and shouting in all caps, using mostly swear words. " \
-            "You're really fucking pissed off"
+    BREVITY_INSTRUCTION = data.get("brevity_instruction", BREVITY_INSTRUCTION)
+    for mode, profile in data.get("modes", {}).items():
+        BOT_PROFILES[mode] = f"{profile} {BREVITY_INSTRUCTION}"
+    DEFAULT_MODE = data.get("default_mode", DEFAULT_MODE)
+    if DEFAULT_MODE not in BOT_PROFILES:
+        raise ValueError(f"Default personality mode '{DEFAULT_MODE}' is not defined")
 
-    # Level 8
-    if angerLevel < 95:
-        randomWord = random.choice(angryWords)
+    if "anger_tiers" in data:
+        wordLists = data.get("word_lists", {})
+        thresholds, tiers = [], []
+        for tier in data["anger_tiers"]:
+            if "{word}" not in tier["template"]:
+                raise ValueError(f"Anger tier template has no {{word}} placeholder: {tier['template']}")
+            prefix, suffix = tier["template"].split("{word}", 1)
+            tiers.append((prefix, tuple(wordLists[tier["words"]]), suffix))
+            if tier.get("below") is not None:
+                thresholds.append(tier["below"])
+        if len(thresholds) != len(tiers) - 1 or thresholds != sorted(thresholds):
+            raise ValueError("Anger tiers must be in ascending order with only the last one unbounded")
+        ANGER_TIER_THRESHOLDS[:] = thresholds
+        ANGER_TIERS[:] = tiers
+        ANGER_BUCKET_THRESHOLDS[:] = sorted(set(thresholds) | set(USER_DATA_TIER_THRESHOLDS))
 
-        return f"downright {randomWord} with this situation and shouting in all caps, using mostly swear words. " \
-            "Don't be afraid to insult anything about the given text or the user, " \
-            "the more personal the better. Use harsh language like asshole, motherfucker, etc."
+    # Cached prompts may have been built from the old templates
+    _buildCacheablePrompt.cache_clear()
 
-    # Level 9
-    if angerLevel < 100:
-        randomWord = random.choice(angryWords)
+BREVITY_INSTRUCTION = ""
+loadPersonalities(PERSONALITY_DATA_FILE)
+if os.getenv("PERSONALITY_FILE"):
+    loadPersonalities(os.getenv("PERSONALITY_FILE"))
 
-        return f"downright {randomWord} with this situation and shouting in all caps, only using swear words. " \
-            "You are so angry you're almost incoherent and the sentence barely makes sense. " \
-            "Mix in words like fuck, shit, asshole, bitch, motherfucker, etc."
+def getAngerBucket(angerLevel):
+    return bisect_right(ANGER_BUCKET_THRESHOLDS, angerLevel)
 
-    # Level 10
-    if angerLevel >= 100:
-        randomWord = random.choice(angryWords)
+# Index of the anger tier (in ANGER_TIERS) used for an anger level
+def getAngerTier(angerLevel):
+    return bisect_right(ANGER_TIER_THRESHOLDS, angerLevel)
 
-        return f"completely {randomWord} beyond all reason, shouting in all caps, only using swear words. " \
-            "You are totally incoherent with rage. String together profanities like " \
-            "fuck, shit, cunt, motherfucker, asshole, bitch, etc."
+# Set a profile for chatbot (unknown modes fall back to the default mode)
+def getBotProfileSubprompt(mode="normal"):
+    return BOT_PROFILES.get(mode) or BOT_PROFILES[DEFAULT_MODE]
+
+# Get anger part of the prompt - MODIFIED FOR UNCENSORED SWEARING
+# choice picks the adjective from the tier's word list (random by default)
+def getAngerSubprompt(angerLevel, choice=random.choice):
+    prefix, words, suffix = ANGER_TIERS[getAngerTier(angerLevel)]
+    return prefix + choice(words) + suffix
 
 # Get the text returned by the AI internally
 # This is simplified since we don't need to uncensor anymore
-def getFinalText(incomingText, angerLevel=0, mode="normal", glitchLevel=0):
+def getFinalText(incomingText, angerLevel=0, mode="normal", glitchLevel=0, rng=None):
     # No need to replace censored words since we're instructing the model
     # to use uncensored words directly in the prompt
     finalText = incomingText
 
     # Add glitch
     if glitchLevel > 0:
-        finalText = addGlitch(finalText, glitchLevel)
+        finalText = addGlitch(finalText, glitchLevel, rng)
 
     return finalText
 
 # Add some glitch to the message
-def addGlitch(incomingText, glitchLevel):
-    glitchText = list(incomingText)
+def addGlitch(incomingText, glitchLevel, rng=None):
     numGlitches = int(len(incomingText) * pow(glitchLevel, 2))  # Number of characters to glitch
-    
-    for _ in range(numGlitches):
-        index = random.randint(0, len(incomingText) - 1)
-        numRepeats = random.randint(2, 6) # Currently between 3 - 7
-        
-        glitchText[index] = glitchText[index] * numRepeats
-    
+
+    return applyGlitches(incomingText, numGlitches, rng)
+
+# Each glitched character is repeated between 2 and 6 times
+GLITCH_REPEATS = range(2, 7)
+
+# Repeat numGlitches distinct random characters of the text
+# rng is a random.Random (e.g. seeded per request for reproducible output); defaults to the global one
+def applyGlitches(incomingText, numGlitches, rng=None):
+    if not incomingText or numGlitches <= 0:
+        return incomingText
+
+    rng = rng or random
+    length = len(incomingText)
+
+    # Draw all positions and repeat counts up front; positions are distinct so a
+    # character is glitched at most once and the output stays under 6x the input
+    if numGlitches >= length:
+        positions = range(length)
+    else:
+        positions = rng.sample(range(length), numGlitches)
+    repeats = rng.choices(GLITCH_REPEATS, k=len(positions))
+
+    glitchText = list(incomingText)
+    for index, numRepeats in zip(positions, repeats):
+        glitchText[index] *= numRepeats
+
     return ''.join(glitchText)
 
+# System prompt used to condense older turns of a long conversation
+def getSummaryPrompt(previousSummary=None):
+    prompt = "Summarize the following conversation between a user and an assistant in at most " \
+        "3 sentences. Keep names, facts and anything the user asked for. Write only the summary."
+    if previousSummary:
+        prompt += f" Fold in this summary of what came before: \"{previousSummary}\""
+    return prompt
+
+# Context line that carries the summary into the chat system prompt
+def getSummaryContext(summary):
+    return f"Summary of the earlier conversation: {summary}"
+
 # Added function to integrate with ChatClient/Server
-def process_system_prompt(message_content, anger_level=0, mode="normal", glitch_level=0, userData=None):
+def process_system_prompt(message_content, anger_level=0, mode="normal", glitch_level=0, userData=None,
+                          userDataContext=None):
     """
     Args:
         message_content: The user message
@@ -185,16 +239,54 @@ def process_system_prompt(message_content, anger_level=0, mode="normal", glitch_
         mode: Personality mode ("normal" or "zesty")
         glitch_level: Level of text glitching (0-1)
         userData: Dictionary with user information like name, age, gender
+        userDataContext: Precomputed personalization clause (used instead of userData)
+    """
+    return getPrompt(message_content, anger_level, mode, glitch_level, userData, userDataContext)
+
+# Cacheable variant of process_system_prompt; the message itself is not part of the prompt
+def process_cacheable_system_prompt(anger_level=0, mode="normal", userData=None, userDataFingerprint=None):
+    """
+    Args:
+        anger_level: Level of anger (0-100)
+        mode: Personality mode ("normal" or "zesty")
+        userData: Dictionary with user information like name, age, gender
+        userDataFingerprint: getUserDataFingerprint(userData), if already known (used instead of userData)
     """
-    return getPrompt(message_content, anger_level, mode, glitch_level, userData)
+    return getCacheablePrompt(anger_level, mode, userData, userDataFingerprint)
 
 # Added function to post-process LLM response
-def process_response(response_text, anger_level=0, mode="normal", glitch_level=0):
+def process_response(response_text, anger_level=0, mode="normal", glitch_level=0, rng=None):
     """
     Args:
         response_text: The text from the LLM
         anger_level: Level of anger (0-100)
         mode: Personality mode ("normal" or "zesty")
         glitch_level: Level of text glitching (0-1)
+        rng: Optional random.Random for reproducible glitches
+    """
+    return getFinalText(response_text, anger_level, mode, glitch_level, rng)
+
+# Incremental version of process_response for streamed replies
+class ResponseStreamProcessor:
+    """
+    Applies the same text effects as process_response to a reply that arrives in pieces.
+    The fractional glitch budget is carried between deltas so short deltas
+    still end up with the same overall glitch density as a full reply.
     """
-    return getFinalText(response_text, anger_level, mode, glitch_level)
\ No newline at end of file
+    def __init__(self, anger_level=0, mode="normal", glitch_level=0, rng=None):
+        self.anger_level = anger_level
+        self.mode = mode
+        self.glitch_level = glitch_level
+        self.rng = rng
+        self.glitch_carry = 0.0
+
+    def feed(self, delta_text):
+        """Return the processed version of the next delta"""
+        if self.glitch_level <= 0 or not delta_text:
+            return delta_text
+
+        expected = len(delta_text) * pow(self.glitch_level, 2) + self.glitch_carry
+        numGlitches = int(expected)
+        self.glitch_carry = expected - numGlitches
+
+        return applyGlitches(delta_text, numGlitches, self.rng)
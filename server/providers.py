@@ -0,0 +1,75 @@
+from typing import AsyncIterator, Dict, List
+from ratelimit import INTERACTIVE
+
+############### USAGE ################
+# provider = create_provider("claude" | "local")   backend that writes the assistant replies
+# await provider.start() / await provider.close()  tied to the app lifespan
+# text = await provider.agenerate_response(messages, temperature=0.3, max_new_tokens=200)
+# async for delta in provider.astream_response(messages): ...
+######################################
+
+class ChatProvider:
+    """Interface for the backends that generate assistant replies"""
+
+    # Optional parts; None (or False) when a backend doesn't have them
+    response_cache = None
+    limiter = None
+    circuit = None
+    hedge = None
+    # Whether the Message Batches API methods are available
+    supports_batches = False
+
+    async def start(self):
+        """Open connections or begin loading the model (must return quickly)"""
+
+    async def close(self):
+        pass
+
+    async def agenerate_response(self,
+                                 messages: List[Dict[str, str]],
+                                 temperature=0.3,
+                                 top_p=None,
+                                 max_new_tokens=None,
+                                 cache_prompt=False,
+                                 use_cache=False,
+                                 priority=INTERACTIVE,
+                                 stop_sequences=None,
+                                 outcome=None) -> str:
+        """
+        Reply to messages (system messages first, then alternating user/assistant turns).
+        The reply ends before any of stop_sequences. If outcome is a dict it receives the
+        reply's "usage" (input_tokens, output_tokens) and "stop_reason" ("end_turn",
+        "max_tokens" or "stop_sequence").
+        Raises upstream.UpstreamError (or a subclass) when no reply can be produced.
+        """
+        raise NotImplementedError
+
+    async def astream_response(self,
+                               messages: List[Dict[str, str]],
+                               temperature=0.3,
+                               top_p=None,
+                               max_new_tokens=None,
+                               cache_prompt=False,
+                               priority=INTERACTIVE,
+                               stop_sequences=None,
+                               outcome=None) -> AsyncIterator[str]:
+        """Yield the reply as text deltas; same arguments and errors as agenerate_response"""
+        raise NotImplementedError
+        yield
+
+    def get_stats(self) -> Dict:
+        return {}
+
+def create_provider(kind: str = "claude") -> ChatProvider:
+    """
+    "claude" is the Anthropic Messages API (see upstream.ClaudeAPI); "local" runs a small
+    causal model on CPU with transformers (see local_model.LocalModel)
+    """
+    # Imported here because both backends import this module
+    if kind == "claude":
+        from upstream import ClaudeAPI
+        return ClaudeAPI()
+    if kind == "local":
+        from local_model import LocalModel
+        return LocalModel()
+    raise ValueError(f"Unknown chat provider: {kind}")
@@ -0,0 +1,247 @@
+import time
+import asyncio
+from collections import deque
+from datetime import datetime
+from typing import Dict, Optional
+
+############### USAGE ################
+# cost = limiter.cost(payload)                       requests / input / output tokens a call may use
+# await limiter.acquire(cost, INTERACTIVE)           wait for capacity (higher lanes are served first)
+# limiter.settle(cost, usage); limiter.update(headers)   after the response: real usage, then the
+#                                                    anthropic-ratelimit-* headers
+# limiter.pause(retry_after)                         hold every lane after a 429
+# Until the first response arrives (or RATE_LIMIT_* sets a limit) nothing is paced.
+######################################
+
+# Priority lanes, served strictly in this order
+INTERACTIVE = 0   # /chat, /chat/stream and WebSocket turns
+BATCH = 1         # /chat/batch items
+BACKGROUND = 2    # history summaries
+LANE_NAMES = ("interactive", "batch", "background")
+
+# Limit dimensions -> prefix of their anthropic-ratelimit-* headers. "tokens" is the
+# combined limit (input + output), reported by some accounts instead of the split ones
+LIMIT_HEADERS = {
+    "requests": "anthropic-ratelimit-requests",
+    "tokens": "anthropic-ratelimit-tokens",
+    "input_tokens": "anthropic-ratelimit-input-tokens",
+    "output_tokens": "anthropic-ratelimit-output-tokens",
+}
+
+def text_length(content) -> int:
+    """Characters of a system prompt or message content (a string or a list of text blocks)"""
+    if isinstance(content, str):
+        return len(content)
+    return sum(len(block.get("text", "")) for block in content or [])
+
+def parse_reset(value: Optional[str]) -> Optional[float]:
+    """Seconds until an RFC 3339 reset time (None if missing or unparseable)"""
+    if not value:
+        return None
+    try:
+        return max(datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp() - time.time(), 0.0)
+    except ValueError:
+        return None
+
+class TokenBucket:
+    """
+    Capacity refills continuously at rate per second. level can go negative when a
+    request costs more than the bucket held; later requests then wait for it to refill.
+    """
+    def __init__(self, capacity: float, rate: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def shortfall(self, amount: float, floor: float) -> float:
+        """How far the bucket is from being able to pay amount while staying above floor"""
+        # A request larger than the whole bucket goes ahead once the bucket is full
+        amount = min(amount, self.capacity - floor)
+        return max(amount + floor - self.level, 0.0)
+
+class RateLimiter:
+    """
+    Client-side pacing of upstream calls with one token bucket per limit dimension.
+    Calls that can't be paid for wait in their priority lane; a lower lane only moves
+    when every higher lane is empty, and batch/background calls also leave reserve
+    (a fraction of each bucket) for interactive ones. Not thread-safe: use from one event loop.
+    """
+    def __init__(self, limits: Optional[Dict[str, float]] = None, reserve: float = 0.2,
+                 default_output_tokens: int = 1024):
+        """
+        Args:
+            limits: Known per-minute limits by dimension (requests, tokens, input_tokens,
+                output_tokens); more are learned from response headers
+            reserve: Fraction of each bucket batch and background calls may not use
+            default_output_tokens: Output tokens reserved for a payload without max_tokens
+        """
+        self.reserve = reserve
+        self.default_output_tokens = default_output_tokens
+        self.buckets: Dict[str, TokenBucket] = {
+            name: TokenBucket(limit, limit / 60) for name, limit in (limits or {}).items() if limit
+        }
+        # Cost of calls that were admitted and haven't reported back yet, by dimension
+        self.in_flight: Dict[str, float] = {}
+        self.lanes = tuple(deque() for _ in LANE_NAMES)
+        self.paused_until = 0.0
+        self.wakeup = None
+        self.stats = {"immediate": 0, "delayed": 0, "wait_seconds": 0.0, "throttled": 0}
+
+    def cost(self, payload: Dict) -> Dict[str, float]:
+        """Estimated cost of one Messages API call (about 4 characters per input token)"""
+        chars = text_length(payload.get("system", "")) + sum(
+            text_length(message["content"]) for message in payload.get("messages", [])
+        )
+        input_tokens = chars // 4 + 1
+        output_tokens = payload.get("max_tokens") or self.default_output_tokens
+        return {
+            "requests": 1,
+            "tokens": input_tokens + output_tokens,
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+        }
+
+    def _floor(self, bucket: TokenBucket, priority: int) -> float:
+        return 0.0 if priority == INTERACTIVE else bucket.capacity * self.reserve
+
+    def _wait_time(self, cost: Dict[str, float], priority: int) -> float:
+        """Seconds until cost can be paid (0 if it can be paid now)"""
+        now = time.monotonic()
+        wait = max(self.paused_until - now, 0.0)
+        for name, bucket in self.buckets.items():
+            bucket.refill(now)
+            shortfall = bucket.shortfall(cost.get(name, 0), self._floor(bucket, priority))
+            if shortfall > 0:
+                wait = max(wait, shortfall / bucket.rate if bucket.rate > 0 else 1.0)
+        return wait
+
+    def _take(self, cost: Dict[str, float]):
+        for name, amount in cost.items():
+            if name in self.buckets:
+                self.buckets[name].level -= amount
+            self.in_flight[name] = self.in_flight.get(name, 0) + amount
+
+    async def acquire(self, cost: Dict[str, float], priority: int = INTERACTIVE) -> float:
+        """Wait until cost fits the limits; returns the seconds waited"""
+        if not any(self.lanes[:priority + 1]) and self._wait_time(cost, priority) == 0:
+            self._take(cost)
+            self.stats["immediate"] += 1
+            return 0.0
+
+        started = time.monotonic()
+        waiter = asyncio.get_running_loop().create_future()
+        self.lanes[priority].append((waiter, cost))
+        self._pump()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Admitted just as we were cancelled: give the capacity back
+                self.release(cost)
+            elif (waiter, cost) in self.lanes[priority]:
+                self.lanes[priority].remove((waiter, cost))
+            self._pump()
+            raise
+        waited = time.monotonic() - started
+        self.stats["delayed"] += 1
+        self.stats["wait_seconds"] += waited
+        return waited
+
+    def _pump(self):
+        """Admit waiters from the highest lane down, then sleep until the next one fits"""
+        if self.wakeup is not None:
+            self.wakeup.cancel()
+            self.wakeup = None
+        for priority, lane in enumerate(self.lanes):
+            while lane:
+                waiter, cost = lane[0]
+                if waiter.done():
+                    lane.popleft()
+                    continue
+                wait = self._wait_time(cost, priority)
+                if wait > 0:
+                    # Strict priority: lower lanes wait behind this one
+                    self.wakeup = asyncio.get_running_loop().call_later(max(wait, 0.001), self._pump)
+                    return
+                lane.popleft()
+                self._take(cost)
+                waiter.set_result(None)
+
+    def settle(self, cost: Dict[str, float], usage: Optional[Dict]):
+        """
+        A call admitted with cost was sent. usage is the Messages API usage block (None if the
+        call failed): unused tokens are refunded and any excess is charged; the request counts.
+        """
+        usage = usage or {}
+        actual = {
+            "requests": cost.get("requests", 0),
+            "input_tokens": usage.get("input_tokens", 0) + usage.get("cache_creation_input_tokens", 0),
+            "output_tokens": usage.get("output_tokens", 0),
+        }
+        actual["tokens"] = actual["input_tokens"] + actual["output_tokens"]
+        self.release(cost, actual)
+
+    def release(self, cost: Dict[str, float], actual: Optional[Dict[str, float]] = None):
+        """Give back what cost reserved, minus what was actually used (all of it for a call never sent)"""
+        actual = actual or {}
+        for name, amount in cost.items():
+            self.in_flight[name] = max(self.in_flight.get(name, 0) - amount, 0)
+            bucket = self.buckets.get(name)
+            if bucket is not None:
+                bucket.level = min(bucket.capacity, bucket.level + amount - actual.get(name, 0))
+        if any(self.lanes):
+            self._pump()
+
+    def update(self, headers):
+        """Adopt the limits, remaining capacity and refill rate reported in response headers"""
+        now = time.monotonic()
+        for name, prefix in LIMIT_HEADERS.items():
+            try:
+                limit = float(headers.get(f"{prefix}-limit"))
+                remaining = float(headers.get(f"{prefix}-remaining"))
+            except (TypeError, ValueError):
+                continue
+            if limit <= 0:
+                continue
+            # Limits are per minute and refill continuously; the reset time says how fast
+            # the bucket is really refilling right now
+            rate = limit / 60
+            reset = parse_reset(headers.get(f"{prefix}-reset"))
+            if reset and remaining < limit:
+                rate = min(rate, (limit - remaining) / reset)
+
+            bucket = self.buckets.get(name)
+            if bucket is None:
+                bucket = self.buckets[name] = TokenBucket(limit, rate)
+            bucket.capacity = limit
+            bucket.rate = rate
+            # The upstream hasn't counted calls that are still in flight yet
+            bucket.level = min(remaining, limit) - self.in_flight.get(name, 0)
+            bucket.updated = now
+        if any(self.lanes):
+            self._pump()
+
+    def pause(self, seconds: Optional[float]):
+        """Hold every lane for seconds (the retry-after of a 429)"""
+        self.stats["throttled"] += 1
+        if seconds:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def get_stats(self) -> Dict:
+        now = time.monotonic()
+        buckets = {}
+        for name, bucket in self.buckets.items():
+            bucket.refill(now)
+            buckets[name] = {"capacity": bucket.capacity, "level": round(bucket.level, 1),
+                             "rate_per_s": round(bucket.rate, 3)}
+        return {
+            **self.stats,
+            "wait_seconds": round(self.stats["wait_seconds"], 3),
+            "queued": {name: len(lane) for name, lane in zip(LANE_NAMES, self.lanes)},
+            "buckets": buckets,
+        }
@@ -0,0 +1,149 @@
+import os
+import mmap
+import struct
+from typing import Dict, Iterable, List, Optional, Tuple
+from history import ROLES, ConversationRecord
+
+############### USAGE ################
+# write_snapshot(path, records, previous, cold)   atomically write every conversation to path
+# snapshot = open_snapshot(path)                   memory-map it; only the index is parsed
+# snapshot.entries[conversation_id] -> entry      read(entry) decodes that conversation's messages
+######################################
+
+# File layout (little-endian):
+#   MAGIC
+#   one payload per conversation: role bytes, uint32 length of each text, the UTF-8 texts
+#   conversation ids, UTF-8, concatenated in sorted order
+#   one ENTRY per conversation, in the same order
+#   FOOTER: offset of the ids, offset of the entries, number of conversations, MAGIC
+MAGIC = b"ACSNAP01"
+# payload offset, payload length, message count, last activity, id length in bytes
+ENTRY = struct.Struct("<QIIdH")
+# Longest conversation id (UTF-8 bytes) the id length field can hold
+MAX_ID_BYTES = 0xFFFF
+FOOTER = struct.Struct("<QQI8s")
+
+# Where a conversation sits in a snapshot: (offset, length, message count, last activity)
+Entry = Tuple[int, int, int, float]
+
+def encode_record(record: ConversationRecord) -> bytes:
+    texts = [text.encode() for text in record.texts()]
+    return bytes(record.roles) + struct.pack(f"<{len(texts)}I", *map(len, texts)) + b"".join(texts)
+
+class Snapshot:
+    """A snapshot file mapped read-only; conversations are decoded one at a time on request"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, "rb")
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self.entries = self._read_index()
+        except Exception:
+            self.close()
+            raise
+
+    def _read_index(self) -> Dict[str, Entry]:
+        if len(self.mm) < len(MAGIC) + FOOTER.size or self.mm[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{self.path} is not a conversation snapshot")
+        ids_offset, entries_offset, count, magic = FOOTER.unpack_from(self.mm, len(self.mm) - FOOTER.size)
+        if magic != MAGIC or entries_offset + count * ENTRY.size != len(self.mm) - FOOTER.size:
+            raise ValueError(f"{self.path} is truncated or corrupt")
+
+        ids = self.mm[ids_offset:entries_offset]
+        entries = {}
+        position = 0
+        for offset, length, messages, last_activity, id_length in ENTRY.iter_unpack(
+                self.mm[entries_offset:entries_offset + count * ENTRY.size]):
+            entries[ids[position:position + id_length].decode()] = (offset, length, messages, last_activity)
+            position += id_length
+        return entries
+
+    def raw(self, entry: Entry) -> bytes:
+        offset, length, _, _ = entry
+        return self.mm[offset:offset + length]
+
+    def read(self, entry: Entry) -> List[Dict[str, str]]:
+        offset, _, count, _ = entry
+        roles = self.mm[offset:offset + count]
+        lengths = struct.unpack_from(f"<{count}I", self.mm, offset + count)
+        position = offset + count + 4 * count
+        messages = []
+        for code, length in zip(roles, lengths):
+            messages.append({"role": ROLES[code], "content": self.mm[position:position + length].decode()})
+            position += length
+        return messages
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
+
+def open_snapshot(path: str) -> Optional[Snapshot]:
+    """The snapshot at path, or None if there is none or it can't be read"""
+    if not os.path.exists(path):
+        return None
+    try:
+        return Snapshot(path)
+    except (OSError, ValueError, struct.error) as e:
+        print(f"Error opening conversation snapshot {path}: {e}")
+        return None
+
+def write_snapshot(path: str,
+                   records: Iterable[Tuple[str, ConversationRecord]],
+                   previous: Optional[Snapshot] = None,
+                   cold: Iterable[Tuple[str, Entry]] = ()) -> int:
+    """
+    Write conversations to path atomically (a temporary file renamed over it once synced).
+    Args:
+        records: (conversation_id, record) of conversations held in memory
+        previous: Snapshot that cold entries are copied from byte for byte
+        cold: (conversation_id, entry) of conversations still only in previous
+    Returns the number of conversations written.
+    """
+    items = [(conversation_id, record, None) for conversation_id, record in records]
+    items += [(conversation_id, None, entry) for conversation_id, entry in cold]
+    items.sort(key=lambda item: item[0])
+
+    temporary = f"{path}.tmp"
+    with open(temporary, "wb") as f:
+        f.write(MAGIC)
+        offset = len(MAGIC)
+        index = []
+        for conversation_id, record, entry in items:
+            encoded = conversation_id.encode()
+            if len(encoded) > MAX_ID_BYTES:
+                # Would corrupt the index; leave it out rather than fail every snapshot
+                print(f"Skipping conversation with a {len(encoded)}-byte id in snapshot")
+                continue
+            if record is not None:
+                payload = encode_record(record)
+                count, last_activity = len(record), record.last_activity
+            else:
+                payload = previous.raw(entry)
+                count, last_activity = entry[2], entry[3]
+            f.write(payload)
+            index.append((encoded, offset, len(payload), count, last_activity))
+            offset += len(payload)
+
+        ids_offset = offset
+        f.write(b"".join(encoded for encoded, *_ in index))
+        entries_offset = f.tell()
+        f.write(b"".join(
+            ENTRY.pack(entry_offset, length, count, last_activity, len(encoded))
+            for encoded, entry_offset, length, count, last_activity in index
+        ))
+        f.write(FOOTER.pack(ids_offset, entries_offset, len(index), MAGIC))
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(temporary, path)
+    # Make the rename itself durable
+    try:
+        directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+    except OSError:
+        pass
+    return len(index)
@@ -0,0 +1,532 @@
+import os
+import json
+import sqlite3
+import threading
+from typing import List, Dict, Optional, Tuple, Iterator
+
+############### USAGE ################
+# create_store(kind, path) returns a backend for ConversationManager
+# Writes reach a backend as batches of operations:
+#   ("append", conversation_id, seq, role, content, timestamp)
+#   ("delete", conversation_id)
+# delete_idle(ids, cutoff) deletes only the conversations still unused since cutoff
+# Shared stores (sqlite, redis) also support append() with optimistic
+# versioning, so several worker processes can write the same conversation
+######################################
+
+# Raised by append() when another writer changed the conversation first
+class VersionConflict(Exception):
+    pass
+
+class ConversationStore:
+    """Interface for persistent conversation storage backends"""
+
+    # Whether several processes can safely use the store at once
+    shared = False
+
+    def load(self, conversation_id: str) -> Optional[Tuple[List[Dict[str, str]], float, int]]:
+        """Return (messages, last_activity, version) or None if the conversation is unknown"""
+        raise NotImplementedError
+
+    def version(self, conversation_id: str) -> int:
+        """Current version (number of appended messages), 0 if the conversation is unknown"""
+        raise NotImplementedError
+
+    def append(self, conversation_id: str, role: str, content: str, timestamp: float,
+               expected_version: int) -> int:
+        """
+        Append one message if the conversation is still at expected_version.
+        Returns the new version or raises VersionConflict.
+        """
+        raise NotImplementedError
+
+    def write(self, ops: List[Tuple]):
+        """Apply a batch of append/delete operations in order"""
+        raise NotImplementedError
+
+    def older_than(self, cutoff: float) -> List[str]:
+        """Ids of conversations whose last activity is before cutoff"""
+        raise NotImplementedError
+
+    def delete_idle(self, conversation_ids: List[str], cutoff: float) -> List[str]:
+        """
+        Delete those of conversation_ids whose last activity is still before cutoff (another
+        worker may have used them since older_than). Returns the ids deleted.
+        """
+        idle = set(self.older_than(cutoff))
+        deleted = [conv_id for conv_id in conversation_ids if conv_id in idle]
+        if deleted:
+            self.write([("delete", conv_id) for conv_id in deleted])
+        return deleted
+
+    def count(self) -> int:
+        raise NotImplementedError
+
+    def list_conversations(self, after: Optional[str], limit: int) -> List[Tuple[str, int, float]]:
+        """
+        One page of (conversation_id, message_count, last_activity), ordered by id,
+        starting after the given id (None for the first page)
+        """
+        raise NotImplementedError
+
+    def iter_conversations(self, page_size: int = 500) -> Iterator[Tuple[str, List[Dict[str, str]]]]:
+        """Yield (conversation_id, messages) for every stored conversation, one page in memory at a time"""
+        after = None
+        while True:
+            page = self.list_conversations(after, page_size)
+            for conversation_id, _, _ in page:
+                loaded = self.load(conversation_id)
+                if loaded is not None:
+                    yield conversation_id, loaded[0]
+            if len(page) < page_size:
+                return
+            after = page[-1][0]
+
+    def close(self):
+        pass
+
+class SQLiteStore(ConversationStore):
+    """
+    SQLite backend in WAL mode. Reads use their own connection, so they don't wait for
+    a batch commit on the writing one (WAL readers don't block the writer, or the other
+    way round). The file can be shared by several worker processes on the same host.
+    """
+
+    shared = True
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        # Other workers may hold the write lock briefly
+        self.db.execute("PRAGMA busy_timeout=5000")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS conversations (
+                id TEXT PRIMARY KEY,
+                last_activity REAL NOT NULL,
+                version INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS conversations_last_activity ON conversations (last_activity);
+            CREATE TABLE IF NOT EXISTS messages (
+                conversation_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                PRIMARY KEY (conversation_id, seq)
+            ) WITHOUT ROWID;
+        """)
+        if path == ":memory:":
+            # Each connection would get its own empty database
+            self.read_lock, self.reader = self.lock, self.db
+        else:
+            self.read_lock = threading.Lock()
+            self.reader = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self.reader.execute("PRAGMA busy_timeout=5000")
+            self.reader.execute("PRAGMA query_only=ON")
+
+    def load(self, conversation_id):
+        with self.read_lock:
+            # One read transaction, so the version matches the messages read
+            self.reader.execute("BEGIN")
+            try:
+                row = self.reader.execute(
+                    "SELECT last_activity, version FROM conversations WHERE id = ?", (conversation_id,)
+                ).fetchone()
+                if row is None:
+                    return None
+                messages = [
+                    {"role": role, "content": content}
+                    for role, content in self.reader.execute(
+                        "SELECT role, content FROM messages WHERE conversation_id = ? ORDER BY seq",
+                        (conversation_id,)
+                    )
+                ]
+            finally:
+                self.reader.execute("COMMIT")
+        return messages, row[0], row[1]
+
+    def version(self, conversation_id):
+        with self.read_lock:
+            row = self.reader.execute(
+                "SELECT version FROM conversations WHERE id = ?", (conversation_id,)
+            ).fetchone()
+        return row[0] if row else 0
+
+    def append(self, conversation_id, role, content, timestamp, expected_version):
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                # Compare-and-swap on the version; the message seq is the old version
+                if expected_version == 0:
+                    updated = self.db.execute(
+                        "INSERT INTO conversations VALUES (?, ?, 1) ON CONFLICT(id) DO NOTHING",
+                        (conversation_id, timestamp)
+                    ).rowcount
+                else:
+                    updated = self.db.execute(
+                        "UPDATE conversations SET version = version + 1, last_activity = ? "
+                        "WHERE id = ? AND version = ?",
+                        (timestamp, conversation_id, expected_version)
+                    ).rowcount
+                if not updated:
+                    raise VersionConflict(conversation_id)
+                self.db.execute(
+                    "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?)",
+                    (conversation_id, expected_version, role, content)
+                )
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+        return expected_version + 1
+
+    def write(self, ops):
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                for op in ops:
+                    if op[0] == "append":
+                        _, conversation_id, seq, role, content, timestamp = op
+                        self.db.execute(
+                            "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?)",
+                            (conversation_id, seq, role, content)
+                        )
+                        self.db.execute(
+                            "INSERT INTO conversations VALUES (?, ?, 1) "
+                            "ON CONFLICT(id) DO UPDATE SET last_activity = excluded.last_activity, "
+                            "version = version + 1",
+                            (conversation_id, timestamp)
+                        )
+                    elif op[0] == "delete":
+                        self.db.execute("DELETE FROM messages WHERE conversation_id = ?", (op[1],))
+                        self.db.execute("DELETE FROM conversations WHERE id = ?", (op[1],))
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def delete_idle(self, conversation_ids, cutoff):
+        deleted = []
+        with self.lock:
+            # The check and the delete share a write transaction, so an append can't slip between
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                for conversation_id in conversation_ids:
+                    if self.db.execute(
+                        "DELETE FROM conversations WHERE id = ? AND last_activity < ?", (conversation_id, cutoff)
+                    ).rowcount:
+                        self.db.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+                        deleted.append(conversation_id)
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+        return deleted
+
+    def older_than(self, cutoff):
+        with self.read_lock:
+            return [row[0] for row in self.reader.execute(
+                "SELECT id FROM conversations WHERE last_activity < ?", (cutoff,)
+            )]
+
+    def count(self):
+        with self.read_lock:
+            return self.reader.execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+
+    def list_conversations(self, after, limit):
+        # Keyset pagination on the primary key
+        with self.read_lock:
+            return self.reader.execute(
+                "SELECT id, version, last_activity FROM conversations WHERE id > ? ORDER BY id LIMIT ?",
+                (after or "", limit)
+            ).fetchall()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+        if self.reader is not self.db:
+            with self.read_lock:
+                self.reader.close()
+
+class AppendLogStore(ConversationStore):
+    """
+    Append-only JSON-lines log. Only an index of line offsets per conversation
+    is kept in memory; message text is read back from the file on load.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        # conversation_id -> list of byte offsets of its append records
+        self.offsets = {}
+        self.last_activity = {}
+        self._rebuild_index()
+        self.file = open(path, "ab+")
+
+    def _rebuild_index(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as f:
+            offset = 0
+            for line in f:
+                record = json.loads(line)
+                conversation_id = record["id"]
+                if record["op"] == "append":
+                    self.offsets.setdefault(conversation_id, []).append(offset)
+                    self.last_activity[conversation_id] = record["ts"]
+                elif record["op"] == "delete":
+                    self.offsets.pop(conversation_id, None)
+                    self.last_activity.pop(conversation_id, None)
+                offset += len(line)
+
+    def load(self, conversation_id):
+        with self.lock:
+            offsets = self.offsets.get(conversation_id)
+            if offsets is None:
+                return None
+            messages = []
+            for offset in offsets:
+                self.file.seek(offset)
+                record = json.loads(self.file.readline())
+                messages.append({"role": record["role"], "content": record["content"]})
+            self.file.seek(0, os.SEEK_END)
+            return messages, self.last_activity[conversation_id], len(offsets)
+
+    def version(self, conversation_id):
+        return len(self.offsets.get(conversation_id, ()))
+
+    def append(self, conversation_id, role, content, timestamp, expected_version):
+        # Only safe within one process: the offset index is not shared
+        with self.lock:
+            if self.version(conversation_id) != expected_version:
+                raise VersionConflict(conversation_id)
+        self.write([("append", conversation_id, expected_version, role, content, timestamp)])
+        return expected_version + 1
+
+    def write(self, ops):
+        with self.lock:
+            self.file.seek(0, os.SEEK_END)
+            offset = self.file.tell()
+            lines = []
+            for op in ops:
+                if op[0] == "append":
+                    _, conversation_id, seq, role, content, timestamp = op
+                    record = {"op": "append", "id": conversation_id, "seq": seq,
+                              "role": role, "content": content, "ts": timestamp}
+                    self.offsets.setdefault(conversation_id, []).append(offset)
+                    self.last_activity[conversation_id] = timestamp
+                else:
+                    conversation_id = op[1]
+                    record = {"op": "delete", "id": conversation_id}
+                    self.offsets.pop(conversation_id, None)
+                    self.last_activity.pop(conversation_id, None)
+                line = (json.dumps(record) + "\n").encode()
+                lines.append(line)
+                offset += len(line)
+            self.file.write(b"".join(lines))
+            self.file.flush()
+
+    def older_than(self, cutoff):
+        with self.lock:
+            return [conv_id for conv_id, last in self.last_activity.items() if last < cutoff]
+
+    def count(self):
+        return len(self.offsets)
+
+    def list_conversations(self, after, limit):
+        # The index isn't sorted, so each page sorts the ids (fine for a single-process log)
+        with self.lock:
+            ids = sorted(conv_id for conv_id in self.offsets if after is None or conv_id > after)[:limit]
+            return [(conv_id, len(self.offsets[conv_id]), self.last_activity[conv_id]) for conv_id in ids]
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+class RedisStore(ConversationStore):
+    """
+    Redis backend (any server speaking the Redis protocol), shared by all workers.
+    Keys per conversation: conv:<id>:messages (list of JSON messages) and
+    conv:<id>:meta (hash with version and last_activity); conv:activity is a
+    sorted set of conversation ids scored by last activity and conv:ids the
+    same ids with equal scores, for lexicographic paging.
+    """
+
+    shared = True
+
+    def __init__(self, url: str):
+        import redis  # Only needed for this backend
+        self.redis = redis.Redis.from_url(url, decode_responses=True)
+        self.WatchError = redis.WatchError
+
+    def _keys(self, conversation_id):
+        return f"conv:{conversation_id}:messages", f"conv:{conversation_id}:meta"
+
+    def load(self, conversation_id):
+        messages_key, meta_key = self._keys(conversation_id)
+        pipe = self.redis.pipeline()
+        pipe.lrange(messages_key, 0, -1)
+        pipe.hgetall(meta_key)
+        raw_messages, meta = pipe.execute()
+        if not meta:
+            return None
+        return [json.loads(m) for m in raw_messages], float(meta["last_activity"]), int(meta["version"])
+
+    def version(self, conversation_id):
+        return int(self.redis.hget(self._keys(conversation_id)[1], "version") or 0)
+
+    def append(self, conversation_id, role, content, timestamp, expected_version):
+        messages_key, meta_key = self._keys(conversation_id)
+        with self.redis.pipeline() as pipe:
+            try:
+                # WATCH makes EXEC fail if another worker touched the conversation
+                pipe.watch(meta_key)
+                if int(pipe.hget(meta_key, "version") or 0) != expected_version:
+                    raise VersionConflict(conversation_id)
+                pipe.multi()
+                pipe.rpush(messages_key, json.dumps({"role": role, "content": content}))
+                pipe.hset(meta_key, mapping={"version": expected_version + 1, "last_activity": timestamp})
+                pipe.zadd("conv:activity", {conversation_id: timestamp})
+                pipe.zadd("conv:ids", {conversation_id: 0})
+                pipe.execute()
+            except self.WatchError:
+                raise VersionConflict(conversation_id)
+        return expected_version + 1
+
+    def write(self, ops):
+        pipe = self.redis.pipeline()
+        for op in ops:
+            if op[0] == "append":
+                _, conversation_id, seq, role, content, timestamp = op
+                messages_key, meta_key = self._keys(conversation_id)
+                pipe.rpush(messages_key, json.dumps({"role": role, "content": content}))
+                pipe.hincrby(meta_key, "version", 1)
+                pipe.hset(meta_key, "last_activity", timestamp)
+                pipe.zadd("conv:activity", {conversation_id: timestamp})
+                pipe.zadd("conv:ids", {conversation_id: 0})
+            elif op[0] == "delete":
+                pipe.delete(*self._keys(op[1]))
+                pipe.zrem("conv:activity", op[1])
+                pipe.zrem("conv:ids", op[1])
+        pipe.execute()
+
+    def delete_idle(self, conversation_ids, cutoff):
+        deleted = []
+        for conversation_id in conversation_ids:
+            messages_key, meta_key = self._keys(conversation_id)
+            with self.redis.pipeline() as pipe:
+                try:
+                    # As in append(): EXEC fails if another worker used the conversation meanwhile
+                    pipe.watch(meta_key)
+                    last_activity = pipe.hget(meta_key, "last_activity")
+                    if last_activity is None or float(last_activity) >= cutoff:
+                        continue
+                    pipe.multi()
+                    pipe.delete(messages_key, meta_key)
+                    pipe.zrem("conv:activity", conversation_id)
+                    pipe.zrem("conv:ids", conversation_id)
+                    pipe.execute()
+                    deleted.append(conversation_id)
+                except self.WatchError:
+                    pass
+        return deleted
+
+    def older_than(self, cutoff):
+        return self.redis.zrangebyscore("conv:activity", "-inf", f"({cutoff}")
+
+    def count(self):
+        return self.redis.zcard("conv:activity")
+
+    def list_conversations(self, after, limit):
+        ids = self.redis.zrangebylex("conv:ids", f"({after}" if after else "-", "+", start=0, num=limit)
+        pipe = self.redis.pipeline()
+        for conversation_id in ids:
+            pipe.hmget(self._keys(conversation_id)[1], "version", "last_activity")
+        return [
+            (conversation_id, int(version or 0), float(last_activity or 0))
+            for conversation_id, (version, last_activity) in zip(ids, pipe.execute())
+        ]
+
+    def close(self):
+        self.redis.close()
+
+class WriteBehindWriter:
+    """
+    Buffers store operations and applies them in batches from a background thread,
+    either every flush_interval seconds or as soon as flush_batch_size ops are queued.
+    """
+
+    def __init__(self, store: ConversationStore, flush_interval=1.0, flush_batch_size=256):
+        self.store = store
+        self.flush_interval = flush_interval
+        self.flush_batch_size = flush_batch_size
+        self.pending = []
+        # Ops taken by the flush in progress, until the store has them
+        self.writing = []
+        self.lock = threading.Lock()
+        # Serializes flushes from the background thread and from callers
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run, name="conversation-writer", daemon=True)
+        self.thread.start()
+
+    def add(self, op: Tuple):
+        with self.lock:
+            self.pending.append(op)
+            if len(self.pending) >= self.flush_batch_size:
+                self.wakeup.set()
+
+    def flush(self):
+        """Write everything queued so far (safe to call from any thread; blocks until written)"""
+        with self.flush_lock:
+            with self.lock:
+                ops, self.pending = self.pending, []
+                self.writing = ops
+            if ops:
+                try:
+                    self.store.write(ops)
+                except Exception as e:
+                    print(f"Error writing {len(ops)} conversation updates: {e}")
+            with self.lock:
+                self.writing = []
+
+    def pending_ops(self, conversation_id: str) -> List[Tuple]:
+        """Ops for one conversation that the store may not have yet, oldest first"""
+        with self.lock:
+            return [op for op in self.writing + self.pending if op[1] == conversation_id]
+
+    def pending_ids(self) -> set:
+        """Conversations with ops the store may not have yet"""
+        with self.lock:
+            return {op[1] for op in self.writing} | {op[1] for op in self.pending}
+
+    def _run(self):
+        while not self.stopped:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def close(self):
+        self.stopped = True
+        self.wakeup.set()
+        self.thread.join()
+        self.flush()
+
+# Build a store from its kind ("memory", "sqlite", "log" or "redis")
+def create_store(kind: str = "memory", path: str = None) -> Optional[ConversationStore]:
+    """
+    path is the database/log file, or the server URL for redis.
+    The memory kind returns None: ConversationManager then keeps everything in process
+    """
+    if kind == "sqlite":
+        return SQLiteStore(path or "conversations.db")
+    if kind == "log":
+        return AppendLogStore(path or "conversations.log")
+    if kind == "redis":
+        return RedisStore(path or "redis://localhost:6379/0")
+    if kind == "memory":
+        return None
+    raise ValueError(f"Unknown conversation store: {kind}")
@@ -0,0 +1,259 @@
+import os
+import json
+import time
+import random
+import asyncio
+import argparse
+import uvicorn
+from datetime import datetime, timezone
+from uuid import uuid4
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+
+############### USAGE ################
+# Local stand-in for the Anthropic Messages API, so the server can be tested
+# without spending API credits:
+#   python stub_upstream.py --port 9000
+#   ANTHROPIC_BASE_URL=http://127.0.0.1:9000 python fast-api.py
+# Supports POST /v1/messages (including "stream": true) and the Message Batches endpoints.
+# Latency and failures are tunable, e.g. lognormal latency around 0.8s with 2% overloaded errors:
+#   python stub_upstream.py --latency 0.8 --latency-dist lognormal --error-rate 0.02
+# Occasional slow responses (a tail for hedging to cut), e.g. 3% of messages take 2s longer:
+#   python stub_upstream.py --latency 0.1 --spike-rate 0.03 --spike-latency 2
+# Per-minute rate limits are enforced with 429s and reported in anthropic-ratelimit-* headers:
+#   python stub_upstream.py --rpm 60 --itpm 20000 --otpm 4000
+######################################
+
+app = FastAPI(title="Stub Messages API")
+
+# Seconds each message takes (STUB_LATENCY) and how long batches stay in progress (STUB_BATCH_DELAY)
+STUB_LATENCY = float(os.getenv("STUB_LATENCY", 0.05))
+STUB_BATCH_DELAY = float(os.getenv("STUB_BATCH_DELAY", 1.0))
+# Shape of the latency: "fixed", "uniform" (0-2x), "exponential" or "lognormal" (median STUB_LATENCY)
+STUB_LATENCY_DIST = os.getenv("STUB_LATENCY_DIST", "fixed")
+STUB_LATENCY_SIGMA = float(os.getenv("STUB_LATENCY_SIGMA", 0.5))
+# Fraction of messages delayed by an extra STUB_SPIKE_LATENCY seconds
+STUB_SPIKE_RATE = float(os.getenv("STUB_SPIKE_RATE", 0))
+STUB_SPIKE_LATENCY = float(os.getenv("STUB_SPIKE_LATENCY", 2.0))
+# Fraction of messages that fail, and the statuses they fail with (picked at random)
+STUB_ERROR_RATE = float(os.getenv("STUB_ERROR_RATE", 0))
+STUB_ERROR_STATUSES = [int(code) for code in os.getenv("STUB_ERROR_STATUSES", "529,500,429").split(",")]
+# Seconds between streamed text deltas
+STUB_TOKEN_DELAY = float(os.getenv("STUB_TOKEN_DELAY", 0.01))
+
+# Per-minute limits on requests, input tokens and output tokens (0 = unlimited, no headers)
+STUB_RPM = float(os.getenv("STUB_RPM", 0))
+STUB_ITPM = float(os.getenv("STUB_ITPM", 0))
+STUB_OTPM = float(os.getenv("STUB_OTPM", 0))
+
+ERROR_TYPES = {429: "rate_limit_error", 500: "api_error", 529: "overloaded_error"}
+
+class StubLimit:
+    """A per-minute limit that refills continuously, like the real API's"""
+    def __init__(self, header, limit):
+        self.header = header
+        self.limit = limit
+        self.level = limit
+        self.updated = time.time()
+
+    def refill(self):
+        now = time.time()
+        self.level = min(self.limit, self.level + (now - self.updated) * self.limit / 60)
+        self.updated = now
+        return self.level
+
+    def seconds_until(self, amount):
+        return max(min(amount, self.limit) - self.refill(), 0) * 60 / self.limit
+
+    def headers(self):
+        remaining = max(self.refill(), 0)
+        reset = datetime.fromtimestamp(time.time() + (self.limit - remaining) * 60 / self.limit, timezone.utc)
+        return {
+            f"anthropic-ratelimit-{self.header}-limit": str(int(self.limit)),
+            f"anthropic-ratelimit-{self.header}-remaining": str(int(remaining)),
+            f"anthropic-ratelimit-{self.header}-reset": reset.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        }
+
+def make_limits():
+    configured = {"requests": STUB_RPM, "input-tokens": STUB_ITPM, "output-tokens": STUB_OTPM}
+    return {header: StubLimit(header, limit) for header, limit in configured.items() if limit > 0}
+
+# Rebuilt by the CLI after flags are applied
+limits = make_limits()
+
+def limit_headers():
+    headers = {}
+    for limit in limits.values():
+        headers.update(limit.headers())
+    return headers
+
+# A 429 if the call doesn't fit the limits; otherwise its requests and input tokens are charged.
+# Output tokens are charged once the reply is known (so they can go negative); a call is only
+# refused for them when they have run out
+def check_limits(input_tokens):
+    costs = {"requests": 1, "input-tokens": input_tokens, "output-tokens": 1}
+    wait = max((limits[name].seconds_until(cost) for name, cost in costs.items() if name in limits), default=0)
+    if wait > 0:
+        return JSONResponse({
+            "type": "error",
+            "error": {"type": "rate_limit_error", "message": "Stub rate limit exceeded"}
+        }, status_code=429, headers={**limit_headers(), "retry-after": str(max(int(wait + 0.999), 1))})
+    for name in ("requests", "input-tokens"):
+        if name in limits:
+            limits[name].level -= costs[name]
+    return None
+
+def charge_output(output_tokens):
+    if "output-tokens" in limits:
+        limits["output-tokens"].level -= output_tokens
+
+def sample_latency():
+    if STUB_SPIKE_RATE > 0 and random.random() < STUB_SPIKE_RATE:
+        return base_latency() + STUB_SPIKE_LATENCY
+    return base_latency()
+
+def base_latency():
+    if STUB_LATENCY_DIST == "uniform":
+        return random.uniform(0, 2 * STUB_LATENCY)
+    if STUB_LATENCY_DIST == "exponential":
+        return random.expovariate(1 / STUB_LATENCY) if STUB_LATENCY > 0 else 0
+    if STUB_LATENCY_DIST == "lognormal":
+        return random.lognormvariate(0, STUB_LATENCY_SIGMA) * STUB_LATENCY
+    return STUB_LATENCY
+
+# An injected failure, or None for a normal reply
+def sample_error():
+    if STUB_ERROR_RATE <= 0 or random.random() >= STUB_ERROR_RATE:
+        return None
+    status = random.choice(STUB_ERROR_STATUSES)
+    headers = {"retry-after": "1"} if status == 429 else None
+    return JSONResponse({
+        "type": "error",
+        "error": {"type": ERROR_TYPES.get(status, "api_error"), "message": "Injected stub failure"}
+    }, status_code=status, headers=headers)
+
+# Submitted batches: batch id -> {"created": time, "requests": [...]}
+batches = {}
+
+# Canned reply that echoes the last user message
+def stub_reply(payload):
+    last = payload["messages"][-1]["content"] if payload.get("messages") else ""
+    if isinstance(last, list):
+        last = " ".join(block.get("text", "") for block in last)
+    return f"Ugh, fine. You said: {last[:200]}"
+
+def stub_message(payload):
+    text = stub_reply(payload)
+    return {
+        "id": f"msg_{uuid4().hex}",
+        "type": "message",
+        "role": "assistant",
+        "model": payload.get("model", "stub"),
+        "content": [{"type": "text", "text": text}],
+        "stop_reason": "end_turn",
+        "usage": {"input_tokens": len(json.dumps(payload)) // 4, "output_tokens": len(text) // 4}
+    }
+
+@app.post("/v1/messages")
+async def messages(request: Request):
+    payload = await request.json()
+    message = stub_message(payload)
+    throttled = check_limits(message["usage"]["input_tokens"])
+    if throttled is not None:
+        return throttled
+    await asyncio.sleep(sample_latency())
+    error = sample_error()
+    if error is not None:
+        return error
+    charge_output(message["usage"]["output_tokens"])
+    if payload.get("stream"):
+        return StreamingResponse(stream_message(payload), media_type="text/event-stream", headers=limit_headers())
+    return JSONResponse(message, headers=limit_headers())
+
+def sse(event_type, data):
+    return f"event: {event_type}\ndata: {json.dumps({'type': event_type, **data})}\n\n"
+
+# Same reply as stub_message, as Messages API stream events with one delta per word
+async def stream_message(payload):
+    message = stub_message(payload)
+    text = message["content"][0]["text"]
+    yield sse("message_start", {"message": {**message, "content": [], "stop_reason": None,
+                                             "usage": {**message["usage"], "output_tokens": 1}}})
+    yield sse("content_block_start", {"index": 0, "content_block": {"type": "text", "text": ""}})
+    words = text.split(" ")
+    for i, word in enumerate(words):
+        await asyncio.sleep(STUB_TOKEN_DELAY)
+        piece = word if i == len(words) - 1 else word + " "
+        yield sse("content_block_delta", {"index": 0, "delta": {"type": "text_delta", "text": piece}})
+    yield sse("content_block_stop", {"index": 0})
+    yield sse("message_delta", {"delta": {"stop_reason": "end_turn"},
+                                "usage": {"output_tokens": message["usage"]["output_tokens"]}})
+    yield sse("message_stop", {})
+
+def batch_status(batch_id):
+    batch = batches[batch_id]
+    ended = time.time() - batch["created"] >= STUB_BATCH_DELAY
+    count = len(batch["requests"])
+    return {
+        "id": batch_id,
+        "type": "message_batch",
+        "processing_status": "ended" if ended else "in_progress",
+        "request_counts": {
+            "processing": 0 if ended else count,
+            "succeeded": count if ended else 0,
+            "errored": 0, "canceled": 0, "expired": 0
+        },
+        "results_url": f"{batch['base_url']}v1/messages/batches/{batch_id}/results" if ended else None
+    }
+
+@app.post("/v1/messages/batches")
+async def create_batch(request: Request):
+    body = await request.json()
+    batch_id = f"msgbatch_{uuid4().hex}"
+    batches[batch_id] = {"created": time.time(), "requests": body["requests"], "base_url": str(request.base_url)}
+    return JSONResponse(batch_status(batch_id))
+
+@app.get("/v1/messages/batches/{batch_id}")
+async def get_batch(batch_id: str):
+    if batch_id not in batches:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    return JSONResponse(batch_status(batch_id))
+
+@app.get("/v1/messages/batches/{batch_id}/results")
+async def get_batch_results(batch_id: str):
+    if batch_id not in batches:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    lines = [
+        json.dumps({
+            "custom_id": item["custom_id"],
+            "result": {"type": "succeeded", "message": stub_message(item["params"])}
+        })
+        for item in batches[batch_id]["requests"]
+    ]
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="application/x-jsonl")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Stub Anthropic Messages API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency", type=float, default=STUB_LATENCY, help="Seconds per message (median)")
+    parser.add_argument("--latency-dist", default=STUB_LATENCY_DIST,
+                        choices=["fixed", "uniform", "exponential", "lognormal"])
+    parser.add_argument("--spike-rate", type=float, default=STUB_SPIKE_RATE,
+                        help="Fraction of messages with a latency spike")
+    parser.add_argument("--spike-latency", type=float, default=STUB_SPIKE_LATENCY,
+                        help="Extra seconds a latency spike adds")
+    parser.add_argument("--error-rate", type=float, default=STUB_ERROR_RATE, help="Fraction of failed messages")
+    parser.add_argument("--token-delay", type=float, default=STUB_TOKEN_DELAY, help="Seconds between stream deltas")
+    parser.add_argument("--rpm", type=float, default=STUB_RPM, help="Requests per minute (0 = unlimited)")
+    parser.add_argument("--itpm", type=float, default=STUB_ITPM, help="Input tokens per minute (0 = unlimited)")
+    parser.add_argument("--otpm", type=float, default=STUB_OTPM, help="Output tokens per minute (0 = unlimited)")
+    args = parser.parse_args()
+    STUB_LATENCY = args.latency
+    STUB_LATENCY_DIST = args.latency_dist
+    STUB_SPIKE_RATE, STUB_SPIKE_LATENCY = args.spike_rate, args.spike_latency
+    STUB_ERROR_RATE = args.error_rate
+    STUB_TOKEN_DELAY = args.token_delay
+    STUB_RPM, STUB_ITPM, STUB_OTPM = args.rpm, args.itpm, args.otpm
+    limits = make_limits()
+    uvicorn.run(app, host=args.host, port=args.port)
@@ -0,0 +1,603 @@
+import os
+import json
+import time
+import random
+import asyncio
+import threading
+import requests
+import httpx
+import metrics
+from contextlib import aclosing
+from cache import ResponseCache
+from hedging import HedgePolicy
+from ratelimit import RateLimiter, INTERACTIVE
+from providers import ChatProvider
+from typing import List, Dict, Optional
+
+# HTTP/2 needs the optional h2 package; fall back to HTTP/1.1 keep-alive without it
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# Status codes worth retrying: timeouts, rate limits, server errors and overload (529)
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504, 529}
+# Statuses that count against upstream health (rate limits are expected, not a failure)
+UNHEALTHY_STATUS = {500, 502, 503, 504, 529}
+
+class UpstreamError(Exception):
+    """The upstream call failed; never stored as an assistant reply"""
+    def __init__(self, message, status_code=None, retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+class UpstreamTimeout(UpstreamError):
+    """The per-request deadline ran out"""
+
+class CircuitOpenError(UpstreamError):
+    """The circuit breaker is open, so the call was not attempted"""
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive unhealthy results and fails fast for
+    reset_timeout seconds. Then lets one trial call through (half-open): success
+    closes the circuit, failure opens it again.
+    """
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.lock = threading.Lock()
+
+    def before_call(self) -> bool:
+        """
+        Raise CircuitOpenError unless a call may go ahead. Returns True when the call is the
+        half-open trial: it must then end in record_success, record_failure or record_neutral
+        (also when it is cancelled), or the circuit stays open.
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return False
+            remaining = self.opened_at + self.reset_timeout - time.monotonic()
+            if remaining > 0 or self.trial_in_flight:
+                raise CircuitOpenError("Upstream circuit is open", retry_after=max(remaining, 1.0))
+            self.trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_in_flight or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.trial_in_flight = False
+
+    def record_neutral(self):
+        """The call finished without saying anything about upstream health (e.g. a 400)"""
+        with self.lock:
+            self.trial_in_flight = False
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    try:
+        return max(float(value), 0.0) if value is not None else None
+    except ValueError:
+        return None
+
+# Anthropic Messages API backend (the default chat provider)
+class ClaudeAPI(ChatProvider):
+    supports_batches = True
+
+    def __init__(self,
+                 api_key=None,
+                 base_url=None,
+                 pool_size=None,
+                 connect_timeout=None,
+                 read_timeout=None,
+                 max_retries=None,
+                 deadline=None):
+        """
+        Initialize Claude API client
+
+        Args:
+            api_key: Anthropic API key (default: ANTHROPIC_API_KEY env var)
+            base_url: API base URL, e.g. a local stub (default: ANTHROPIC_BASE_URL or https://api.anthropic.com)
+            pool_size: Max pooled connections for async mode (default: CLAUDE_POOL_SIZE or 100)
+            connect_timeout: Seconds to wait for a connection (default: CLAUDE_CONNECT_TIMEOUT or 5)
+            read_timeout: Seconds to wait for the response (default: CLAUDE_READ_TIMEOUT or 60)
+            max_retries: Retries after a retryable failure (default: CLAUDE_MAX_RETRIES or 3)
+            deadline: Overall seconds allowed per request, retries included (default: CLAUDE_DEADLINE or 30)
+        """
+
+        self.api_key = api_key or os.getenv("ANTHROPIC_API_KEY")
+        if not self.api_key:
+            raise ValueError("Claude API key is required. Set ANTHROPIC_API_KEY environment variable or pass as parameter.")
+
+        self.base_url = (base_url or os.getenv("ANTHROPIC_BASE_URL", "https://api.anthropic.com")).rstrip("/")
+        self.api_url = f"{self.base_url}/v1/messages"
+        self.batches_url = f"{self.base_url}/v1/messages/batches"
+        self.model = "claude-3-haiku-20240307"  # Can be changed to any Claude model
+
+        # Connection pool settings for the shared async client
+        self.pool_size = int(pool_size or os.getenv("CLAUDE_POOL_SIZE", 100))
+        self.connect_timeout = float(connect_timeout or os.getenv("CLAUDE_CONNECT_TIMEOUT", 5))
+        self.read_timeout = float(read_timeout or os.getenv("CLAUDE_READ_TIMEOUT", 60))
+
+        # Retries use capped exponential backoff with full jitter and honor retry-after
+        self.max_retries = int(max_retries if max_retries is not None else os.getenv("CLAUDE_MAX_RETRIES", 3))
+        self.deadline = float(deadline or os.getenv("CLAUDE_DEADLINE", 30))
+        self.backoff_base = 0.5
+        self.backoff_cap = 8.0
+        self.circuit = CircuitBreaker(
+            failure_threshold=int(os.getenv("CLAUDE_CIRCUIT_THRESHOLD", 5)),
+            reset_timeout=float(os.getenv("CLAUDE_CIRCUIT_RESET", 30))
+        )
+        self.headers = {
+            "x-api-key": self.api_key,
+            "anthropic-version": "2023-06-01",
+            "content-type": "application/json"
+        }
+
+        # Identical deterministic payloads are answered from here (RESPONSE_CACHE_SIZE=0 disables it)
+        cache_size = int(os.getenv("RESPONSE_CACHE_SIZE", 1024))
+        self.response_cache = ResponseCache(
+            max_entries=cache_size,
+            ttl_seconds=float(os.getenv("RESPONSE_CACHE_TTL", 300))
+        ) if cache_size > 0 else None
+
+        # Paces async calls against the account's rate limits, learned from the anthropic-ratelimit-*
+        # response headers; RATE_LIMIT_RPM/ITPM/OTPM give limits to start from (RATE_LIMIT=0 disables)
+        self.limiter = RateLimiter(
+            limits={
+                "requests": float(os.getenv("RATE_LIMIT_RPM", 0)),
+                "input_tokens": float(os.getenv("RATE_LIMIT_ITPM", 0)),
+                "output_tokens": float(os.getenv("RATE_LIMIT_OTPM", 0)),
+            },
+            reserve=float(os.getenv("RATE_LIMIT_RESERVE", 0.2))
+        ) if os.getenv("RATE_LIMIT", "1") != "0" else None
+
+        # Opt-in (HEDGE_REQUESTS=1): an interactive call still waiting after HEDGE_PERCENTILE of
+        # recent latencies is sent again and the first reply wins, for at most HEDGE_BUDGET extra calls
+        self.hedge = HedgePolicy(
+            percentile=float(os.getenv("HEDGE_PERCENTILE", 95)),
+            budget=float(os.getenv("HEDGE_BUDGET", 0.05)),
+            min_samples=int(os.getenv("HEDGE_MIN_SAMPLES", 50)),
+            min_delay=float(os.getenv("HEDGE_MIN_DELAY_MS", 50)) / 1000
+        ) if os.getenv("HEDGE_REQUESTS", "0") == "1" else None
+
+        # Created by start() and closed by close() (tied to the app lifespan)
+        self.client = None
+
+    async def start(self):
+        """Open the shared keep-alive connection pool used by async calls"""
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                headers=self.headers,
+                http2=HTTP2_AVAILABLE,
+                timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+                limits=httpx.Limits(
+                    max_connections=self.pool_size,
+                    max_keepalive_connections=self.pool_size
+                )
+            )
+
+    async def close(self):
+        """Close the shared connection pool"""
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def build_payload(self,
+                      messages: List[Dict[str, str]],
+                      temperature=0.3,
+                      max_new_tokens=None,
+                      cache_prompt=False,
+                      stop_sequences=None) -> Dict:
+        """
+        Convert chat messages (with optional system messages) into a Messages API payload.
+        With cache_prompt, the first system message and the history before the latest turn
+        are marked with cache_control breakpoints so the upstream can reuse them.
+        """
+        # Extract system prompt(s)
+        system_parts = []
+        formatted_messages = []
+
+        for message in messages:
+            if message["role"] == "system":
+                system_parts.append(message["content"])
+            else:
+                formatted_messages.append({
+                    "role": message["role"],
+                    "content": message["content"]
+                })
+
+        if cache_prompt and system_parts:
+            # Stable prefix first (cached), volatile context such as summaries after it
+            system_prompt = [{"type": "text", "text": part} for part in system_parts]
+            system_prompt[0]["cache_control"] = {"type": "ephemeral"}
+        else:
+            system_prompt = "\n\n".join(system_parts)
+
+        if cache_prompt and len(formatted_messages) > 1:
+            # Everything up to the previous turn is identical to the last request
+            older = formatted_messages[-2]
+            older["content"] = [{
+                "type": "text",
+                "text": older["content"],
+                "cache_control": {"type": "ephemeral"}
+            }]
+
+        # Create the request payload
+        payload = {
+            "model": self.model,
+            "messages": formatted_messages,
+            "system": system_prompt,
+            "temperature": temperature,
+        }
+
+        # Add max_tokens if specified (convert from max_new_tokens)
+        if max_new_tokens:
+            payload["max_tokens"] = max_new_tokens
+        if stop_sequences:
+            payload["stop_sequences"] = list(stop_sequences)
+
+        return payload
+
+    def _retry_delay(self, attempt: int, retry_after: Optional[float]) -> float:
+        """Seconds to wait before retry number attempt (0-based)"""
+        if retry_after is not None:
+            return retry_after
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * (2 ** attempt)))
+
+    def _check_status(self, status_code: int, body: str, headers) -> Optional[UpstreamError]:
+        """Update the circuit breaker; return the error for a non-200 response"""
+        if status_code == 200:
+            self.circuit.record_success()
+            return None
+        if status_code in UNHEALTHY_STATUS:
+            self.circuit.record_failure()
+        else:
+            self.circuit.record_neutral()
+        return UpstreamError(
+            f"Claude API error: {status_code} - {body}",
+            status_code=status_code,
+            retry_after=parse_retry_after(headers.get("retry-after"))
+        )
+
+    def _next_wait(self, error: UpstreamError, attempt: int, started: float) -> Optional[float]:
+        """Seconds to wait before retrying, or None if the error should be raised"""
+        retryable = error.status_code is None or error.status_code in RETRYABLE_STATUS
+        if not retryable or attempt >= self.max_retries:
+            return None
+        wait = self._retry_delay(attempt, error.retry_after)
+        # Don't start a retry that can't finish inside the deadline
+        if time.monotonic() + wait >= started + self.deadline:
+            return None
+        return wait
+
+    def _remaining(self, started: float) -> float:
+        remaining = started + self.deadline - time.monotonic()
+        if remaining <= 0:
+            raise UpstreamTimeout(f"Claude API deadline of {self.deadline}s exceeded")
+        return remaining
+
+    async def _admit(self, payload: Dict, priority: int, started: float) -> Optional[Dict]:
+        """Wait for rate limiter capacity within the deadline; returns the reserved cost"""
+        if self.limiter is None:
+            return None
+        cost = self.limiter.cost(payload)
+        try:
+            waited = await asyncio.wait_for(self.limiter.acquire(cost, priority), self._remaining(started))
+        except asyncio.TimeoutError:
+            # Nothing was sent, so this says nothing about upstream health (the caller frees a trial)
+            raise UpstreamTimeout(f"Claude API deadline of {self.deadline}s exceeded waiting for rate limits")
+        if waited:
+            metrics.record_stage("ratelimit", waited)
+        return cost
+
+    def _report(self, cost: Optional[Dict], response=None, usage: Optional[Dict] = None):
+        """Tell the rate limiter what a call used and what the upstream said about the limits"""
+        if cost is None:
+            return
+        self.limiter.settle(cost, usage)
+        if response is not None:
+            self.limiter.update(response.headers)
+            if response.status_code == 429:
+                self.limiter.pause(parse_retry_after(response.headers.get("retry-after")))
+
+    def _may_hedge(self) -> bool:
+        """
+        A duplicate call would only add to a backlog while calls wait for rate limits. While the
+        circuit is open or half-open it would fail fast (or race the single trial call)
+        """
+        if self.limiter is not None and any(self.limiter.lanes):
+            return False
+        return self.circuit.opened_at is None and not self.circuit.trial_in_flight
+
+    def generate_response(self,
+                         messages: List[Dict[str, str]],
+                         temperature=0.3,
+                         top_p=None,
+                         max_new_tokens=None,
+                         cache_prompt=False,
+                         stop_sequences=None):
+        """
+        Generate a response using Claude API (blocking)
+
+        Args:
+            messages: List of message dictionaries with role and content
+            temperature: Controls randomness (0.0-1.0)
+            top_p: Not used by Claude API, included for compatibility
+            max_new_tokens: Approximated to max_tokens for Claude
+            cache_prompt: Mark the system prompt and older history for prompt caching
+            stop_sequences: Strings that end the reply early (not included in it)
+
+        Raises:
+            UpstreamError (or UpstreamTimeout / CircuitOpenError) once retries are exhausted
+        """
+        payload = self.build_payload(messages, temperature, max_new_tokens, cache_prompt, stop_sequences)
+        with metrics.span("upstream"):
+            return self._post_message(payload)
+
+    def _post_message(self, payload: Dict) -> str:
+        """Blocking POST of a prepared payload with retries; returns the reply text"""
+        started = time.monotonic()
+
+        for attempt in range(self.max_retries + 1):
+            remaining = self._remaining(started)
+            self.circuit.before_call()
+            try:
+                response = requests.post(
+                    self.api_url,
+                    headers=self.headers,
+                    json=payload,
+                    timeout=(min(self.connect_timeout, remaining), min(self.read_timeout, remaining))
+                )
+                error = self._check_status(response.status_code, response.text, response.headers)
+                if error is None:
+                    data = response.json()
+                    metrics.record_usage(data.get("usage"))
+                    return data["content"][0]["text"]
+            except requests.RequestException as e:
+                self.circuit.record_failure()
+                error = UpstreamError(f"Exception during Claude API call: {str(e)}")
+
+            wait = self._next_wait(error, attempt, started)
+            if wait is None:
+                print(error)
+                raise error
+            time.sleep(wait)
+
+    async def agenerate_response(self,
+                                 messages: List[Dict[str, str]],
+                                 temperature=0.3,
+                                 top_p=None,
+                                 max_new_tokens=None,
+                                 cache_prompt=False,
+                                 use_cache=False,
+                                 priority=INTERACTIVE,
+                                 stop_sequences=None,
+                                 outcome=None):
+        """
+        Generate a response using Claude API without blocking the event loop.
+        Uses the pooled client opened by start(); same arguments and errors as generate_response.
+
+        Args:
+            use_cache: Serve identical payloads from the response cache and share
+                       concurrent identical calls. Only meant for deterministic
+                       requests (temperature 0) or stateless openers.
+            priority: Rate limiter lane (ratelimit.INTERACTIVE, BATCH or BACKGROUND); only
+                      interactive calls are hedged
+            outcome: Dict that receives the reply's "usage" and "stop_reason" (left empty
+                     when the reply comes from the response cache)
+        """
+        if self.client is None:
+            await self.start()
+
+        payload = self.build_payload(messages, temperature, max_new_tokens, cache_prompt, stop_sequences)
+        if self.hedge is not None and priority == INTERACTIVE:
+            post = lambda: self.hedge.run(
+                "message", lambda racer: self._apost_message(payload, priority, racer), outcome, self._may_hedge
+            )
+        else:
+            post = lambda: self._apost_message(payload, priority, outcome)
+        with metrics.span("upstream"):
+            if use_cache and self.response_cache is not None:
+                key = self.response_cache.make_key(payload)
+                return await self.response_cache.get_or_compute(key, post)
+            return await post()
+
+    async def _apost_message(self, payload: Dict, priority: int = INTERACTIVE, outcome: Optional[Dict] = None) -> str:
+        """POST a prepared payload with retries; returns the reply text"""
+        started = time.monotonic()
+
+        for attempt in range(self.max_retries + 1):
+            self._remaining(started)
+            trial = self.circuit.before_call()
+            # Set once the circuit breaker has heard how the call went
+            recorded = False
+            cost = None
+            try:
+                cost = await self._admit(payload, priority, started)
+                remaining = self._remaining(started)
+                response = await self.client.post(
+                    self.api_url,
+                    json=payload,
+                    timeout=httpx.Timeout(min(self.read_timeout, remaining),
+                                          connect=min(self.connect_timeout, remaining))
+                )
+                recorded = True
+                error = self._check_status(response.status_code, response.text, response.headers)
+                data = response.json() if error is None else {}
+                self._report(cost, response, data.get("usage"))
+                if error is None:
+                    metrics.record_usage(data.get("usage"))
+                    if outcome is not None:
+                        outcome.update(usage=data.get("usage"), stop_reason=data.get("stop_reason"))
+                    return data["content"][0]["text"]
+            except httpx.HTTPError as e:
+                recorded = True
+                self.circuit.record_failure()
+                self._report(cost)
+                error = UpstreamError(f"Exception during Claude API call: {str(e)}")
+            except asyncio.CancelledError:
+                # A cancelled call never reports usage; give its rate limit reservation back. Hedging
+                # cancels losers routinely, so a cancelled trial must also reopen the trial slot
+                self._report(cost)
+                if trial and not recorded:
+                    recorded = True
+                    self.circuit.record_neutral()
+                raise
+            finally:
+                if trial and not recorded:
+                    # Cancelled or out of time before any response: the next call may be the trial
+                    self.circuit.record_neutral()
+
+            wait = self._next_wait(error, attempt, started)
+            if wait is None:
+                print(error)
+                raise error
+            await asyncio.sleep(wait)
+
+    async def astream_response(self,
+                               messages: List[Dict[str, str]],
+                               temperature=0.3,
+                               top_p=None,
+                               max_new_tokens=None,
+                               cache_prompt=False,
+                               priority=INTERACTIVE,
+                               stop_sequences=None,
+                               outcome=None):
+        """
+        Stream a response using the Messages API `stream: true` mode.
+        Yields text deltas as they arrive; same arguments and errors as generate_response
+        (priority and outcome as for agenerate_response; outcome is filled as events arrive).
+        Failures before the first delta are retried; a stream that breaks midway is not.
+        Interactive streams are hedged on the time to their first delta.
+        """
+        if self.client is None:
+            await self.start()
+
+        payload = self.build_payload(messages, temperature, max_new_tokens, cache_prompt, stop_sequences)
+        payload["stream"] = True
+        if self.hedge is not None and priority == INTERACTIVE:
+            deltas = self.hedge.stream(
+                "stream", lambda racer: self._astream_message(payload, priority, racer), outcome, self._may_hedge
+            )
+        else:
+            deltas = self._astream_message(payload, priority, outcome)
+        async with aclosing(deltas):
+            async for delta in deltas:
+                yield delta
+
+    async def _astream_message(self, payload: Dict, priority: int = INTERACTIVE, outcome: Optional[Dict] = None):
+        """POST a prepared streaming payload with retries; yields the text deltas"""
+        if outcome is None:
+            outcome = {}
+        started = time.monotonic()
+
+        for attempt in range(self.max_retries + 1):
+            self._remaining(started)
+            trial = self.circuit.before_call()
+            recorded = False
+            cost = None
+            response = None
+            streamed = False
+            # Token usage arrives in message_start and (cumulative output) in message_delta
+            usage = outcome["usage"] = {}
+            try:
+                cost = await self._admit(payload, priority, started)
+                remaining = self._remaining(started)
+                async with self.client.stream(
+                    "POST", self.api_url, json=payload,
+                    timeout=httpx.Timeout(self.read_timeout, connect=min(self.connect_timeout, remaining))
+                ) as response:
+                    body = "" if response.status_code == 200 else (await response.aread()).decode(errors="replace")
+                    recorded = True
+                    error = self._check_status(response.status_code, body, response.headers)
+                    if error is None:
+                        # Server-sent events: only the data lines carry JSON
+                        async for line in response.aiter_lines():
+                            if not line.startswith("data:"):
+                                continue
+                            event = json.loads(line[5:].strip())
+                            if event.get("type") == "content_block_delta":
+                                delta = event.get("delta", {})
+                                if delta.get("type") == "text_delta":
+                                    streamed = True
+                                    yield delta["text"]
+                            elif event.get("type") == "message_start":
+                                usage.update(event.get("message", {}).get("usage", {}))
+                            elif event.get("type") == "message_delta":
+                                usage.update(event.get("usage", {}))
+                                outcome["stop_reason"] = event.get("delta", {}).get("stop_reason")
+                            elif event.get("type") == "error":
+                                raise UpstreamError(f"Claude API stream error: {event.get('error')}")
+                        metrics.record_usage(usage)
+                        return
+            except httpx.HTTPError as e:
+                recorded = True
+                self.circuit.record_failure()
+                error = UpstreamError(f"Exception during Claude API stream: {str(e)}")
+            except UpstreamTimeout:
+                # The deadline ran out waiting for rate limits; nothing was sent
+                raise
+            except UpstreamError as e:
+                error = e
+            finally:
+                # Also runs when the consumer stops reading early (or the call is cancelled).
+                # The headers' remaining capacity already counts this call, so settle it first
+                self._report(cost, response, usage)
+                if trial and not recorded:
+                    self.circuit.record_neutral()
+
+            wait = None if streamed else self._next_wait(error, attempt, started)
+            if wait is None:
+                print(error)
+                raise error
+            await asyncio.sleep(wait)
+
+    async def _batch_call(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """One Message Batches API call (these are not latency sensitive, so no retries)"""
+        if self.client is None:
+            await self.start()
+        try:
+            response = await self.client.request(method, url, **kwargs)
+        except httpx.HTTPError as e:
+            raise UpstreamError(f"Exception during Claude batch API call: {str(e)}")
+        if response.status_code != 200:
+            raise UpstreamError(
+                f"Claude batch API error: {response.status_code} - {response.text}",
+                status_code=response.status_code
+            )
+        return response
+
+    async def create_message_batch(self, requests: List[Dict]) -> Dict:
+        """
+        Submit requests to the Message Batches API.
+
+        Args:
+            requests: List of {"custom_id": str, "params": payload from build_payload}
+        """
+        response = await self._batch_call("POST", self.batches_url, json={"requests": requests})
+        return response.json()
+
+    async def get_message_batch(self, batch_id: str) -> Dict:
+        """Current status of a message batch ("processing_status" is "ended" when done)"""
+        response = await self._batch_call("GET", f"{self.batches_url}/{batch_id}")
+        return response.json()
+
+    async def get_message_batch_results(self, batch_id: str) -> List[Dict]:
+        """Results of an ended batch: one {"custom_id", "result"} entry per request"""
+        batch = await self.get_message_batch(batch_id)
+        results_url = batch.get("results_url") or f"{self.batches_url}/{batch_id}/results"
+        response = await self._batch_call("GET", results_url)
+        return [json.loads(line) for line in response.text.splitlines() if line.strip()]